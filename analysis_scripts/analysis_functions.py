@@ -2,11 +2,18 @@ import numpy as np
 from scipy import stats
 import pandas as pd
 
-from schrodinger.application.scisol.packages.fep.graph import Graph
-from schrodinger.application.scisol.packages.fep import fep_stats
+# Schrodinger is only needed to read FMP files. The CSV and experimental survey functions work without it.
+try:
+    from schrodinger.application.scisol.packages.fep.graph import Graph
+    from schrodinger.application.scisol.packages.fep import fep_stats
+except ImportError:
+    Graph = fep_stats = None
 
 
 import helper_functions as hf
+import profiling as prof
+import ragged
+import results_table as rt
 
 def read_exp_csv(filename):
     """
@@ -71,6 +78,7 @@ def weighted_rmsd(num_per_set, rmsd_per_set):
     return np.sqrt(np.sum(num_per_set * rmsd_per_set**2) / np.sum(num_per_set))
 
 
+@prof.profiled('bootstrap')
 def get_bootstrap_weighted_value(num_set, value_set, nboots=10000):
     """
     Return the bootstrap mean of an array along with uncertainty.
@@ -99,6 +107,7 @@ def get_bootstrap_weighted_value(num_set, value_set, nboots=10000):
     return value_samples.mean(), value_samples.std(), np.percentile(value_samples, 2.5), np.percentile(value_samples, 97.5)
 
 
+@prof.profiled('bootstrap')
 def get_bootstrap_weighted_rmsd(num_set, rmsd_set, nboots=10000):
     """
     Calculate the boostrap estimate of the overall weighted root-mean-square of a set of root-mean-squares (RMS)
@@ -176,7 +185,9 @@ def collect_fep_pairwise_errors(files):
     """
     pairwise_diffs = []
     for name in files:
-        g = Graph.deserialize(name)
+        entry = name.split('/')[-1].split('.')[0]
+        with prof.stage('deserialize', entry):
+            g = Graph.deserialize(name)
         exp_dgs = []
         pred_dgs = []
         for n in g.nodes_iter():
@@ -184,45 +195,49 @@ def collect_fep_pairwise_errors(files):
                 continue
             exp_dgs.append(n.exp_dg.val)
             pred_dgs.append(n.pred_dg.val)
-        pairwise_diffs.extend(hf.get_pairwise_diffs(np.array(exp_dgs), np.array(pred_dgs), verbose=False))
+        with prof.stage('pairwise diffs', entry):
+            pairwise_diffs.extend(hf.get_pairwise_diffs(np.array(exp_dgs), np.array(pred_dgs), verbose=False))
 
     return pairwise_diffs
 
 
-def parse_fep_data(files):
+def parse_fep_map(name):
     """
-    Collect the FEP errors from a list of FEP+ fmp files
-
-    TODO: document format of output.
+    Collect the FEP errors of a single FEP+ fmp file.
 
     Parameters
     ----------
-    files: list-like
-        The paths to all the output fmp files.
+    name: str
+        The path to the output fmp file.
 
     Returns
     -------
-    results: dict
-        A dictionary containing all numpy arrays of each error metric.
+    metrics: dict
+        The value of each error metric of the map, with the same keys as the results of parse_fep_data.
+    diffs: numpy.ndarray
+        The pairwise errors of the map.
+    uncertainties: dict
+        The uncertainties of the 'Edgewise RMSE' and 'Pairwise RMSE' from fep_stats, which are shown in the latex tables.
     """
-    results = {'entries':[], 'number of compounds':[], 'number of edges':[], 'Pairwise RMSE':[], 'Pairwise MUE':[],
-               'Edgewise RMSE':[], 'Edgewise MUE':[], 'R-squared':[], 'Kendall tau':[]}
-
-    pairwise_diffs = []
-    for name in files:
-        results['entries'].append(name.split('/')[-1].split('.')[0])
-        g = Graph.deserialize(name)
+    entry = name.split('/')[-1].split('.')[0]
+    with prof.stage('parse map', entry):
+        with prof.stage('deserialize', entry):
+            g = Graph.deserialize(name)
 
         # Collect the aggregate stats
-        r = fep_stats.calculate(g)
-        results['number of compounds'].append(r['Total compounds'])
-        results['number of edges'].append(g.number_of_edges())
-        results['Edgewise RMSE'].append(r['RMSE Edgewise'].val)
-        results['Edgewise MUE'].append(r['MUE Edgewise'].val)
-        results['Pairwise RMSE'].append(r['RMSE Pairwise'].val)
-        results['Pairwise MUE'].append(r['MUE Pairwise'].val)
-        results['R-squared'].append(r['R^2'])
-        results['Kendall tau'].append(calculate_tau_from_fep(g))
+        with prof.stage('fep_stats.calculate', entry):
+            r = fep_stats.calculate(g)
+        metrics = {'entries': entry,
+                   'number of compounds': r['Total compounds'],
+                   'number of edges': g.number_of_edges(),
+                   'Pairwise RMSE': r['RMSE Pairwise'].val,
+                   'Pairwise MUE': r['MUE Pairwise'].val,
+                   'Edgewise RMSE': r['RMSE Edgewise'].val,
+                   'Edgewise MUE': r['MUE Edgewise'].val,
+                   'R-squared': r['R^2']}
+        with prof.stage('kendall tau', entry):
+            metrics['Kendall tau'] = calculate_tau_from_fep(g)
+        uncertainties = {'Edgewise RMSE': r['RMSE Edgewise'].unc, 'Pairwise RMSE': r['RMSE Pairwise'].unc}
 
         # Collect the pairwise errors
         exp_dgs = []
@@ -232,58 +247,113 @@ def parse_fep_data(files):
                 continue
             exp_dgs.append(n.exp_dg.val)
             pred_dgs.append(n.pred_dg.val)
-        pairwise_diffs.extend(hf.get_pairwise_diffs(np.array(exp_dgs), np.array(pred_dgs), verbose=False))
+        with prof.stage('pairwise diffs', entry):
+            diffs = hf.get_pairwise_diffs(np.array(exp_dgs), np.array(pred_dgs), verbose=False)
 
-    for key in results:
-        results[key] = np.array(results[key])
+    return metrics, diffs, uncertainties
 
-    return results, np.array(pairwise_diffs)
 
-
-def parse_fep_data_from_csv(files):
+def parse_fep_data(files):
     """
     Collect the FEP errors from a list of FEP+ fmp files
 
+    TODO: document format of output.
+
     Parameters
     ----------
     files: list-like
-        The paths to all the output csv files.
+        The paths to all the output fmp files.
 
     Returns
     -------
-    results: dict
-        A dictionary containing all numpy arrays of each error metric.
+    results: results_table.ResultsTable
+        A dictionary containing all numpy arrays of each error metric, with one row per map and the group of each map.
     """
-    results = {'entries': [],
-               'number of compounds': [],
-               'Pairwise RMSE': [],
-               'Pairwise MUE': [],
-               'R-squared': [],
-               'Kendall tau': []}
+    columns = ['entries', 'number of compounds', 'number of edges', 'Pairwise RMSE', 'Pairwise MUE', 'Edgewise RMSE',
+               'Edgewise MUE', 'R-squared', 'Kendall tau']
 
+    records = []
     pairwise_diffs = []
     for name in files:
-        results['entries'].append(name.split('/')[-1].split('.')[0])
+        metrics, diffs, uncertainties = parse_fep_map(name)
+        records.append(metrics)
+        pairwise_diffs.extend(diffs)
 
-        df = pd.read_csv(name)
-        rmsd, mue, r2, tau = hf.get_absolute_stats(df['Pred. dG (kcal/mol)'], df['Exp. dG (kcal/mol)'], verbose=False)
+    results = rt.ResultsTable.from_records(records, [rt.group_of(name) for name in files], columns)
+    return results, np.array(pairwise_diffs)
 
-        diffs = hf.get_pairwise_diffs(df['Pred. dG (kcal/mol)'], df['Exp. dG (kcal/mol)'], verbose=False)
-        pairwise_diffs.extend(diffs)
 
-        # Collect the aggregate stats
-        results['number of compounds'].append(len(df))
-        results['Pairwise RMSE'].append(np.sqrt(np.mean(diffs ** 2)))
-        results['Pairwise MUE'].append(np.mean(np.abs(diffs)))
-        results['R-squared'].append(r2)
-        results['Kendall tau'].append(tau)
+def parse_fep_csv(name):
+    """
+    Collect the FEP errors of a single FEP+ csv file.
 
-    for key in results:
-        results[key] = np.array(results[key])
+    Parameters
+    ----------
+    name: str
+        The path to the output csv file.
 
-    return results, np.array(pairwise_diffs)
+    Returns
+    -------
+    metrics: dict
+        The value of each error metric of the map, with the same keys as the results of parse_fep_data_from_csv.
+    diffs: numpy.ndarray
+        The pairwise errors of the map.
+    """
+    entry = name.split('/')[-1].split('.')[0]
+    with prof.stage('parse map', entry):
+        with prof.stage('read csv', entry):
+            df = pd.read_csv(name)
+        maps = ragged.RaggedMaps.from_series([df['Pred. dG (kcal/mol)'].values], [df['Exp. dG (kcal/mol)'].values])
+        metrics = {key: values[0] for key, values in _map_metrics([entry], maps).items()}
+        diffs = maps.pairwise_diffs()
+    return metrics, diffs
+
+
+def _map_metrics(entries, maps):
+    """
+    The error metrics of every map of a ragged.RaggedMaps of the predicted (x) and experimental (y) binding free
+    energies, with the columns of parse_fep_data_from_csv.
+    """
+    return {'entries': entries,
+            'number of compounds': maps.counts,
+            'Pairwise RMSE': maps.pairwise_rmse(),
+            'Pairwise MUE': maps.pairwise_mue(),
+            'R-squared': maps.r_squared(),
+            'Kendall tau': maps.kendall_tau()}
+
+
+def parse_fep_data_from_csv(files):
+    """
+    Collect the FEP errors from a list of FEP+ fmp files. The binding free energies of all the maps are gathered into
+    flat arrays and the metrics of every map are calculated together with segment reductions (see ragged.py).
+
+    Parameters
+    ----------
+    files: list-like
+        The paths to all the output csv files.
+
+    Returns
+    -------
+    results: results_table.ResultsTable
+        A dictionary containing all numpy arrays of each error metric, with one row per map and the group of each map.
+    """
+    entries, preds, exps = [], [], []
+    for name in files:
+        entry = name.split('/')[-1].split('.')[0]
+        with prof.stage('read csv', entry):
+            df = pd.read_csv(name)
+        entries.append(entry)
+        preds.append(df['Pred. dG (kcal/mol)'].values)
+        exps.append(df['Exp. dG (kcal/mol)'].values)
 
+    with prof.stage('segment statistics'):
+        maps = ragged.RaggedMaps.from_series(preds, exps)
+        results = rt.ResultsTable.from_columns(_map_metrics(entries, maps), [rt.group_of(name) for name in files])
+        pairwise_diffs = maps.pairwise_diffs()
+    return results, pairwise_diffs
 
+
+@prof.profiled('summarize_fep_error')
 def summarize_fep_error(results, verbose=True):
     """
     Calculate the weighted errors and correlation statistics for the FEP benchmark.
@@ -412,42 +482,37 @@ def parse_experimental_data(files, notlist=()):
 
     Returns
     -------
-    results: dict
-        Contains the arrays of the data RMSEs, MUEs, and correlation statistics.
+    results: results_table.ResultsTable
+        Contains the arrays of the data RMSEs, MUEs, and correlation statistics, with one row per comparison.
     """
-    results = {'entries':[], 'number':[], 'Pairwise RMSE':[], 'Pairwise MUE':[], 'Absolute RMSE':[], 'Absolute MUE':[],
-               'R-squared':[], 'Kendall tau':[]}
-
-    pairwise_diffs = []
+    entries, groups, dg1s, dg2s = [], [], [], []
     for f in files:
         entry = f.split('/')[-1].split('.')[0]
         if entry in notlist:
             #print('Skipping {}'.format(entry))
             pass
         else:
-            # Collect the aggregate stats
-            results['entries'].append(entry)
-            # Correlation stats
-            dg1, dg2 = read_exp_csv(f)
-            rmsd, mae, c1, c2  = hf.get_absolute_stats(dg1, dg2, verbose=False)
-            results['R-squared'].append(c1)
-            results['Kendall tau'].append(c2)
-            results['number'].append(len(dg1))
-            # Abosulute errors
-            results['Absolute RMSE'].append(np.sqrt(np.mean((dg1 - dg2)**2)))
-            results['Absolute MUE'].append(np.mean(np.abs(dg1 - dg2)))
-            # Pairwise errors
-            diffs = hf.get_pairwise_diffs(dg1, dg2, verbose=False)
-            results['Pairwise RMSE'].append(np.sqrt(np.mean(diffs**2)))
-            results['Pairwise MUE'].append(np.mean(np.abs(diffs)))
-
-            # Store the pairwise differences
-            pairwise_diffs.extend(diffs)
-
-    for key in results:
-        results[key] = np.array(results[key])
-
-    return results, np.array(pairwise_diffs)
+            entries.append(entry)
+            groups.append(rt.group_of(f))
+            with prof.stage('read csv', entry):
+                dg1, dg2 = read_exp_csv(f)
+            dg1s.append(dg1)
+            dg2s.append(dg2)
+
+    # The stats of all the comparisons are calculated together with segment reductions over flat arrays.
+    with prof.stage('segment statistics'):
+        maps = ragged.RaggedMaps.from_series(dg1s, dg2s)
+        results = {'entries': entries,
+                   'number': maps.counts,
+                   'Pairwise RMSE': maps.pairwise_rmse(),
+                   'Pairwise MUE': maps.pairwise_mue(),
+                   'Absolute RMSE': maps.absolute_rmse(),
+                   'Absolute MUE': maps.absolute_mue(),
+                   'R-squared': maps.r_squared(),
+                   'Kendall tau': maps.kendall_tau()}
+        pairwise_diffs = maps.pairwise_diffs()
+
+    return rt.ResultsTable.from_columns(results, groups), pairwise_diffs
 
 
 def summarize_experimental_error(files, notlist=()):
@@ -489,24 +554,38 @@ def error_diff_stats(diffs):
     Print out the percentage of differences less than 1 kcal/mol and the fraction of differences greater than 2 kcal/mol.
     """
     abs_diffs = np.abs(diffs)
-    total = len(diffs)
-    frac_less_1 = np.sum(abs_diffs < 1) / total
-    frac_more_2 = np.sum(abs_diffs > 2) / total
+    print_error_diff_counts(len(diffs), np.sum(abs_diffs < 1), np.sum(abs_diffs > 2))
+
+
+def print_error_diff_counts(total, num_less_1, num_more_2):
+    """
+    Print out the statistics of error_diff_stats from the number of differences that are less than 1 kcal/mol and
+    greater than 2 kcal/mol in magnitude.
+    """
+    frac_less_1 = num_less_1 / total
+    frac_more_2 = num_more_2 / total
     print(f'There are a total of {total} differences')
     print(f'{100 * frac_less_1:.1f}% of the differences are less than 1 kcal/mol' )
     print(f'{100 * frac_more_2:.1f}% of the differences are greater than 2 kcal/mol' )
 
 
-def print_latex_table(fmpnames, out2pdb=None, out2protein=None):
+def format_latex_table(maps, out2pdb=None, out2protein=None):
     """
-    Print out the errors for a collection of FEP+ maps in a latex formatted table.
+    Format the errors for a collection of FEP+ maps as a latex table.
 
-    fmpnames: list of str
-        The paths to a every FEP+ output file you want to put in a latex table.
+    Parameters
+    ----------
+    maps: list of tuple
+        The metrics and uncertainties of each map, as returned by parse_fep_map.
     out2pdb: dict
         A dictionary that links the output filename to a PDB
     out2protein: dict
         A dictionary that links the output filename to a protein name.
+
+    Returns
+    -------
+    table: str
+        The latex table.
     """
     num_compounds = []
     num_edges = []
@@ -514,16 +593,14 @@ def print_latex_table(fmpnames, out2pdb=None, out2protein=None):
     edge_rmse = []
     r2 = []
     lines = []
-    for name in fmpnames:
-        g = Graph.deserialize(name)
-        r = fep_stats.calculate(g)
-        num_compounds.append(r['Total compounds'])
-        num_edges.append(g.number_of_edges())
-        edge_rmse.append(r['RMSE Edgewise'].val)
-        pairwise_rmse.append(r['RMSE Pairwise'].val)
-        r2.append(r['R^2'])
-
-        outname = name.split('/')[-1].split('.')[0]
+    for metrics, uncertainties in maps:
+        num_compounds.append(metrics['number of compounds'])
+        num_edges.append(metrics['number of edges'])
+        edge_rmse.append(metrics['Edgewise RMSE'])
+        pairwise_rmse.append(metrics['Pairwise RMSE'])
+        r2.append(metrics['R-squared'])
+
+        outname = metrics['entries']
         if out2pdb is not None:
             pdb = out2pdb[outname]
         else:
@@ -535,13 +612,13 @@ def print_latex_table(fmpnames, out2pdb=None, out2protein=None):
 
         line = r'    {:35} & {} & {} & {} & {:.2f} & {:.2f} $\pm$ {:.2f} & {:.2f} $\pm$ {:.2f} \\'.format(protein,
                                                                                            pdb,
-                                                                                           r['Total compounds'],
-                                                                                           g.number_of_edges(),
-                                                                                           r['R^2'],
-                                                                                           r['RMSE Edgewise'].val,
-                                                                                           r['RMSE Edgewise'].unc,
-                                                                                           r['RMSE Pairwise'].val,
-                                                                                           r['RMSE Pairwise'].unc)
+                                                                                           metrics['number of compounds'],
+                                                                                           metrics['number of edges'],
+                                                                                           metrics['R-squared'],
+                                                                                           metrics['Edgewise RMSE'],
+                                                                                           uncertainties['Edgewise RMSE'],
+                                                                                           metrics['Pairwise RMSE'],
+                                                                                           uncertainties['Pairwise RMSE'])
         lines.append(line)
 
     num_compounds = np.array(num_compounds)
@@ -584,10 +661,24 @@ def print_latex_table(fmpnames, out2pdb=None, out2protein=None):
 \end{table}
     """
 
-    print(header)
-    for l in lines:
-        print(l)
-    print(last_line)
-    print(footer)
+    return '\n'.join([header] + lines + [last_line, footer])
+
+
+def print_latex_table(fmpnames, out2pdb=None, out2protein=None):
+    """
+    Print out the errors for a collection of FEP+ maps in a latex formatted table.
+
+    fmpnames: list of str
+        The paths to a every FEP+ output file you want to put in a latex table.
+    out2pdb: dict
+        A dictionary that links the output filename to a PDB
+    out2protein: dict
+        A dictionary that links the output filename to a protein name.
+    """
+    maps = []
+    for name in fmpnames:
+        metrics, diffs, uncertainties = parse_fep_map(name)
+        maps.append((metrics, uncertainties))
+    print(format_latex_table(maps, out2pdb, out2protein))
 
 
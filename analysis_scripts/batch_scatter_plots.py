@@ -0,0 +1,197 @@
+import argparse
+import glob
+import hashlib
+import html
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+import fast_stats as fs
+import generate_scatter_plots as gsp
+import profiling as prof
+
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '21_4_results', 'ligand_predictions')
+
+EXP_COLUMN = 'Exp. dG (kcal/mol)'
+EXP_ERR_COLUMN = 'Exp. dG error (kcal/mol)'
+PRED_COLUMN = 'Pred. dG (kcal/mol)'
+PRED_ERR_COLUMN = 'Pred. dG std. error (kcal/mol)'
+
+# Bump this when the appearance of the plots changes so that every plot is redrawn.
+PLOT_VERSION = 1
+
+
+def find_maps(dirname):
+    """
+    Find the ligand prediction CSV file of every map in a directory of groups, as in ../21_4_results/ligand_predictions.
+
+    Returns
+    -------
+    maps: list of dict
+        The 'group', 'name' and 'path' of each map, sorted by group and name.
+    """
+    maps = []
+    for path in sorted(glob.glob(os.path.join(dirname, '*', '*.csv'))):
+        group = os.path.basename(os.path.dirname(path))
+        name = os.path.splitext(os.path.basename(path))[0]
+        maps.append({'group': group, 'name': name, 'path': path})
+    return maps
+
+
+def input_hash(path, settings):
+    """
+    The hash of a map's CSV file and the settings that affect its plot, which decides whether the plot is redrawn.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        h.update(f.read())
+    h.update(repr(settings).encode())
+    return h.hexdigest()
+
+
+def map_statistics(m, nboots, seed):
+    """
+    Read one map and calculate its statistics, intervals and annotation strings. The random numbers of each map are
+    seeded by the seed and the map's name, so a map's intervals do not depend on which other maps are processed.
+
+    Returns
+    -------
+    row: dict
+        The row of the index for the map.
+    job: dict
+        Everything that is needed to draw the map's plot.
+    """
+    df = pd.read_csv(m['path'])
+    df = df.loc[pd.notna(df[EXP_COLUMN]) & pd.notna(df[PRED_COLUMN])]
+    dgx = df[EXP_COLUMN].values.astype(float)
+    dgy = df[PRED_COLUMN].values.astype(float)
+    dgx_err = df[EXP_ERR_COLUMN].fillna(0.).values if EXP_ERR_COLUMN in df else None
+    dgy_err = df[PRED_ERR_COLUMN].fillna(0.).values if PRED_ERR_COLUMN in df else None
+
+    rng = np.random.default_rng([seed, zlib.crc32(f'{m["group"]}/{m["name"]}'.encode())])
+    values, samples = fs.bootstrap_statistics(dgx, dgy, nboots, rng)
+    row = {'Group': m['group'], 'Map': m['name'], 'Number of ligands': len(dgx)}
+    for s in fs.STATISTICS:
+        lower, upper = fs.interval(samples[s])
+        row.update({s: values[s], f'{s} lower': lower, f'{s} upper': upper})
+
+    tau = r"$\tau_{{\Delta G}}$ = {0:.2f} [{1:.2f}, {2:.2f}]".format(row['Kendall tau'], row['Kendall tau lower'],
+                                                                   row['Kendall tau upper'])
+    rmse = r'$RMSE_{{\Delta\Delta G}}$ = {0:.1f} [{1:.1f}, {2:.1f}] kcal/mol'.format(
+        row['Pairwise RMSE'], row['Pairwise RMSE lower'], row['Pairwise RMSE upper'])
+    job = {'title': f'{m["group"]}: {m["name"]}', 'dgx': dgx, 'dgy': dgy, 'dgx_err': dgx_err, 'dgy_err': dgy_err,
+           'annotations': [tau, rmse]}
+    return row, job
+
+
+def render(job):
+    """
+    Draw and save the scatter plot of one map with the Agg backend.
+    """
+    fig, ax = plt.subplots(figsize=(7, 7))
+    gsp.draw_scatter(ax, job['dgx'], job['dgy'], job['dgx_err'], job['dgy_err'], job['annotations'])
+    ax.set_title(job['title'], fontsize=16)
+    ax.set_xlabel(r'Experimental $\Delta G$ (kcal/mol)', fontsize=14)
+    ax.set_ylabel(r'$\Delta G$ predicted by FEP+ (kcal/mol)', fontsize=14)
+    fig.tight_layout()
+    fig.savefig(job['image'], dpi=job['dpi'])
+    plt.close(fig)
+    return job['image']
+
+
+def write_html_index(index, outdir):
+    """
+    Write an HTML page with the statistics and plot of every map.
+    """
+    lines = ['<html><head><meta charset="utf-8"><title>FEP+ benchmark scatter plots</title></head><body>',
+             '<table border="1" cellspacing="0" cellpadding="4">',
+             '<tr><th>Group</th><th>Map</th><th>Ligands</th><th>Pairwise RMSE (kcal/mol)</th><th>Kendall tau</th>'
+             '<th>Plot</th></tr>']
+    for _, r in index.iterrows():
+        image = html.escape(r['Image'])
+        lines.append(f'<tr><td>{html.escape(r["Group"])}</td><td>{html.escape(r["Map"])}</td>'
+                     f'<td>{r["Number of ligands"]}</td>'
+                     f'<td>{r["Pairwise RMSE"]:.2f} [{r["Pairwise RMSE lower"]:.2f}, '
+                     f'{r["Pairwise RMSE upper"]:.2f}]</td>'
+                     f'<td>{r["Kendall tau"]:.2f} [{r["Kendall tau lower"]:.2f}, {r["Kendall tau upper"]:.2f}]</td>'
+                     f'<td><a href="{image}"><img src="{image}" width="300"></a></td></tr>')
+    lines += ['</table>', '</body></html>']
+    with open(os.path.join(outdir, 'index.html'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def main(argv=None):
+    description = """
+    Draw a scatter plot of the FEP+ predictions against experiment for every map in the benchmark. The statistics,
+    bootstrap intervals and annotations of all maps are calculated first, then the plots are drawn in parallel with
+    the non-interactive Agg backend. One PNG file is written per map (as <group>/<map>.png) together with index.csv
+    and index.html, which hold the statistics of every map. The index records a hash of each map's CSV file and of the
+    plot settings, and maps whose hash has not changed since the last run are not recomputed or redrawn.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('dirname', type=str, nargs='?', default=DEFAULT_DIR,
+                        help="The directory with a subdirectory of ligand prediction CSV files for each group, "
+                             "default=../21_4_results/ligand_predictions.")
+    parser.add_argument('-o', '--outdir', type=str, help="The output directory, default=scatter_plots.",
+                        default='scatter_plots')
+    parser.add_argument('-b', '--nboots', type=int, help="The number of bootstrap samples, default=5000.",
+                        default=5000)
+    parser.add_argument('--seed', type=int, help="The seed of the random number generator, default=0.", default=0)
+    parser.add_argument('--dpi', type=int, help="The resolution of the plots, default=100.", default=100)
+    parser.add_argument('-j', dest='nprocs', type=int, help="The number of plots to draw in parallel, "
+                                                            "default=number of CPUs.", default=os.cpu_count())
+    parser.add_argument('-f', '--force', action='store_true', help="Redraw every plot, even if its input is unchanged.")
+    prof.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+    prof.setup(args)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    index_csv = os.path.join(args.outdir, 'index.csv')
+    previous = {}
+    if os.path.isfile(index_csv) and not args.force:
+        df = pd.read_csv(index_csv, dtype={'Group': str, 'Map': str})
+        previous = {(r['Group'], r['Map']): r.to_dict() for _, r in df.iterrows()}
+
+    settings = (PLOT_VERSION, args.nboots, args.seed, args.dpi)
+    rows, jobs = [], []
+    for m in find_maps(args.dirname):
+        image = os.path.join(m['group'], f'{m["name"]}.png')
+        with prof.stage('hash', m['name']):
+            digest = input_hash(m['path'], settings)
+        old = previous.get((m['group'], m['name']))
+        if old is not None and old['Input hash'] == digest and os.path.isfile(os.path.join(args.outdir, image)):
+            rows.append(old)
+            continue
+        try:
+            with prof.stage('statistics', m['name']):
+                row, job = map_statistics(m, args.nboots, args.seed)
+        except Exception as e:
+            print(f'Unable to process {m["path"]}: {type(e).__name__}: {e}')
+            continue
+        row.update({'Image': image, 'Input hash': digest})
+        os.makedirs(os.path.join(args.outdir, m['group']), exist_ok=True)
+        job.update({'image': os.path.join(args.outdir, image), 'dpi': args.dpi})
+        rows.append(row)
+        jobs.append(job)
+
+    print(f'{len(jobs)} of {len(rows)} plots need to be drawn')
+    if len(jobs) > 0:
+        with prof.stage('render'), ProcessPoolExecutor(max_workers=args.nprocs) as pool:
+            for _ in pool.map(render, jobs, chunksize=max(1, len(jobs) // (4 * args.nprocs))):
+                pass
+
+    index = pd.DataFrame(rows)
+    index.to_csv(index_csv, index=False)
+    write_html_index(index, args.outdir)
+    print(f'Plots and index written to {args.outdir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import analysis_functions as af
+import fast_stats as fs
+import helper_functions as hf
+import process_fep_benchmark
+import write_group_summary_tables
+
+DEFAULT_SIZES = (10, 30, 100, 300, 1000, 3000, 10000)
+
+# The number of maps (or assay comparisons) written for the cases that read a directory of files.
+NFILES = 4
+
+
+def synthetic_map(nligands, rng, spread=1.5, error_scale=0.8, df=5):
+    """
+    Generate the ligand predictions of a map in the format of ../21_4_results/ligand_predictions.
+
+    The experimental DGs are normally distributed with the spread of a typical congeneric series. The prediction
+    errors are t-distributed, as are the errors of the benchmark, and the predictions are shifted to have the same
+    mean as experiment.
+
+    Parameters
+    ----------
+    nligands: int
+        The number of ligands.
+    rng: numpy.random.Generator
+        The random number generator.
+    spread: float
+        The standard deviation of the experimental DGs (in kcal/mol).
+    error_scale: float
+        The scale of the t-distributed prediction errors (in kcal/mol).
+    df: float
+        The degrees of freedom of the prediction errors.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        The ligand names, experimental and predicted DGs and the standard errors of the predictions.
+    """
+    exp = rng.normal(-9., spread, nligands)
+    pred = exp + error_scale * rng.standard_t(df, nligands)
+    pred += exp.mean() - pred.mean()
+    return pd.DataFrame({'Ligand name': [f'lig{i}' for i in range(nligands)],
+                         'Exp. dG (kcal/mol)': exp,
+                         'Pred. dG (kcal/mol)': pred,
+                         'Pred. dG std. error (kcal/mol)': rng.gamma(4., 0.05, nligands)})
+
+
+def synthetic_comparison(nligands, rng, spread=1.5, error_scale=0.6, df=5, offset_sd=0.5):
+    """
+    Generate an assay comparison in the format of the experimental survey: the DGs of the same ligands from two assays
+    that differ by a constant offset and t-distributed noise.
+    """
+    dg1 = rng.normal(-9., spread, nligands)
+    dg2 = dg1 + rng.normal(0., offset_sd) + error_scale * rng.standard_t(df, nligands)
+    return pd.DataFrame({'dG assay 1 (kcal/mol)': dg1, 'dG assay 2 (kcal/mol)': dg2})
+
+
+def synthetic_results(nmaps, rng):
+    """
+    Generate the per-map statistics of a benchmark of many maps, in the format of analysis_functions.parse_fep_data.
+    """
+    n = rng.integers(10, 60, nmaps)
+    rmse = np.abs(rng.normal(1.1, 0.35, nmaps))
+    return {'entries': np.array([f'map{i}' for i in range(nmaps)]),
+            'number of compounds': n,
+            'number of edges': (1.6 * n).astype(int),
+            'Pairwise RMSE': rmse,
+            'Pairwise MUE': 0.8 * rmse,
+            'Edgewise RMSE': 0.85 * rmse,
+            'Edgewise MUE': 0.7 * rmse,
+            'R-squared': rng.uniform(0., 0.9, nmaps),
+            'Kendall tau': rng.uniform(-0.1, 0.8, nmaps)}
+
+
+def write_benchmark_tree(root, nligands, rng, nmaps=NFILES):
+    """
+    Write a directory of synthetic maps with the layout that the analysis scripts expect, with the maps split
+    between two groups.
+
+    Returns
+    -------
+    files: list of str
+        The CSV files of the maps.
+    """
+    files = []
+    for i in range(nmaps):
+        group_dir = os.path.join(root, f'group_{i % 2}')
+        os.makedirs(group_dir, exist_ok=True)
+        files.append(os.path.join(group_dir, f'map{i}_out.csv'))
+        synthetic_map(nligands, rng).to_csv(files[-1], index=False)
+    return files
+
+
+def write_survey(root, nligands, rng, ncomparisons=NFILES):
+    """
+    Write a directory of synthetic assay comparisons.
+
+    Returns
+    -------
+    files: list of str
+        The CSV files of the comparisons.
+    """
+    os.makedirs(root, exist_ok=True)
+    files = []
+    for i in range(ncomparisons):
+        files.append(os.path.join(root, f'comparison{i}.csv'))
+        synthetic_comparison(nligands, rng).to_csv(files[-1], index=False)
+    return files
+
+
+def _series(size, rng):
+    df = synthetic_map(size, rng)
+    return df['Exp. dG (kcal/mol)'].values, df['Pred. dG (kcal/mol)'].values
+
+
+def _quiet_cli(main, argv, cwd):
+    """
+    A function that runs the main function of a script in a directory without printing.
+    """
+    def run():
+        owd = os.getcwd()
+        os.chdir(cwd)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                main(argv)
+        finally:
+            os.chdir(owd)
+    return run
+
+
+def _pairwise_diffs_case(size, workdir, rng, nboots):
+    x, y = _series(size, rng)
+    return lambda: hf.get_pairwise_diffs(x, y, verbose=False)
+
+
+def _bootstrap_pairwise_case(size, workdir, rng, nboots):
+    x, y = _series(size, rng)
+    return lambda: hf.bootstrap_pairwise_error(x, y, nboots)
+
+
+def _bootstrap_absolute_case(size, workdir, rng, nboots):
+    x, y = _series(size, rng)
+    return lambda: hf.bootstrap_absolute_stats(x, y, nboots)
+
+
+def _fast_stats_case(size, workdir, rng, nboots):
+    x, y = _series(size, rng)
+    return lambda: fs.bootstrap_statistics(x, y, nboots, rng)
+
+
+def _parse_fep_csv_case(size, workdir, rng, nboots):
+    files = write_benchmark_tree(os.path.join(workdir, 'fep'), size, rng)
+    return lambda: af.parse_fep_data_from_csv(files)
+
+
+def _parse_experimental_case(size, workdir, rng, nboots):
+    files = write_survey(os.path.join(workdir, 'survey'), size, rng)
+    return lambda: af.parse_experimental_data(files)
+
+
+def _summarize_case(size, workdir, rng, nboots):
+    results = synthetic_results(size, rng)
+    return lambda: af.summarize_fep_error(results, verbose=False)
+
+
+def _process_benchmark_case(size, workdir, rng, nboots):
+    write_benchmark_tree(os.path.join(workdir, 'fep'), size, rng)
+    return _quiet_cli(process_fep_benchmark.main, [os.path.join(workdir, 'fep'), '-e', 'csv'], workdir)
+
+
+def _group_tables_case(size, workdir, rng, nboots):
+    write_benchmark_tree(os.path.join(workdir, 'fep'), size, rng)
+    return _quiet_cli(write_group_summary_tables.main, [os.path.join(workdir, 'fep'), '-e', 'csv'], workdir)
+
+
+# Each case takes the size, a scratch directory, the random number generator and the number of bootstrap samples, does
+# the setup that should not be timed and returns the function that is timed. The size is the number of ligands per map
+# or comparison, except for summarize_fep_error, where it is the number of maps.
+CASES = {'get_pairwise_diffs': _pairwise_diffs_case,
+         'bootstrap_pairwise_error': _bootstrap_pairwise_case,
+         'bootstrap_absolute_stats': _bootstrap_absolute_case,
+         'fast_stats.bootstrap_statistics': _fast_stats_case,
+         'parse_fep_data_from_csv': _parse_fep_csv_case,
+         'parse_experimental_data': _parse_experimental_case,
+         'summarize_fep_error': _summarize_case,
+         'process_fep_benchmark.py': _process_benchmark_case,
+         'write_group_summary_tables.py': _group_tables_case}
+
+
+def measure(func, repeats=3, min_time=1.):
+    """
+    Time a function and measure the peak memory that it allocates.
+
+    The wall time is the fastest of up to `repeats` runs, but a function that takes longer than min_time is only run
+    once. The peak memory is measured with tracemalloc in a separate run, so that tracing does not affect the timing.
+
+    Returns
+    -------
+    seconds: float
+        The wall time in seconds.
+    peak: int
+        The largest amount of memory allocated during the run, in bytes.
+    """
+    seconds = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        seconds = min(seconds, time.perf_counter() - start)
+        if seconds > min_time:
+            break
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def scaling_exponent(sizes, seconds, min_seconds=1e-3):
+    """
+    The exponent b of seconds ~ a * size^b, from a least squares fit in log space. Runs that are faster than
+    min_seconds are dominated by overheads and are left out, unless that leaves fewer than two runs.
+    """
+    sizes, seconds = np.asarray(sizes, dtype=float), np.asarray(seconds, dtype=float)
+    keep = seconds >= min_seconds
+    if np.sum(keep) < 2:
+        keep = np.isfinite(seconds)
+    if np.sum(keep) < 2:
+        return np.nan
+    return np.polyfit(np.log(sizes[keep]), np.log(seconds[keep]), 1)[0]
+
+
+def run_case(name, sizes, nboots=100, repeats=3, max_seconds=10., seed=0):
+    """
+    Run one case over increasing sizes. A size is skipped when extrapolating the previous runs with the exponent
+    measured so far (at least linear) predicts that it would take longer than max_seconds, so the quadratic functions
+    are not run at sizes where they would take minutes.
+
+    Returns
+    -------
+    records: list of dict
+        One record per size with the 'case', 'size', 'seconds', 'peak memory (MB)' and whether it was 'skipped'. The
+        seconds and memory of skipped sizes are None, which is null in the JSON file.
+    """
+    records = []
+    for size in sorted(sizes):
+        done = [r for r in records if not r['skipped']]
+        if len(done) > 0:
+            exponent = max(1., scaling_exponent([r['size'] for r in done], [r['seconds'] for r in done]))
+            if not np.isfinite(exponent):
+                exponent = 1.
+            predicted = done[-1]['seconds'] * (size / done[-1]['size']) ** exponent
+            if predicted > max_seconds:
+                records.append({'case': name, 'size': size, 'seconds': None, 'peak memory (MB)': None,
+                                'skipped': True})
+                continue
+        rng = np.random.default_rng(seed)
+        with tempfile.TemporaryDirectory() as workdir:
+            func = CASES[name](size, workdir, rng, nboots)
+            seconds, peak = measure(func, repeats)
+        records.append({'case': name, 'size': size, 'seconds': seconds, 'peak memory (MB)': peak / 2 ** 20,
+                        'skipped': False})
+    return records
+
+
+def environment():
+    """
+    The versions and machine that a benchmark was run with, so that results from different runs can be compared.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+            'commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def summarize(records):
+    """
+    Tabulate the timings with one row per case, one column per size and the scaling exponent of each case.
+    """
+    df = pd.DataFrame(records)
+    table = df.pivot(index='case', columns='size', values='seconds')
+    exponents = {case: scaling_exponent(g.loc[~g['skipped'], 'size'], g.loc[~g['skipped'], 'seconds'])
+                 for case, g in df.groupby('case')}
+    table['exponent'] = pd.Series(exponents)
+    return table.loc[[c for c in CASES if c in table.index]]
+
+
+def compare(records, reference_json):
+    """
+    The ratio of the times of this run to those of a previous run, for the cases and sizes that both runs completed.
+    """
+    with open(reference_json) as f:
+        reference = pd.DataFrame(json.load(f)['results'])
+    df = pd.DataFrame(records).merge(reference, on=['case', 'size'], suffixes=('', ' reference'))
+    df['ratio'] = df['seconds'] / df['seconds reference']
+    return df.pivot(index='case', columns='size', values='ratio')
+
+
+def main(argv=None):
+    description = """
+    Benchmark the analysis functions and scripts on synthetic maps and assay comparisons of increasing size. Each case
+    is timed and its peak memory measured at every size, and the exponent of the scaling of its time with size is
+    reported. Sizes that would take longer than --max-seconds are skipped. The results are written to a JSON file
+    (with the versions of the environment) and a CSV file, and can be compared with the JSON file of an earlier run.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-o', '--output', type=str, help="The JSON file of the results, default=benchmark.json. A CSV "
+                                                         "file with the same name is also written.",
+                        default='benchmark.json')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', help="The numbers of ligands per map, "
+                                                                   "default=10 to 10000.", default=DEFAULT_SIZES)
+    parser.add_argument('-c', '--cases', type=str, nargs='+', choices=list(CASES), help="The cases to run, "
+                                                                                        "default=all.", default=None)
+    parser.add_argument('-b', '--nboots', type=int, help="The number of bootstrap samples of the bootstrap cases, "
+                                                         "default=100.", default=100)
+    parser.add_argument('-r', '--repeats', type=int, help="The largest number of timed runs of each case and size, "
+                                                          "default=3.", default=3)
+    parser.add_argument('--max-seconds', type=float, help="Skip the sizes that are predicted to take longer than "
+                                                          "this, default=10.", default=10.)
+    parser.add_argument('--seed', type=int, help="The seed of the synthetic data, default=0.", default=0)
+    parser.add_argument('--compare', type=str, help="The JSON file of an earlier run to compare against.",
+                        default=None)
+    args = parser.parse_args(argv)
+
+    records = []
+    for name in args.cases or list(CASES):
+        print(f'Running {name}', file=sys.stderr)
+        records.extend(run_case(name, args.sizes, args.nboots, args.repeats, args.max_seconds, args.seed))
+
+    settings = {k: v for k, v in vars(args).items() if k not in ('output', 'compare')}
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'settings': settings, 'results': records}, f, indent=2, allow_nan=False)
+    pd.DataFrame(records).to_csv(os.path.splitext(args.output)[0] + '.csv', index=False)
+
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.float_format', '{:.4g}'.format):
+        print('Wall time (s) and scaling exponent')
+        print(summarize(records))
+        if args.compare is not None:
+            print()
+            print(f'Ratio of wall time to {args.compare}')
+            print(compare(records, args.compare))
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
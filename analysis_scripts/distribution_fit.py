@@ -0,0 +1,319 @@
+import numpy as np
+from scipy import optimize, stats
+
+# The models that are fitted to the error distributions and the names of their parameters.
+MODELS = {'normal': ('scale',), 't': ('scale', 'df')}
+
+# The bounds of the logarithm of every parameter. The upper bound of the degrees of freedom is high enough that the
+# likelihood of the t-distribution there is that of the normal to within rounding, which keeps the fits of normally
+# distributed data finite.
+LOG_BOUNDS = {'scale': (np.log(1e-3), np.log(1e3)), 'df': (np.log(1e-3), np.log(1e6))}
+
+
+def _log_bounds(model):
+    return np.array([LOG_BOUNDS[name] for name in MODELS[model]])
+
+
+def bin_differences(diffs, width=0.05, limit=10.):
+    """
+    Count the differences in bins of equal width on a grid that is symmetric about zero. The counts are sufficient
+    statistics for the binned likelihood, so every fit afterwards takes a time that depends on the number of bins and
+    not on the number of differences. Differences beyond the limit are counted in the outermost bins, which extend to
+    infinity in the likelihood.
+
+    Parameters
+    ----------
+    diffs: numpy.ndarray
+        The pairwise differences (in kcal/mol).
+    width: float
+        The width of the bins (in kcal/mol).
+    limit: float
+        The largest absolute difference of the grid (in kcal/mol).
+
+    Returns
+    -------
+    edges: numpy.ndarray
+        The edges of the bins, symmetric about zero.
+    counts: numpy.ndarray
+        The number of differences in each bin.
+    """
+    diffs = np.asarray(diffs, dtype=float)
+    nhalf = max(1, int(np.ceil(min(np.max(np.abs(diffs)), limit) / width)))
+    edges = np.arange(-nhalf, nhalf + 1) * width
+    inds = np.clip(np.floor(diffs / width).astype(int) + nhalf, 0, 2 * nhalf - 1)
+    return edges, np.bincount(inds, minlength=2 * nhalf)
+
+
+def symmetrize(counts):
+    """
+    Add the mirror image of the counts, which is the binned version of pooling both d and -d. The sign of a pairwise
+    difference only depends on the order of the pair, so the symmetric distribution is the one that is fitted.
+    """
+    return counts + counts[..., ::-1]
+
+
+def _cdf(model, edges, params):
+    params = np.asarray(params)[..., np.newaxis]
+    if model == 'normal':
+        return stats.norm.cdf(edges, scale=params[..., 0, :])
+    return stats.t.cdf(edges, df=params[..., 1, :], scale=params[..., 0, :])
+
+
+def bin_probabilities(model, edges, params):
+    """
+    The probability of each bin under a model centred on zero. The outermost bins extend to infinity so that the
+    probabilities sum to one. The parameters can have leading dimensions to evaluate many models at once.
+
+    As the models are symmetric, the probabilities of the bins above zero are taken from the lower tail, cdf(-x),
+    instead of as the difference of CDFs that are close to one, which would round the far bins to zero.
+    """
+    tail = _cdf(model, -np.abs(edges[1:-1]), params)
+    shape = tail.shape[:-1] + (1,)
+    return np.abs(np.diff(np.concatenate((np.zeros(shape), tail, np.zeros(shape)), axis=-1), axis=-1))
+
+
+def log_likelihood(model, edges, counts, params):
+    """
+    The multinomial log-likelihood of the bin counts, without the constant combinatorial term.
+    """
+    p = np.maximum(bin_probabilities(model, edges, params), 1e-300)
+    return np.sum(counts * np.log(p), axis=-1)
+
+
+def fit_model(model, edges, counts, x0=None):
+    """
+    Fit a model to binned differences by maximum likelihood. The parameters are optimized in log space to keep them
+    positive.
+
+    Parameters
+    ----------
+    model: str
+        Either 'normal' or 't'.
+    edges: numpy.ndarray
+        The edges of the bins.
+    counts: numpy.ndarray
+        The number of differences in each bin.
+    x0: numpy.ndarray
+        The starting parameters. By default, the scale starts at the standard deviation of the binned data, and the
+        t-distribution is fitted twice, from 5 degrees of freedom and from the fitted normal distribution at the upper
+        bound of the degrees of freedom, and the fit with the higher likelihood is kept. From 5 degrees of freedom
+        alone, the optimizer often stops short of the normal limit when the data are close to normal.
+
+    Returns
+    -------
+    params: numpy.ndarray
+        The fitted parameters, in the order of MODELS[model].
+    loglike: float
+        The maximum log-likelihood.
+    """
+    if x0 is None:
+        centers = (edges[1:] + edges[:-1]) / 2
+        sd = np.sqrt(np.sum(counts * centers ** 2) / np.sum(counts))
+        if model == 't':
+            normal = fit_model('normal', edges, counts)[0]
+            fits = [fit_model(model, edges, counts, np.array([sd, 5.])),
+                    fit_model(model, edges, counts, np.array([normal[0], np.exp(LOG_BOUNDS['df'][1])]))]
+            return max(fits, key=lambda fit: fit[1])
+        x0 = np.array([sd])
+
+    def objective(logx):
+        return -log_likelihood(model, edges, counts, np.exp(logx))
+
+    result = optimize.minimize(objective, np.log(x0), method='L-BFGS-B', bounds=_log_bounds(model),
+                               options={'ftol': 1e-14, 'gtol': 1e-8})
+    return np.exp(result.x), -result.fun
+
+
+def refine_fits(model, edges, counts, x0, iterations=20, step=1e-4):
+    """
+    Maximize the likelihood of many sets of bin counts at once with Newton's method in log space, using central
+    finite differences for the gradient and Hessian. Every iteration evaluates the CDFs of all sets together, which
+    makes this much faster than one optimization per set when the starting parameters are close to the optimum, as
+    they are for bootstrap samples started from the fit of the full data.
+
+    Parameters
+    ----------
+    model: str
+        Either 'normal' or 't'.
+    edges: numpy.ndarray
+        The edges of the bins.
+    counts: numpy.ndarray
+        The bin counts of each set, shape (nsets, nbins).
+    x0: numpy.ndarray
+        The starting parameters, which are shared by all sets.
+    iterations: int
+        The largest number of Newton iterations.
+    step: float
+        The finite difference step of the log parameters.
+
+    Returns
+    -------
+    params: numpy.ndarray
+        The fitted parameters of each set, shape (nsets, nparams).
+    """
+    k = len(MODELS[model])
+    logx = np.tile(np.log(x0), (len(counts), 1))
+    shifts = np.eye(k) * step
+    for _ in range(iterations):
+        def f(delta):
+            return log_likelihood(model, edges, counts, np.exp(logx + delta))
+        f0 = f(0.)
+        grad = np.empty((len(counts), k))
+        hess = np.empty((len(counts), k, k))
+        for i in range(k):
+            fp, fm = f(shifts[i]), f(-shifts[i])
+            grad[:, i] = (fp - fm) / (2 * step)
+            hess[:, i, i] = (fp - 2 * f0 + fm) / step ** 2
+            for j in range(i):
+                hess[:, i, j] = hess[:, j, i] = (f(shifts[i] + shifts[j]) - f(shifts[i] - shifts[j])
+                                                 - f(shifts[j] - shifts[i]) + f(-shifts[i] - shifts[j])) / (4 * step ** 2)
+        # Take a small gradient ascent step wherever the Hessian is not negative definite, such as where the degrees
+        # of freedom are so large that the likelihood no longer depends on them.
+        concave = np.all(np.linalg.eigvalsh(hess) < 0, axis=-1)
+        delta = 1e-3 * grad / np.maximum(np.abs(grad).max(axis=-1, keepdims=True), 1.)
+        delta[concave] = -np.linalg.solve(hess[concave], grad[concave][..., np.newaxis])[..., 0]
+        new = np.clip(logx + np.clip(delta, -0.5, 0.5), *_log_bounds(model).T)
+        converged = np.max(np.abs(new - logx)) < 1e-8
+        logx = new
+        if converged:
+            break
+    return np.exp(logx)
+
+
+def grid_counts(diffs, width=0.05, limit=10.):
+    """
+    Count the differences in the bins of bin_differences on the full grid out to the limit, whatever the largest
+    difference is. Counts on the full grid can be added together, e.g. over maps that are processed separately, and
+    trim_counts then gives the counts of bin_differences for all the differences at once.
+
+    Returns
+    -------
+    counts: numpy.ndarray
+        The number of differences in each of the 2 * ceil(limit / width) bins.
+    """
+    diffs = np.asarray(diffs, dtype=float)
+    nhalf = max(1, int(np.ceil(limit / width)))
+    inds = np.clip(np.floor(diffs / width).astype(int) + nhalf, 0, 2 * nhalf - 1)
+    return np.bincount(inds, minlength=2 * nhalf)
+
+
+def trim_counts(counts, max_abs, width=0.05, limit=10.):
+    """
+    Fold the counts of grid_counts into the grid that bin_differences makes for differences whose largest absolute
+    value is max_abs. The bins beyond the smaller grid are added to its outermost bins, as bin_differences clips them.
+
+    Returns
+    -------
+    edges: numpy.ndarray
+        The edges of the bins, symmetric about zero.
+    counts: numpy.ndarray
+        The number of differences in each bin.
+    """
+    full = len(counts) // 2
+    nhalf = max(1, int(np.ceil(min(max_abs, limit) / width)))
+    trimmed = np.array(counts[full - nhalf:full + nhalf])
+    trimmed[0] += np.sum(counts[:full - nhalf])
+    trimmed[-1] += np.sum(counts[full + nhalf:])
+    return np.arange(-nhalf, nhalf + 1) * width, trimmed
+
+
+def fit_distributions(diffs, width=0.05, limit=10., nboots=1000, seed=None):
+    """
+    Fit normal and Student-t distributions to pooled pairwise differences by binned maximum likelihood, with
+    bootstrap intervals of the parameters and a comparison of the goodness of fit.
+
+    Note
+    ----
+    The bootstrap samples are multinomial draws of the bin counts before they are symmetrized, which is the same as
+    resampling the differences and binning them. The differences of a map are not independent of one another, so the
+    intervals are narrower than the uncertainty of the underlying distribution.
+
+    Parameters
+    ----------
+    diffs: numpy.ndarray
+        The pairwise differences (in kcal/mol).
+    width: float
+        The width of the bins (in kcal/mol).
+    limit: float
+        The largest absolute difference of the grid (in kcal/mol).
+    nboots: int
+        The number of bootstrap samples.
+    seed: int
+        The seed of the random number generator.
+
+    Returns
+    -------
+    fits: dict
+        For each model, a dictionary with the fitted 'params', their 'lower' and 'upper' 95% bootstrap bounds, the
+        'loglike', 'aic', 'bic' and the Kolmogorov-Smirnov distance 'ks' between the binned and model CDFs. Under the
+        key 'comparison', the likelihood ratio statistic of t against normal and its p-value.
+    """
+    edges, raw = bin_differences(diffs, width, limit)
+    return fit_binned(edges, raw, nboots, seed)
+
+
+def fit_binned(edges, raw, nboots=1000, seed=None):
+    """
+    Fit the distributions of fit_distributions to differences that have already been counted in bins, e.g. by
+    bin_differences or trim_counts.
+
+    Parameters
+    ----------
+    edges: numpy.ndarray
+        The edges of the bins, symmetric about zero.
+    raw: numpy.ndarray
+        The number of differences in each bin, before they are symmetrized.
+    nboots: int
+        The number of bootstrap samples.
+    seed: int
+        The seed of the random number generator.
+
+    Returns
+    -------
+    fits: dict
+        As returned by fit_distributions.
+    """
+    # The mirrored counts have the same best fit as the raw counts under a model that is symmetric about zero, but
+    # they count every difference twice, so the likelihood and the number of differences are taken from the raw counts.
+    counts = symmetrize(raw)
+    total = np.sum(raw)
+    empirical_cdf = np.cumsum(counts)[:-1] / np.sum(counts)
+
+    rng = np.random.default_rng(seed)
+    boot_counts = symmetrize(rng.multinomial(np.sum(raw), raw / np.sum(raw), size=nboots))
+
+    fits = {}
+    for model, names in MODELS.items():
+        params = fit_model(model, edges, counts)[0]
+        loglike = log_likelihood(model, edges, raw, params)
+        boots = refine_fits(model, edges, boot_counts, params)
+        k = len(names)
+        fits[model] = {'names': names,
+                       'params': params,
+                       'lower': np.percentile(boots, 2.5, axis=0),
+                       'upper': np.percentile(boots, 97.5, axis=0),
+                       'loglike': loglike,
+                       'aic': 2 * k - 2 * loglike,
+                       'bic': k * np.log(total) - 2 * loglike,
+                       'ks': np.max(np.abs(empirical_cdf - _cdf(model, edges[1:-1], params)))}
+
+    # The normal distribution is the limit of the t-distribution as df goes to infinity, which is on the boundary of
+    # the parameter space, so the statistic follows an equal mixture of chi-squared distributions with 0 and 1 dof.
+    lr = max(0., 2 * (fits['t']['loglike'] - fits['normal']['loglike']))
+    fits['comparison'] = {'lr': lr, 'p': 0.5 * stats.chi2.sf(lr, 1)}
+    return fits
+
+
+def print_fits(fits):
+    """
+    Print the fitted parameters and goodness of fit from fit_distributions.
+    """
+    for model in MODELS:
+        f = fits[model]
+        params = ', '.join(f'{n} = {x:.3f} [{lo:.3f}, {hi:.3f}]'
+                           for n, x, lo, hi in zip(f['names'], f['params'], f['lower'], f['upper']))
+        print(f'{model}: {params}')
+        print(f'    log-likelihood = {f["loglike"]:.1f}, AIC = {f["aic"]:.1f}, BIC = {f["bic"]:.1f}, '
+              f'KS distance = {f["ks"]:.4f}')
+    c = fits['comparison']
+    print(f'Likelihood ratio of t against normal = {c["lr"]:.1f} (p = {c["p"]:.3g})')
@@ -0,0 +1,253 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import ligand_index as li
+import profiling as prof
+import structure_store as ss
+
+# The largest distance (in angstroms) between two atoms of the same element that are matched between the ligands of
+# an edge. The ligands of a map are aligned on their common core, so the core atoms are close to each other.
+MATCH_CUTOFF = 1.0
+
+# The exponent of the Gaussian of every heavy atom in the shape overlap, for a radius of 1.7 angstroms, and the
+# distance beyond which the overlap of two atoms is neglected.
+SHAPE_ALPHA = 0.836
+SHAPE_CUTOFF = 5.0
+
+
+class LigandCache:
+    """
+    The heavy atoms, KD-tree and shape self-overlap of the ligands of one map, calculated once for each ligand however
+    many edges it is in.
+    """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self._ligands = {}
+
+    def __getitem__(self, title):
+        if title not in self._ligands:
+            ligand = self.store.ligand(self.name, title)
+            heavy = np.asarray(ligand['atoms']['element']) != 'H'
+            xyz = np.asarray(ligand['coordinates'], dtype=float)[heavy]
+            tree = cKDTree(xyz)
+            self._ligands[title] = {'xyz': xyz, 'elements': np.asarray(ligand['atoms']['element'])[heavy],
+                                    'tree': tree, 'self overlap': shape_overlap(tree, tree)}
+        return self._ligands[title]
+
+
+def shape_overlap(tree1, tree2):
+    """
+    The overlap of the Gaussian volumes of the atoms of two ligands, up to a constant factor.
+    """
+    distances = tree1.sparse_distance_matrix(tree2, SHAPE_CUTOFF, output_type='ndarray')['v']
+    return np.sum(np.exp(-SHAPE_ALPHA / 2 * distances ** 2))
+
+
+def edge_features(ligand1, ligand2):
+    """
+    Compare the heavy atoms of the two ligands of an edge. Atoms are matched if they are each other's nearest neighbour
+    in the other ligand, are of the same element and are closer than MATCH_CUTOFF, which takes two KD-tree queries
+    instead of a maximum common substructure search.
+
+    Parameters
+    ----------
+    ligand1, ligand2: dict
+        The ligands, from LigandCache.
+
+    Returns
+    -------
+    features: dict
+        The 'matched atoms', the number of heavy atoms of either ligand that are not matched ('changed atoms'), the
+        RMSD of the matched atoms ('matched RMSD', in angstroms) and the Tanimoto of the shape overlap of the ligands
+        ('shape Tanimoto').
+    """
+    n1, n2 = len(ligand1['xyz']), len(ligand2['xyz'])
+    d12, j = ligand2['tree'].query(ligand1['xyz'], distance_upper_bound=MATCH_CUTOFF)
+    d21, i = ligand1['tree'].query(ligand2['xyz'], distance_upper_bound=MATCH_CUTOFF)
+    found = np.flatnonzero(j < n2)
+    mutual = found[i[j[found]] == found]
+    matched = mutual[ligand1['elements'][mutual] == ligand2['elements'][j[mutual]]]
+    nmatched = len(matched)
+
+    overlap = shape_overlap(ligand1['tree'], ligand2['tree'])
+    return {'heavy atoms 1': n1,
+            'heavy atoms 2': n2,
+            'matched atoms': nmatched,
+            'changed atoms': n1 + n2 - 2 * nmatched,
+            'matched RMSD': np.sqrt(np.mean(d12[matched] ** 2)) if nmatched > 0 else np.nan,
+            'shape Tanimoto': overlap / (ligand1['self overlap'] + ligand2['self overlap'] - overlap)}
+
+
+def map_edge_features(store, name):
+    """
+    Calculate the features of every edge of one map, from its *_edges.csv file in the structure inputs.
+
+    Returns
+    -------
+    features: pandas.DataFrame
+        One row per edge with the 'Group', 'Input name', 'Lig 1' and 'Lig 2' and the features of edge_features. Edges
+        with a ligand that is not in the SD file have no features.
+    """
+    group, input_name = name.split('/')
+    edges_csv = os.path.join(store.index['structure_dir'], group, f'{input_name}_edges.csv')
+    # The first two columns are the ligands, which are called 'Ligand 1' and 'Ligand 2' in all but one file.
+    edges = pd.read_csv(edges_csv, dtype=str)
+    titles = set(store.titles(name))
+    ligands = LigandCache(store, name)
+    rows = []
+    for lig1, lig2 in zip(edges.iloc[:, 0], edges.iloc[:, 1]):
+        row = {'Group': group, 'Input name': input_name, 'Lig 1': lig1, 'Lig 2': lig2}
+        if lig1 in titles and lig2 in titles:
+            row.update(edge_features(ligands[lig1], ligands[lig2]))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def _map_edge_features(args):
+    store_dir, name = args
+    return map_edge_features(ss.StructureStore(store_dir), name)
+
+
+def featurize(store_dir=ss.DEFAULT_STORE, nprocs=None):
+    """
+    Calculate the features of every edge of every map of the store, with the maps shared out over a pool of processes.
+    """
+    store = ss.StructureStore(store_dir)
+    names = [name for name in store.maps if os.path.isfile(
+        os.path.join(store.index['structure_dir'], f'{name.split("/")[0]}', f'{name.split("/")[1]}_edges.csv'))]
+    with ProcessPoolExecutor(max_workers=nprocs) as pool:
+        frames = list(pool.map(_map_edge_features, [(store_dir, name) for name in names]))
+    return pd.concat(frames, ignore_index=True)
+
+
+def match_maps(predictions, features, metadata):
+    """
+    Find the map of the structure inputs of every file of edge predictions. The files are not always named after the
+    output of their map (e.g. charge_annhil/cdk2_out has the edges of cdk2_pkacorr_out before the pKa correction), so
+    each file is matched to the input map of its group that has the most of its ligands, and ties are broken in favour
+    of the maps whose input or output name is the name of the file.
+
+    Returns
+    -------
+    inputs: dict
+        The input name of each (group, file name), for the files with a map that has at least half of their ligands.
+    """
+    outputs = dict(zip(zip(metadata['Group abbreviation'], metadata['Input file naming scheme']),
+                       metadata['Output file naming scheme']))
+    ligands = {key: set(df['Lig 1']) | set(df['Lig 2']) for key, df in features.groupby(['Group', 'Input name'])}
+    inputs = {}
+    for (group, name), df in predictions.groupby(['Group', 'Map']):
+        predicted = set(df['Lig 1']) | set(df['Lig 2'])
+        scores = [(len(predicted & ligs) / len(predicted), name in (f'{inp}_out', outputs.get((g, inp))), inp)
+                  for (g, inp), ligs in ligands.items() if g == group]
+        if len(scores) > 0 and max(scores)[0] >= 0.5:
+            inputs[(group, name)] = max(scores)[2]
+    return inputs
+
+
+def join_predictions(features, predictions_dir, metadata):
+    """
+    Join the features of every edge to its predicted and experimental relative binding free energies in the
+    edge_predictions CSV files, with the errors of the Bennett and cycle closure corrected predictions. Edges that are
+    in the opposite direction in the predictions are matched too, as the features do not depend on the direction.
+
+    Returns
+    -------
+    joined: pandas.DataFrame
+        One row per predicted edge with the 'Group', 'Map' (the name of the predictions file), the columns of the
+        predictions, the 'Input name' of the map of the structure inputs and the features.
+    """
+    frames = []
+    for path in sorted(glob(os.path.join(predictions_dir, '*', '*.csv'))):
+        df = pd.read_csv(path, dtype={'Lig 1': str, 'Lig 2': str, 'Ligand1': str, 'Ligand2': str})
+        df = df.rename(columns={'Ligand1': 'Lig 1', 'Ligand2': 'Lig 2'})
+        df.insert(0, 'Map', os.path.basename(path)[:-len('.csv')])
+        df.insert(0, 'Group', os.path.basename(os.path.dirname(path)))
+        frames.append(df)
+    predictions = pd.concat(frames, ignore_index=True)
+    for method in ('Bennett', 'CCC'):
+        predictions[f'{method} error (kcal/mol)'] = predictions[f'{method} ddG (kcal/mol)'] - \
+            predictions['Exp. ddG (kcal/mol)']
+
+    inputs = match_maps(predictions, features, metadata)
+    predictions['Input name'] = [inputs.get(key) for key in zip(predictions['Group'], predictions['Map'])]
+    reverse = features.rename(columns={'Lig 1': 'Lig 2', 'Lig 2': 'Lig 1', 'heavy atoms 1': 'heavy atoms 2',
+                                       'heavy atoms 2': 'heavy atoms 1'})
+    keys = ['Group', 'Input name', 'Lig 1', 'Lig 2']
+    features = pd.concat([features, reverse[features.columns]], ignore_index=True).drop_duplicates(keys)
+    return predictions.merge(features, on=keys, how='left')
+
+
+def main(argv=None):
+    usage = """
+    The script measures how large the perturbation of every edge of the structure inputs is: the number of heavy atoms
+    that change, the shape overlap of the two ligands and the RMSD of the atoms that they have in common. The features
+    are joined to the predictions of ../21_4_results/edge_predictions, so that the errors of the edges can be compared
+    with the size of their perturbations:
+
+        > python edge_features.py -o edge_features.csv
+
+    The structures are read from the store of structure_store.py, which is built first if it does not exist.
+    """
+    description = """
+    Calculate the structural features of the edges of the FEP+ benchmark.
+    """
+    parser = argparse.ArgumentParser(usage=usage, description=description)
+    parser.add_argument(
+        '--store',
+        type=str,
+        default=ss.DEFAULT_STORE,
+        help="The directory of the structure store, default=~/.cache/fep_benchmark/structure_store.")
+    parser.add_argument(
+        '-s',
+        '--structure_dir',
+        type=str,
+        default=li.STRUCTURE_INPUTS,
+        help="The directory of the structure inputs, used if the store has to be built, "
+             "default=../fep_benchmark_inputs/structure_inputs.")
+    parser.add_argument(
+        '-p',
+        '--predictions',
+        type=str,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '21_4_results', 'edge_predictions'),
+        help="The directory of the edge predictions, default=../21_4_results/edge_predictions.")
+    parser.add_argument(
+        '-m',
+        '--metadata',
+        type=str,
+        default=li.DEFAULT_METADATA,
+        help="The CSV file with the output metadata, default=../21_4_results/benchmark_output_metadata.csv.")
+    parser.add_argument(
+        '-o',
+        '--output',
+        type=str,
+        default='edge_features.csv',
+        help="The CSV file of the predictions and features, default=edge_features.csv.")
+    parser.add_argument('-j', dest='nprocs', type=int, help="The number of maps to featurize in parallel, "
+                                                            "default=number of CPUs.", default=os.cpu_count())
+    prof.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+    prof.setup(args)
+
+    if not os.path.isfile(os.path.join(args.store, 'index.json')):
+        with prof.stage('store'):
+            ss.build_store(args.structure_dir, args.store)
+    with prof.stage('features'):
+        features = featurize(args.store, args.nprocs)
+    with prof.stage('join'):
+        joined = join_predictions(features, args.predictions, pd.read_csv(args.metadata))
+    joined.to_csv(args.output, index=False, float_format='%.3f')
+    print(f'Features of {len(features)} edges, {joined["matched atoms"].notna().sum()} of {len(joined)} predicted '
+          f'edges matched, written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+import numpy as np
+from scipy import stats
+
+# The largest number of elements of the (nboots, n, n) arrays that are made at once for Kendall's tau.
+MAX_PAIR_ELEMENTS = 2 ** 25
+# Above this many data points, scipy's O(n log n) algorithm applied to each sample is faster than the sign matrices.
+MAX_SIGN_MATRIX_SIZE = 150
+
+
+def bootstrap_indices(n, nboots, rng=None):
+    """
+    Draw the indices of all bootstrap samples at once.
+
+    Parameters
+    ----------
+    n: int
+        The number of data points.
+    nboots: int
+        The number of bootstrap samples.
+    rng: numpy.random.Generator
+        The random number generator. If None, numpy's global random state is used, as with np.random.choice.
+
+    Returns
+    -------
+    inds: numpy.ndarray
+        An integer array of shape (nboots, n).
+    """
+    if rng is None:
+        return np.random.choice(n, (nboots, n))
+    return rng.integers(0, n, size=(nboots, n))
+
+
+def pairwise_rmse(x, y):
+    """
+    The root-mean-square of the pairwise errors (y_i - y_j) - (x_i - x_j) over all pairs i < j of each row.
+
+    Note
+    ----
+    With e = y - x, the sum of (e_i - e_j)^2 over the n(n-1)/2 pairs is n times the sum of (e_i - mean(e))^2, so the
+    pairwise RMSE is sqrt(2 var(e)) with n - 1 degrees of freedom and the pairs are never formed. Repeated indices of a
+    bootstrap sample contribute pairs with zero error, as they do in helper_functions.get_pairwise_diffs.
+
+    Parameters
+    ----------
+    x: numpy.ndarray
+        The first data series, shape (n,) or (nsamples, n).
+    y: numpy.ndarray
+        The second data series, with the same shape as x.
+    """
+    return np.sqrt(2 * np.var(np.asarray(y) - np.asarray(x), axis=-1, ddof=1))
+
+
+def pairwise_mue(x, y):
+    """
+    The mean absolute pairwise error over all pairs i < j of each row. With e sorted in ascending order, the sum of
+    |e_i - e_j| over all pairs is the sum of (2k - n + 1) e_k.
+
+    Parameters
+    ----------
+    x: numpy.ndarray
+        The first data series, shape (n,) or (nsamples, n).
+    y: numpy.ndarray
+        The second data series, with the same shape as x.
+    """
+    e = np.sort(np.asarray(y) - np.asarray(x), axis=-1)
+    n = e.shape[-1]
+    coeffs = 2 * np.arange(n) - n + 1
+    return np.sum(coeffs * e, axis=-1) / (n * (n - 1) / 2)
+
+
+def absolute_rmse(x, y):
+    return np.sqrt(np.mean((np.asarray(y) - np.asarray(x)) ** 2, axis=-1))
+
+
+def absolute_mue(x, y):
+    return np.mean(np.abs(np.asarray(y) - np.asarray(x)), axis=-1)
+
+
+def r_squared(x, y):
+    """
+    The square of the Pearson correlation coefficient of each row.
+    """
+    x = np.asarray(x) - np.mean(x, axis=-1, keepdims=True)
+    y = np.asarray(y) - np.mean(y, axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(x * y, axis=-1) ** 2 / (np.sum(x ** 2, axis=-1) * np.sum(y ** 2, axis=-1))
+
+
+def kendall_tau(x, y):
+    """
+    Kendall's tau-b of each row, as calculated by scipy.stats.kendalltau, with all rows of up to MAX_SIGN_MATRIX_SIZE
+    points evaluated together. Pairs that are tied in x or y are left out of the respective normalization, which also
+    handles the repeated indices of bootstrap samples.
+
+    Parameters
+    ----------
+    x: numpy.ndarray
+        The first data series, shape (n,) or (nsamples, n).
+    y: numpy.ndarray
+        The second data series, with the same shape as x.
+    """
+    single = np.ndim(x) == 1
+    x = np.atleast_2d(x)
+    y = np.atleast_2d(y)
+    nsamples, n = x.shape
+    if n > MAX_SIGN_MATRIX_SIZE:
+        taus = np.array([stats.kendalltau(xs, ys).correlation for xs, ys in zip(x, y)])
+        return taus[0] if single else taus
+    chunk = max(1, MAX_PAIR_ELEMENTS // (n * n))
+    taus = np.empty(nsamples)
+    for start in range(0, nsamples, chunk):
+        xs, ys = x[start:start + chunk], y[start:start + chunk]
+        sx = np.sign(xs[:, :, np.newaxis] - xs[:, np.newaxis, :])
+        sy = np.sign(ys[:, :, np.newaxis] - ys[:, np.newaxis, :])
+        # Each pair appears twice in the full matrices, which cancels in the ratio.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            taus[start:start + chunk] = np.sum(sx * sy, axis=(1, 2)) / np.sqrt(
+                np.sum(sx ** 2, axis=(1, 2)) * np.sum(sy ** 2, axis=(1, 2)))
+    return taus[0] if single else taus
+
+
+STATISTICS = {'Pairwise RMSE': pairwise_rmse,
+              'Pairwise MUE': pairwise_mue,
+              'Absolute RMSE': absolute_rmse,
+              'Absolute MUE': absolute_mue,
+              'R-squared': r_squared,
+              'Kendall tau': kendall_tau}
+
+
+def bootstrap_statistics(x, y, nboots=5000, rng=None, statistics=None):
+    """
+    Calculate the statistics of two data series and their bootstrap samples. The indices of all the samples are drawn
+    at once and every statistic is evaluated on all samples together.
+
+    Parameters
+    ----------
+    x: list-like of floats
+        The data series for one variable.
+    y: List-like of floats
+        The data series for the second variable.
+    nboots: int
+        The number of bootstrap samples.
+    rng: numpy.random.Generator
+        The random number generator. If None, numpy's global random state is used.
+    statistics: list-like of str
+        The names of the statistics to calculate from STATISTICS, default=all.
+
+    Returns
+    -------
+    values: dict
+        The value of each statistic.
+    samples: dict
+        The bootstrap samples of each statistic.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if statistics is None:
+        statistics = list(STATISTICS)
+    inds = bootstrap_indices(len(x), nboots, rng)
+    xb, yb = x[inds], y[inds]
+    values = {s: float(STATISTICS[s](x, y)) for s in statistics}
+    samples = {s: STATISTICS[s](xb, yb) for s in statistics}
+    return values, samples
+
+
+def interval(samples, lower=2.5, upper=97.5):
+    """
+    The percentile interval of bootstrap samples, ignoring undefined samples.
+    """
+    return np.nanpercentile(samples, lower), np.nanpercentile(samples, upper)
+
+
+def bootstrap_weighted(num, values, nboots=10000, rng=None, rms=False):
+    """
+    Bootstrap samples of the weighted mean (or weighted root-mean-square) of per-map values, with all samples drawn
+    at once. With rng=None, the samples are drawn from numpy's global random state in the same order as
+    analysis_functions.get_bootstrap_weighted_value and get_bootstrap_weighted_rmsd.
+
+    Parameters
+    ----------
+    num: numpy.ndarray
+        The weight of each value, e.g. the number of compounds of each map.
+    values: numpy.ndarray
+        The value of each map.
+    nboots: int
+        The number of bootstrap samples.
+    rng: numpy.random.Generator
+        The random number generator. If None, numpy's global random state is used.
+    rms: bool
+        Whether to calculate the weighted root-mean-square instead of the weighted mean.
+
+    Returns
+    -------
+    samples: numpy.ndarray
+        The bootstrap samples.
+    """
+    num = np.asarray(num, dtype=float)
+    values = np.asarray(values, dtype=float)
+    inds = bootstrap_indices(len(values), nboots, rng)
+    w, v = num[inds], values[inds]
+    if rms:
+        return np.sqrt(np.sum(w * v ** 2, axis=1) / np.sum(w, axis=1))
+    return np.sum(w * v, axis=1) / np.sum(w, axis=1)
+
+
+def summarize_fep_error(results, nboots=10000, rng=None):
+    """
+    The weighted statistics of a benchmark and their 95% bootstrap intervals, as returned by
+    analysis_functions.summarize_fep_error with verbose=False. The statistics are bootstrapped in the same order, so with
+    rng=None and the same seed of numpy's global random state the intervals are the same.
+
+    Parameters
+    ----------
+    results: dict of numpy.array
+        Each key is a error metric that points to an array of these metrics for each map in the benchmark set.
+    nboots: int
+        The number of bootstrap samples.
+    rng: numpy.random.Generator
+        The random number generator. If None, numpy's global random state is used.
+
+    Returns
+    -------
+    statistics: tuple of tuples
+        The (value, lower, upper) of the pairwise RMSE, pairwise MUE, edgewise RMSE and MUE (if the results have
+        edges), R-squared and Kendall tau.
+    """
+    def summarize(num, key, rms):
+        num, values = np.asarray(num, dtype=float), np.asarray(results[key], dtype=float)
+        samples = bootstrap_weighted(num, values, nboots, rng, rms)
+        value = np.sqrt(np.sum(num * values ** 2) / np.sum(num)) if rms else np.sum(num * values) / np.sum(num)
+        return value, np.percentile(samples, 2.5), np.percentile(samples, 97.5)
+
+    num_comps = results['number of compounds']
+    pair = summarize(num_comps, 'Pairwise RMSE', True)
+    pair_mue = summarize(num_comps, 'Pairwise MUE', False)
+    r2 = summarize(num_comps, 'R-squared', False)
+    tau = summarize(num_comps, 'Kendall tau', False)
+    if all(k in results for k in ('number of edges', 'Edgewise RMSE', 'Edgewise MUE')):
+        edge = summarize(results['number of edges'], 'Edgewise RMSE', True)
+        edge_mue = summarize(results['number of edges'], 'Edgewise MUE', False)
+        return pair, pair_mue, edge, edge_mue, r2, tau
+    return pair, pair_mue, r2, tau
@@ -0,0 +1,246 @@
+import argparse
+import importlib
+import os
+
+import numpy as np
+import pandas as pd
+
+import analysis_functions as af
+import generate_boxplots_and_histograms as gbh
+import incremental as inc
+import print_latex_tables as latex
+import process_fep_benchmark as pfb
+import profiling as prof
+import results_table as rt
+import write_group_summary_tables as wgst
+
+OUTPUTS = ['summary', 'tables', 'latex', 'plots']
+
+
+class BenchmarkSession:
+    """
+    The FEP+ benchmark results of a directory of groups, read once and kept in memory. The per-map metrics, pairwise
+    errors and (for FMP files) the uncertainties of every map are parsed when the session is created, and the weighted
+    summaries are calculated once on first use, so that any number of outputs can be made from a single pass over the
+    files.
+    """
+
+    def __init__(self, upper_dir, ext, seed=None):
+        """
+        Parameters
+        ----------
+        upper_dir: str
+            The upper directory with a subdirectory of FMP or CSV files for each group.
+        ext: str
+            The file extension of the results, 'fmp' or 'csv'.
+        seed: int
+            The seed of numpy's random state before bootstrapping each summary. If None, the random state is not
+            seeded.
+        """
+        if ext == 'fmp':
+            if importlib.util.find_spec('schrodinger') is None:
+                raise Exception('Schrodinger must be installed to use FMP files as input. Use CSV files instead.')
+        elif ext != 'csv':
+            raise Exception(f'Only "fmp" and "csv" are accessible file extenstions. You have entered {ext}.')
+        self.upper_dir = upper_dir
+        self.ext = ext
+        self.seed = seed
+        self.maps = {}
+        for group, files in inc.find_group_files(upper_dir, ext).items():
+            if len(files) > 0:
+                self.maps[group] = [self._parse(f) for f in files]
+        if len(self.maps) == 0:
+            raise Exception(f'No FEP results files found in the subdirectories of {upper_dir}. '
+                            f'Check the directory name and its contents.')
+        self.table = rt.ResultsTable.from_records([m['metrics'] for g in self.maps.values() for m in g],
+                                                  [g for g, maps in self.maps.items() for m in maps])
+        self._summaries = {}
+
+    def _parse(self, name):
+        if self.ext == 'fmp':
+            metrics, diffs, uncertainties = af.parse_fep_map(name)
+        else:
+            metrics, diffs = af.parse_fep_csv(name)
+            uncertainties = None
+        return {'metrics': metrics, 'diffs': diffs, 'uncertainties': uncertainties}
+
+    @property
+    def edges(self):
+        return self.ext == 'fmp'
+
+    def results(self, group=None):
+        """
+        The per-map metrics of one group, or of all the groups, in the format of analysis_functions.parse_fep_data. The
+        table of a group shares its data with the table of all the groups, so a copy is made before it is changed.
+        """
+        if group is None:
+            return self.table
+        return self.table.group(group)
+
+    def diffs(self, group=None):
+        """
+        The pairwise errors of every map of one group, or of all the groups.
+        """
+        maps = self.maps[group] if group is not None else [m for g in self.maps.values() for m in g]
+        return np.concatenate([np.asarray(m['diffs'], dtype=float) for m in maps])
+
+    def summary(self, group=None):
+        """
+        The weighted statistics of one group, or of the whole benchmark with the thrombin overlap correction, from
+        analysis_functions.summarize_fep_error.
+        """
+        if group not in self._summaries:
+            results = self.results(group)
+            if group is None:
+                results = rt.ResultsTable(results.data.copy(), results.groups)
+                pfb.correct_thrombin_overlap(results)
+            if self.seed is not None:
+                np.random.seed(self.seed)
+            self._summaries[group] = af.summarize_fep_error(results, verbose=False)
+        return self._summaries[group]
+
+    def print_summary(self):
+        print('FEP+ benchmark summary')
+        print('-----------------------')
+        inc.print_summary(self.summary())
+        print()
+
+    def write_tables(self, outdir='.'):
+        """
+        Write the per-map results of each group and the summary of every group to CSV files, as
+        write_group_summary_tables.py does.
+        """
+        os.makedirs(outdir, exist_ok=True)
+        group_summaries = []
+        for group in self.maps:
+            results = self.results(group)
+            pd.DataFrame(results).to_csv(os.path.join(outdir, f'{group}_results.csv'), index=False,
+                                         float_format='%.2f')
+            summary = [group, results['number of compounds'].sum()]
+            if self.edges:
+                summary.append(results['number of edges'].sum())
+            group_summaries.append(summary + [self.summary(group)])
+        df = wgst.summary_table(group_summaries, self.edges)
+        df.to_csv(os.path.join(outdir, 'group_summaries.csv'), index=False, float_format='%.2f')
+
+    def print_latex_tables(self, metadata=None):
+        """
+        Print the latex table of each group, as print_latex_tables.py does. Requires FMP files.
+        """
+        if not self.edges:
+            raise Exception('The latex tables need the uncertainties of the FMP files. Use FMP files instead.')
+        df_meta = pd.read_csv(metadata) if metadata is not None else None
+        for group, maps in self.maps.items():
+            if group in latex.SKIPPED_GROUPS:
+                continue
+            print(group)
+            out2pdb = out2protein = None
+            if df_meta is not None:
+                out2pdb, out2protein = latex.metadata_names(df_meta, group)
+            print(af.format_latex_table([(m['metrics'], m['uncertainties']) for m in maps], out2pdb, out2protein))
+            print()
+            print()
+
+    def plot_boxplots_and_histograms(self, exp_files, outname):
+        """
+        Print the error distribution statistics and plot the boxplots and histograms of the experimental survey and
+        the benchmark, as generate_boxplots_and_histograms.py does.
+        """
+        exp_results, exp_diffs = af.parse_experimental_data(exp_files, gbh.NOTLIST)
+        print('Experimental pairwise error distribution stats:')
+        print('----------------------------------------------')
+        gbh._summarize_differences_stats(exp_results, exp_diffs)
+
+        fep_results, fep_diffs = self.results(), self.diffs()
+        print()
+        print('FEP pairwise error distribution stats:')
+        print('--------------------------------------')
+        gbh._summarize_differences_stats(fep_results, fep_diffs)
+        gbh.plot_boxplots_and_histograms(exp_results, exp_diffs, fep_results, fep_diffs, outname)
+
+
+def main(argv=None):
+    usage = """
+    The script reads the FMP or CSV files of the benchmark once and makes any combination of the outputs of
+    process_fep_benchmark.py (summary), write_group_summary_tables.py (tables), print_latex_tables.py (latex) and
+    generate_boxplots_and_histograms.py (plots) from them. For example, all the outputs for the FMP files in this
+    repository are made with
+
+        > $SCHRODINGER/run python3 fep_benchmark.py ../21_4_results/processed_output_fmps -e fmp summary tables latex plots -m ../21_4_results/benchmark_output_metadata.csv --exp_files ../experimental_survey_data/*/*csv
+
+    and the summary and tables from the CSV files with
+
+        > python fep_benchmark.py ../21_4_results/ligand_predictions -e csv summary tables
+    """
+    description = """
+    Make the summary, group tables, latex tables and plots of the FEP+ benchmark from a single reading of the results.
+    """
+    parser = argparse.ArgumentParser(usage=usage, description=description)
+    parser.add_argument(
+        'upper_dir',
+        type=str,
+        help="The upper directory where all the results are contained. Each group is expected to be a subdirectory "
+             "of 'upper-dir' and each subdirectory should contain either FMP or CSV files.")
+    parser.add_argument(
+        'outputs',
+        type=str,
+        nargs='+',
+        choices=OUTPUTS,
+        help="The outputs to make: the overall summary, the group tables, the latex tables (FMP files only) and the "
+             "boxplots and histograms (which need --exp_files).")
+    parser.add_argument(
+        '-e',
+        '--ext',
+        type=str,
+        choices=['fmp', 'csv'],
+        help="The file extension of the results. Results can be either FMP files or CSVs.")
+    parser.add_argument(
+        '-o',
+        '--outdir',
+        type=str,
+        default='.',
+        help="The directory of the group tables, default=working directory.")
+    parser.add_argument(
+        '-m',
+        '--metadata',
+        type=str,
+        help="The CSV file with the output metadata for the latex tables, default=None")
+    parser.add_argument(
+        '--exp_files',
+        type=str,
+        nargs='+',
+        help="A list of CSV files that contain experimental data comparisons, for the plots.")
+    parser.add_argument(
+        '--plot_name',
+        type=str,
+        default='boxplots_and_histograms.png',
+        help="The name of the png file of the plots, default=boxplots_and_histograms.png.")
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help="The seed of numpy's random state before bootstrapping each summary.")
+    prof.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+    prof.setup(args)
+
+    if 'plots' in args.outputs and args.exp_files is None:
+        parser.error('the plots need the experimental data, which is given with --exp_files')
+
+    with prof.stage('load'):
+        session = BenchmarkSession(args.upper_dir, args.ext, args.seed)
+    if 'summary' in args.outputs:
+        with prof.stage('summary'):
+            session.print_summary()
+    if 'tables' in args.outputs:
+        with prof.stage('tables'):
+            session.write_tables(args.outdir)
+    if 'latex' in args.outputs:
+        with prof.stage('latex'):
+            session.print_latex_tables(args.metadata)
+    if 'plots' in args.outputs:
+        with prof.stage('plots'):
+            session.plot_boxplots_and_histograms(args.exp_files, args.plot_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,24 @@
 import analysis_functions as af
+import distribution_fit as dfit
 import importlib
+import profiling as prof
 import matplotlib.pylab as plt
 import numpy as np
-from scipy import stats
 import argparse
 from glob import glob
 import os
 
+# Excluding these experimental comparisons as they are comparing assays that are too similiar.
+NOTLIST = ['bocquet2015_spr_detergent_nanoc9',
+           'bocquet2015_spr_detergent_nanohis',
+           'bocquet2015_spr_nanoC9_nanohis',
+           'jia2006_cot_inhibition',
+           'patil2018_ic50_spr',
+           'moonshot2020_covid_protease_inhibition',
+           'ycas2020_bptf_spr_labeled_spr',
+           'murphy2006_binding']
+
+
 def _summarize_differences_stats(results, diffs):
     """
     Print a summary of the statistics of the supplied array - which is assumed to be a set of differences. Nothing is
@@ -24,119 +36,31 @@ def _summarize_differences_stats(results, diffs):
     """
     af.error_diff_stats(diffs)
     print()
-    print('The Shapiro-Wilk test tests for the null hypothesis that the differences are drawn from a normal distribution:')
-    print(stats.shapiro(diffs))
+    print('Normal and t-distributions fitted to the symmetrized differences by binned maximum likelihood:')
+    dfit.print_fits(dfit.fit_distributions(diffs, seed=0))
     print()
     print('Median pairwise RMSE from assays: {:.2f} kcal/mol'.format(np.percentile(results['Pairwise RMSE'],50)))
     print()
 
 
-def main(argv=None):
-    usage = """
-        As input, this script takes the experimental survey and the FEP benchmark data as input. The FEP data can be in
-        CSV format (e.g from ../21_4_results/ligand_predictions) or as FMP format (e.g. from 
-        ../21_4_results/processed_output_fmps). The FMP or CSV files must be grouped in subdirectories of the input 
-        leading directory. 
-        
-        The plot that was used in the publication using the output FEP+ FMP files was created using 
-        
-            > $SCHRODINGER/run python3 generate_boxplots_and_histograms.py --fep_dir ../21_4_results/processed_output_fmps -e fmp --exp_files ../experimental_survey_data/*/*csv -o scatterplot_exp_fep.png
-        
-        Alternatively, the CSV output files can also be be processed by this script. 
-        
-            > python generate_boxplots_and_histograms.py --fep_dir ../21_4_results/ligand_predictions/ -e csv --exp_files ../experimental_survey_data/*/*csv -o scatterplot_exp_fep_from_csv.png
-        """
-    description = """
-        The left panel shows boxplots comparing the root-mean-square error (RMSE) between relative binding free energies
-        from different experimental assays (left) and the FEP+ predictions against experimental data (right). The size 
-        of each data point is proportional to the number of ligands in the series in either an assay comparison or 
-        perturbation graph. The two largest data points in the experimental survey are from the COVID moonshot project 
-        and project A from table S4. The median RMSE in the experimental survey is 0.85 kcal/mol and the median in the 
-        FEP+ benchmark is 1.08 kcal/mol. The right plot shows the all pairwise relative binding free energy differences 
-        from the experimental survey and all pairwise FEP+ errors. The error distributions are bell-shaped and can be 
-        approximated by t-distributions.
-        """
-    parser = argparse.ArgumentParser(usage=usage, description=description)
-    parser.add_argument(
-        '--fep_dir',
-        type=str,
-        help="The upper directory that contains all of the FMP or CSV outputs files in subdirectories.")
-    parser.add_argument(
-        '-e',
-        '--ext',
-        type=str,
-        choices=['fmp', 'csv'],
-        help="The file extension of the FEP results. Results can be either FMP files or CSVs.")
-    parser.add_argument(
-        '--exp_files',
-        type=str,
-        nargs='+',
-        help="A list of CSV files that contain experimental data comparisons.")
-    parser.add_argument(
-        '-o',
-        '--outname',
-        type=str,
-        help="The name of the png file that is produced.")
-
-
-    args = parser.parse_args(argv)
-
-    if args.ext == 'fmp':
-        if importlib.util.find_spec('schrodinger') is None:
-            raise Exception('Schrodinger must be installed to use FMP files as input. Use CSV files instead.')
-
-    ##################################
-    ### Load the experimental data ###
-    ##################################
-
-    # Excluding these experimental comparisons as they are comparing assays that are too similiar.
-    notlist = ['bocquet2015_spr_detergent_nanoc9',
-               'bocquet2015_spr_detergent_nanohis',
-               'bocquet2015_spr_nanoC9_nanohis',
-               'jia2006_cot_inhibition',
-               'patil2018_ic50_spr',
-               'moonshot2020_covid_protease_inhibition',
-               'ycas2020_bptf_spr_labeled_spr',
-               'murphy2006_binding']
-
-    exp_results, exp_diffs = af.parse_experimental_data(args.exp_files, notlist)
-
-    print('Experimental pairwise error distribution stats:')
-    print('----------------------------------------------')
-    _summarize_differences_stats(exp_results, exp_diffs)
-
-    ##################################
-    ######## Load the FEP data #######
-    ##################################
-
-    files = []
-    for entry in glob(f'{args.fep_dir}/*'):
-        if os.path.isdir(entry):
-            files.extend(glob(f'{entry}/*{args.ext}'))
-
-    if len(files) == 0:
-        raise Exception(f'No FEP results files found in the subdirectories of {args.fep_dir}. '
-                        f'Check the directory name and its contents.')
-
-    extensions = [f.split('.')[-1] for f in files]
-    if all([e == 'csv' for e in extensions]):
-        fep_results, fep_diffs = af.parse_fep_data_from_csv(files)
-    elif all([e == 'fmp' for e in extensions]):
-        fep_results, fep_diffs  = af.parse_fep_data(files)
-
-    else:
-        raise Exception(f'The supplied files must all be FMP files or CSV files. The following file extensions have '
-                        f'been supplied: {set(extensions)}')
-
-    print()
-    print('FEP pairwise error distribution stats:')
-    print('--------------------------------------')
-    _summarize_differences_stats(fep_results, fep_diffs)
-
-    ##################################
-    ########## The plotting ##########
-    ##################################
+def plot_boxplots_and_histograms(exp_results, exp_diffs, fep_results, fep_diffs, outname):
+    """
+    Plot the boxplots of the pairwise RMSEs and the histograms of the pairwise errors of the experimental survey and
+    the FEP+ benchmark side by side, and save the figure.
 
+    Parameters
+    ----------
+    exp_results: dict
+        The output from analysis_functions.parse_experimental_data.
+    exp_diffs: numpy.ndarray
+        The pairwise differences between the experimental measurements.
+    fep_results: dict
+        The output from analysis_functions.parse_fep_data or analysis_functions.parse_fep_data_from_csv.
+    fep_diffs: numpy.ndarray
+        The pairwise errors of the FEP+ predictions.
+    outname: str
+        The name of the png file that is produced.
+    """
     def num2sizes(number_in_set):
         return number_in_set * 5 + 20
 
@@ -234,7 +158,105 @@ def main(argv=None):
     ax.set_ylabel('Scaled density', fontsize=16)
 
     plt.tight_layout()
-    plt.savefig(args.outname, dpi=200)
+    plt.savefig(outname, dpi=200)
+
+
+def main(argv=None):
+    usage = """
+        As input, this script takes the experimental survey and the FEP benchmark data as input. The FEP data can be in
+        CSV format (e.g from ../21_4_results/ligand_predictions) or as FMP format (e.g. from 
+        ../21_4_results/processed_output_fmps). The FMP or CSV files must be grouped in subdirectories of the input 
+        leading directory. 
+        
+        The plot that was used in the publication using the output FEP+ FMP files was created using 
+        
+            > $SCHRODINGER/run python3 generate_boxplots_and_histograms.py --fep_dir ../21_4_results/processed_output_fmps -e fmp --exp_files ../experimental_survey_data/*/*csv -o scatterplot_exp_fep.png
+        
+        Alternatively, the CSV output files can also be be processed by this script. 
+        
+            > python generate_boxplots_and_histograms.py --fep_dir ../21_4_results/ligand_predictions/ -e csv --exp_files ../experimental_survey_data/*/*csv -o scatterplot_exp_fep_from_csv.png
+        """
+    description = """
+        The left panel shows boxplots comparing the root-mean-square error (RMSE) between relative binding free energies
+        from different experimental assays (left) and the FEP+ predictions against experimental data (right). The size 
+        of each data point is proportional to the number of ligands in the series in either an assay comparison or 
+        perturbation graph. The two largest data points in the experimental survey are from the COVID moonshot project 
+        and project A from table S4. The median RMSE in the experimental survey is 0.85 kcal/mol and the median in the 
+        FEP+ benchmark is 1.08 kcal/mol. The right plot shows the all pairwise relative binding free energy differences 
+        from the experimental survey and all pairwise FEP+ errors. The error distributions are bell-shaped and can be 
+        approximated by t-distributions.
+        """
+    parser = argparse.ArgumentParser(usage=usage, description=description)
+    parser.add_argument(
+        '--fep_dir',
+        type=str,
+        help="The upper directory that contains all of the FMP or CSV outputs files in subdirectories.")
+    parser.add_argument(
+        '-e',
+        '--ext',
+        type=str,
+        choices=['fmp', 'csv'],
+        help="The file extension of the FEP results. Results can be either FMP files or CSVs.")
+    parser.add_argument(
+        '--exp_files',
+        type=str,
+        nargs='+',
+        help="A list of CSV files that contain experimental data comparisons.")
+    parser.add_argument(
+        '-o',
+        '--outname',
+        type=str,
+        help="The name of the png file that is produced.")
+
+
+    prof.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+    prof.setup(args)
+
+    if args.ext == 'fmp':
+        if importlib.util.find_spec('schrodinger') is None:
+            raise Exception('Schrodinger must be installed to use FMP files as input. Use CSV files instead.')
+
+    ##################################
+    ### Load the experimental data ###
+    ##################################
+
+    exp_results, exp_diffs = af.parse_experimental_data(args.exp_files, NOTLIST)
+
+    print('Experimental pairwise error distribution stats:')
+    print('----------------------------------------------')
+    _summarize_differences_stats(exp_results, exp_diffs)
+
+    ##################################
+    ######## Load the FEP data #######
+    ##################################
+
+    files = []
+    for entry in glob(f'{args.fep_dir}/*'):
+        if os.path.isdir(entry):
+            files.extend(glob(f'{entry}/*{args.ext}'))
+
+    if len(files) == 0:
+        raise Exception(f'No FEP results files found in the subdirectories of {args.fep_dir}. '
+                        f'Check the directory name and its contents.')
+
+    extensions = [f.split('.')[-1] for f in files]
+    if all([e == 'csv' for e in extensions]):
+        fep_results, fep_diffs = af.parse_fep_data_from_csv(files)
+    elif all([e == 'fmp' for e in extensions]):
+        fep_results, fep_diffs  = af.parse_fep_data(files)
+
+    else:
+        raise Exception(f'The supplied files must all be FMP files or CSV files. The following file extensions have '
+                        f'been supplied: {set(extensions)}')
+
+    print()
+    print('FEP pairwise error distribution stats:')
+    print('--------------------------------------')
+    _summarize_differences_stats(fep_results, fep_diffs)
+
+    plot_boxplots_and_histograms(exp_results, exp_diffs, fep_results, fep_diffs, args.outname)
+
 
 if __name__== '__main__':
     main()
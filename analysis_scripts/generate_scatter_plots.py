@@ -2,7 +2,9 @@ import numpy as np
 import pandas as pd
 import argparse
 
+import fast_stats as fs
 import helper_functions as hf
+import profiling as prof
 import matplotlib.pylab as plt
 
 # Scatter plot parameters
@@ -13,10 +15,38 @@ FMT = 'o'
 ZORDER = 2
 
 
-def gen_subplot_scatter(ax, dgx, dgy, dgx_err=None, dgy_err=None, scatterplot=True):
+def annotation_strings(dgx, dgy, nboots=5000, rng=None):
     """
-    Generate a scatter plot of binding free energies that shows some statistics. This is a helper function that is
-    written for only one particular plot.
+    The Kendall tau and pairwise RMSE annotations of a scatter plot, with 95% bootstrap intervals. All the bootstrap
+    samples are evaluated together by fast_stats.
+
+    Parameters
+    ----------
+    dgx: list-like
+        The binding free energies for the x-axis.
+    dgy: list-like
+        The binding free energies for the y-axis
+    nboots: int
+        The number of bootstrap samples.
+    rng: numpy.random.Generator
+        The random number generator. If None, numpy's global random state is used.
+
+    Returns
+    -------
+    annotations: list of str
+        The text that is written in the top left of the plot, one string per line.
+    """
+    values, samples = fs.bootstrap_statistics(dgx, dgy, nboots, rng, statistics=['Kendall tau', 'Pairwise RMSE'])
+    tau = r"$\tau_{{\Delta G}}$ = {0:.2f} [{1:.2f}, {2:.2f}]".format(values['Kendall tau'],
+                                                                     *fs.interval(samples['Kendall tau']))
+    rmse = r'$RMSE_{{\Delta\Delta G}}$ = {0:.1f} [{1:.1f}, {2:.1f}] kcal/mol'.format(
+        values['Pairwise RMSE'], *fs.interval(samples['Pairwise RMSE']))
+    return [tau, rmse]
+
+
+def draw_scatter(ax, dgx, dgy, dgx_err=None, dgy_err=None, annotations=(), scatterplot=True):
+    """
+    Draw a scatter plot of binding free energies with the 1 and 2 kcal/mol regions and precomputed annotations.
 
     Parameters
     ----------
@@ -30,9 +60,10 @@ def gen_subplot_scatter(ax, dgx, dgy, dgx_err=None, dgy_err=None, scatterplot=Tr
         The uncertainty on the x-axis binding free energies values. Assumed to represent standard errors.
     dgy_error: list-like
         The uncertainty on the y-axis binding free energies values. Assumed to represent standard errors.
+    annotations: list-like of str
+        The lines of text for the top left of the plot, e.g. from annotation_strings.
     scatterplot: bool
         Whether or not to add the scatter plot.
-
     """
     # Scatter plot with a shaded areas that denote 1 kcal/mol and 2 kcal/mol
     nudge = 0.2
@@ -60,24 +91,36 @@ def gen_subplot_scatter(ax, dgx, dgy, dgx_err=None, dgy_err=None, scatterplot=Tr
     ax.set_xlim((xmin, xmax))
     ax.set_ylim((ymin, ymax))
 
-    # Add correlation and pairwise error information.
-    diffs = hf.get_pairwise_diffs(dgx, dgy)
-    corr_stats = hf.get_absolute_stats(dgx, dgy)
-    boostrap_mues, bootstrap_rmsds = hf.bootstrap_pairwise_error(dgx, dgy, nboots=5000)
-    brmds, bmues, br2, bootstrap_taus = hf.bootstrap_absolute_stats(dgx, dgy, nboots=5000)
-
     xpos = xmin + (xmax - xmin) * 0.05
-    ypos = ymin + (ymax - ymin) * 0.93
-    s = r"$\tau_{{\Delta G}}$ = {0:.2f} [{1:.2f}, {2:.2f}]".format(corr_stats[3],
-                                                                   np.percentile(bootstrap_taus, 2.5),
-                                                                   np.percentile(bootstrap_taus, 97.5))
-    ax.text(x=xpos, y=ypos, s=s, fontsize=15)
-    ypos = ymin + (ymax - ymin) * 0.85
-    rmsd = np.sqrt(np.mean(diffs ** 2))
-    s = r'$RMSE_{{\Delta\Delta G}}$ = {0:.1f} [{1:.1f}, {2:.1f}] kcal/mol'.format(rmsd,
-                                                                                  np.percentile(bootstrap_rmsds, 2.5),
-                                                                                  np.percentile(bootstrap_rmsds, 97.5))
-    ax.text(x=xpos, y=ypos, s=s, fontsize=15)
+    for ypos, s in zip((0.93, 0.85), annotations):
+        ax.text(x=xpos, y=ymin + (ymax - ymin) * ypos, s=s, fontsize=15)
+
+
+def gen_subplot_scatter(ax, dgx, dgy, dgx_err=None, dgy_err=None, scatterplot=True):
+    """
+    Generate a scatter plot of binding free energies that shows some statistics. This is a helper function that is
+    written for only one particular plot.
+
+    Parameters
+    ----------
+    ax: matplotlib.axes._subplots.AxesSubplot
+        The subplot where the axis will go.
+    dgx: list-like
+        The binding free energies for the x-axis.
+    dgy: list-like
+        The binding free energies for the y-axis
+    dgx_error: list-like
+        The uncertainty on the x-axis binding free energies values. Assumed to represent standard errors.
+    dgy_error: list-like
+        The uncertainty on the y-axis binding free energies values. Assumed to represent standard errors.
+    scatterplot: bool
+        Whether or not to add the scatter plot.
+
+    """
+    # Print the pairwise error and correlation statistics.
+    hf.get_pairwise_diffs(dgx, dgy)
+    hf.get_absolute_stats(dgx, dgy)
+    draw_scatter(ax, dgx, dgy, dgx_err, dgy_err, annotation_strings(dgx, dgy), scatterplot)
 
 def main(argv=None):
     usage = """
@@ -112,7 +155,9 @@ def main(argv=None):
         type=str,
         help="The name of the scatter plot (a png file) that is produced.")
 
+    prof.add_profile_argument(parser)
     args = parser.parse_args(argv)
+    prof.setup(args)
 
     # Load the experimental comparison data
     df_exp_galectin = pd.read_csv(f'{args.dirname}/peterson2018_itc_fp_exp_unc.csv')
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+from glob import glob
+
+import numpy as np
+
+import analysis_functions as af
+import results_table as rt
+
+# Bump this when the per-map metrics or the summaries change so that old caches are not used.
+CACHE_VERSION = 1
+
+
+def file_digest(path, chunk_size=2 ** 20):
+    """
+    The SHA-256 hash of a file's content.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def find_group_files(upper_dir, ext):
+    """
+    Find the output files of every group, which are the subdirectories of upper_dir.
+
+    Returns
+    -------
+    groups: dict
+        The sorted list of files of each group, by group name.
+    """
+    groups = {}
+    for entry in sorted(glob(f'{upper_dir}/*')):
+        if os.path.isdir(entry):
+            groups[entry.split('/')[-1]] = sorted(glob(f'{entry}/*{ext}'))
+    return groups
+
+
+def map_metrics(path):
+    """
+    Calculate the metrics of one map with parse_fep_data (for FMP files) or parse_fep_data_from_csv.
+
+    Returns
+    -------
+    metrics: dict
+        The value of every key of the parsed results for this map, as plain Python types.
+    """
+    if path.endswith('.fmp'):
+        results, diffs = af.parse_fep_data([path])
+    else:
+        results, diffs = af.parse_fep_data_from_csv([path])
+    return {key: values[0].item() if isinstance(values[0], np.generic) else values[0]
+            for key, values in results.items()}
+
+
+def _key(*parts):
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+class BenchmarkCache:
+    """
+    A build cache of the FEP benchmark analysis. The metrics of each map depend on the content of its file, the
+    summary of a group depends on the files of the group, and the summary of the benchmark depends on all the files.
+    Each is stored with the hash of what it depends on and is only recalculated when that changes, so rerunning one
+    map of hundreds recalculates that map, its group and the overall summary.
+
+    Files whose size and modification time have not changed since they were hashed are not hashed again.
+    """
+
+    def __init__(self, path=None):
+        """
+        Parameters
+        ----------
+        path: str
+            The JSON file of the cache. If None, nothing is stored between runs.
+        """
+        self.path = path
+        self.data = {'version': CACHE_VERSION, 'maps': {}, 'summaries': {}}
+        if path is not None and os.path.isfile(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == CACHE_VERSION:
+                self.data = data
+        self.recalculated_maps = set()
+        self.recalculated_summaries = set()
+        # Files whose cached metrics are used as they are, even if the file has changed, e.g. while it is being written.
+        self.held = set()
+
+    def digest(self, path):
+        """
+        The content hash of a file, reusing the cached hash if the file's size and modification time are unchanged.
+        """
+        st = os.stat(path)
+        stat = [st.st_size, st.st_mtime_ns]
+        entry = self.data['maps'].get(path)
+        if entry is not None and (entry['stat'] == stat or path in self.held):
+            return entry['digest']
+        return file_digest(path)
+
+    def metrics(self, path):
+        """
+        The metrics of one map, recalculated only if the file has changed.
+        """
+        if path in self.held and path in self.data['maps']:
+            return self.data['maps'][path]['metrics']
+        st = os.stat(path)
+        digest = self.digest(path)
+        entry = self.data['maps'].get(path)
+        if entry is None or entry['digest'] != digest:
+            entry = {'digest': digest, 'metrics': map_metrics(path)}
+            self.recalculated_maps.add(path)
+        entry['stat'] = [st.st_size, st.st_mtime_ns]
+        self.data['maps'][path] = entry
+        return entry['metrics']
+
+    def results(self, files):
+        """
+        The per-map metrics of a list of files as a ResultsTable, as from analysis_functions.parse_fep_data without
+        the pairwise differences.
+        """
+        return rt.ResultsTable.from_records([self.metrics(f) for f in files], [rt.group_of(f) for f in files])
+
+    def summary(self, name, files, summarize, seed=None):
+        """
+        The summary of a set of maps, recalculated only if one of the files has changed.
+
+        Parameters
+        ----------
+        name: str
+            The name of the summary, e.g. the group name.
+        files: list of str
+            The files that the summary depends on.
+        summarize: callable
+            A function that takes the results of the files, from BenchmarkCache.results, and returns a JSON
+            serializable summary.
+        seed: int
+            The seed of numpy's global random state before summarizing, so that the bootstrap intervals are
+            reproducible. If None, the random state is not seeded.
+
+        Returns
+        -------
+        summary:
+            The value returned by summarize.
+        """
+        key = _key([self.digest(f) for f in files], seed)
+        entry = self.data['summaries'].get(name)
+        if entry is None or entry['key'] != key:
+            if seed is not None:
+                np.random.seed(seed)
+            entry = {'key': key, 'summary': summarize(self.results(files))}
+            self.data['summaries'][name] = entry
+            self.recalculated_summaries.add(name)
+        return entry['summary']
+
+    def clear_recalculated(self):
+        """
+        Forget which maps and summaries have been recalculated, e.g. before each update of a long-running process.
+        """
+        self.recalculated_maps.clear()
+        self.recalculated_summaries.clear()
+
+    def prune(self, files):
+        """
+        Forget the maps that are not in a list of files, such as files that have been deleted.
+        """
+        keep = set(files)
+        self.data['maps'] = {p: e for p, e in self.data['maps'].items() if p in keep}
+
+    def forget_summary(self, name):
+        """
+        Forget the summary of a set of maps that no longer exists, such as a group whose files have all been deleted.
+        """
+        self.data['summaries'].pop(name, None)
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+
+
+def atomic_to_csv(df, path, **kwargs):
+    """
+    Write a data frame to a CSV file through a temporary file that replaces it, so that readers never see a partly
+    written file.
+    """
+    tmp = f'{path}.tmp'
+    df.to_csv(tmp, **kwargs)
+    os.replace(tmp, path)
+
+
+def summary_to_lists(summary):
+    """
+    Convert the tuples of analysis_functions.summarize_fep_error into lists of floats, which can be stored as JSON.
+    """
+    return [[float(x) for x in stat] for stat in summary]
+
+
+def print_summary(summary):
+    """
+    Print a summary from analysis_functions.summarize_fep_error in the same format as its verbose output.
+    """
+    if len(summary) == 6:
+        (pair_m, pair_l, pair_u), (mue_m, mue_l, mue_u), edge, edge_mue, r2, tau = summary
+    else:
+        (pair_m, pair_l, pair_u), (mue_m, mue_l, mue_u), r2, tau = summary
+        edge = edge_mue = None
+    print(f'Pair RMSE = {pair_m:.2f} [{pair_l:.2f}, {pair_u:.2f}] kcal/mol')
+    print(f'Pair MUE  = {mue_m:.2f} [{mue_l:.2f}, {mue_u:.2f}] kcal/mol')
+    if edge is not None:
+        print(f'Edge RMSE = {edge[0]:.2f} [{edge[1]:.2f}, {edge[2]:.2f}] kcal/mol')
+        print(f'Edge MUE  = {edge_mue[0]:.2f} [{edge_mue[1]:.2f}, {edge_mue[2]:.2f}] kcal/mol')
+    print(f'R2        = {r2[0]:.2f} [{r2[1]:.2f}, {r2[2]:.2f}]')
+    print(f'Tau       = {tau[0]:.2f} [{tau[1]:.2f}, {tau[2]:.2f}]')
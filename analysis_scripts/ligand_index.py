@@ -0,0 +1,363 @@
+import argparse
+import hashlib
+import json
+import os
+from collections import Counter
+from glob import glob
+
+import pandas as pd
+
+import incremental as inc
+
+STRUCTURE_INPUTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fep_benchmark_inputs',
+                                'structure_inputs')
+DEFAULT_INDEX = os.path.join(os.path.expanduser('~'), '.cache', 'fep_benchmark', 'ligand_index.json')
+DEFAULT_METADATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '21_4_results',
+                                'benchmark_output_metadata.csv')
+
+# Bump this when the hashes change so that old indexes are rebuilt.
+INDEX_VERSION = 1
+
+# The formal charges of the charge field of a V2000 atom line.
+V2000_CHARGES = {0: 0, 1: 3, 2: 2, 3: 1, 4: 0, 5: -1, 6: -2, 7: -3}
+
+
+def read_sdf(path):
+    """
+    Read the molecules of a V2000 SD file, without a cheminformatics toolkit.
+
+    Returns
+    -------
+    molecules: list of dict
+        The 'title', 'elements', 'coordinates', formal 'charges' and 'bonds' (as (atom 1, atom 2, order) with atoms
+        counted from zero) of each molecule, its data fields in 'properties', and the 'offset' and 'length' in bytes
+        of its record in the file.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read().split(b'\n')
+    lines = [line.decode().rstrip('\r') for line in raw]
+    line_offsets = [0]
+    for line in raw:
+        line_offsets.append(line_offsets[-1] + len(line) + 1)
+    size = line_offsets[-1] - 1
+    molecules = []
+    start = 0
+    while start < len(lines):
+        if start + 3 >= len(lines):
+            break
+        counts = lines[start + 3]
+        if 'V3000' in counts:
+            raise Exception(f'{path} is a V3000 SD file, only V2000 files can be read.')
+        natoms, nbonds = int(counts[0:3]), int(counts[3:6])
+        atom_lines = lines[start + 4:start + 4 + natoms]
+        bond_lines = lines[start + 4 + natoms:start + 4 + natoms + nbonds]
+        elements = [line[31:34].strip() for line in atom_lines]
+        coordinates = [(float(line[0:10]), float(line[10:20]), float(line[20:30])) for line in atom_lines]
+        charges = [V2000_CHARGES.get(int(line[36:39] or 0), 0) for line in atom_lines]
+        bonds = [(int(line[0:3]) - 1, int(line[3:6]) - 1, int(line[6:9])) for line in bond_lines]
+
+        i = start + 4 + natoms + nbonds
+        properties = {}
+        charged = False
+        while i < len(lines) and lines[i] != '$$$$':
+            line = lines[i]
+            if line.startswith('M  CHG'):
+                # The charges of the property block replace all the charges of the atom block.
+                if not charged:
+                    charges = [0] * natoms
+                    charged = True
+                fields = line[6:].split()
+                for k in range(int(fields[0])):
+                    charges[int(fields[1 + 2 * k]) - 1] = int(fields[2 + 2 * k])
+            elif line.startswith('>'):
+                name = line[line.index('<') + 1:line.index('>', line.index('<'))]
+                values = []
+                i += 1
+                while i < len(lines) and lines[i] != '' and lines[i] != '$$$$':
+                    values.append(lines[i])
+                    i += 1
+                properties[name] = '\n'.join(values)
+                continue
+            i += 1
+        end = min(i + 1, len(lines))
+        molecules.append({'title': lines[start].strip(), 'elements': elements, 'coordinates': coordinates,
+                          'charges': charges, 'bonds': bonds, 'properties': properties,
+                          'offset': line_offsets[start], 'length': min(line_offsets[end], size) - line_offsets[start]})
+        start = i + 1
+    return molecules
+
+
+def wl_hash(labels, edges):
+    """
+    A canonical hash of a labelled graph by Weisfeiler-Lehman refinement. Each round replaces the label of every atom
+    with a hash of its label and the sorted (edge label, neighbour label) pairs of its neighbours. The rounds stop when
+    they no longer split any class of atoms, and the hash is that of the sorted labels of every round, so it does not
+    depend on the order of the atoms. Each round takes a time linear in the number of bonds.
+
+    Parameters
+    ----------
+    labels: list of str
+        The label of each atom.
+    edges: list of tuple
+        The (atom 1, atom 2, edge label) of each bond.
+
+    Returns
+    -------
+    hash: str
+        A hex digest that is the same for isomorphic graphs.
+    """
+    neighbours = [[] for _ in labels]
+    for i, j, label in edges:
+        neighbours[i].append((label, j))
+        neighbours[j].append((label, i))
+
+    def digest(text):
+        return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+    current = [digest(str(label)) for label in labels]
+    rounds = [sorted(current)]
+    nclasses = len(set(current))
+    for _ in range(len(labels)):
+        current = [digest(current[i] + '|' + ','.join(sorted(f'{b}:{current[j]}' for b, j in neighbours[i])))
+                   for i in range(len(labels))]
+        rounds.append(sorted(current))
+        if len(set(current)) == nclasses:
+            break
+        nclasses = len(set(current))
+    return hashlib.sha256(json.dumps(rounds).encode()).hexdigest()
+
+
+def ligand_hashes(molecule):
+    """
+    The identity hashes of a molecule.
+
+    Returns
+    -------
+    heavy: str
+        The hash of the heavy-atom skeleton: the elements of the heavy atoms and which of them are bonded, without
+        bond orders, charges or hydrogens, so that the protomers and tautomers of a ligand have the same hash.
+    full: str
+        The hash of the heavy atoms with their formal charges and numbers of hydrogens, and the bond orders, which
+        tells the protomers and tautomers apart.
+
+    Note
+    ----
+    The hashes do not include stereochemistry, so the stereoisomers of a ligand have the same hashes.
+    """
+    elements = molecule['elements']
+    heavy_atoms = [i for i, e in enumerate(elements) if e != 'H']
+    position = {a: k for k, a in enumerate(heavy_atoms)}
+    hydrogens = Counter()
+    heavy_bonds = []
+    for i, j, order in molecule['bonds']:
+        if i in position and j in position:
+            heavy_bonds.append((position[i], position[j], order))
+        elif i in position:
+            hydrogens[position[i]] += 1
+        elif j in position:
+            hydrogens[position[j]] += 1
+
+    heavy = wl_hash([elements[a] for a in heavy_atoms], [(i, j, 1) for i, j, order in heavy_bonds])
+    full = wl_hash([f'{elements[a]}{molecule["charges"][a]:+d}H{hydrogens[k]}' for k, a in enumerate(heavy_atoms)],
+                   heavy_bonds)
+    return heavy, full
+
+
+class LigandIndex:
+    """
+    The identity hashes of the ligands of every map of the structure inputs, stored in a JSON file. Each SD file is
+    hashed once and only hashed again when its content changes.
+    """
+
+    def __init__(self, path=None):
+        """
+        Parameters
+        ----------
+        path: str
+            The JSON file of the index. If None, nothing is stored between runs.
+        """
+        self.path = path
+        self.data = {'version': INDEX_VERSION, 'maps': {}}
+        if path is not None and os.path.isfile(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION:
+                self.data = data
+
+    def update(self, structure_dir=STRUCTURE_INPUTS):
+        """
+        Add the ligands of every *_ligands.sdf file in the group directories of structure_dir, and remove the maps
+        whose files no longer exist.
+
+        Returns
+        -------
+        updated: list of str
+            The maps (as group/input name) that were hashed.
+        """
+        updated, found = [], set()
+        for path in sorted(glob(os.path.join(structure_dir, '*', '*_ligands.sdf'))):
+            name = f'{os.path.basename(os.path.dirname(path))}/{os.path.basename(path)[:-len("_ligands.sdf")]}'
+            found.add(name)
+            digest = inc.file_digest(path)
+            if self.data['maps'].get(name, {}).get('digest') == digest:
+                continue
+            ligands = []
+            for molecule in read_sdf(path):
+                heavy, full = ligand_hashes(molecule)
+                ligands.append({'title': molecule['title'], 'heavy': heavy, 'full': full})
+            self.data['maps'][name] = {'digest': digest, 'ligands': ligands}
+            updated.append(name)
+        for name in set(self.data['maps']) - found:
+            del self.data['maps'][name]
+        return updated
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+
+    def identities(self, name, level='heavy'):
+        """
+        The distinct ligands of a map (given as group/input name) at the 'heavy' or 'full' level.
+        """
+        return set(ligand[level] for ligand in self.data['maps'][name]['ligands'])
+
+    def output_identities(self, metadata, level='heavy'):
+        """
+        The distinct ligands of every output map, which is named as in the results (e.g. thrombin_core_out). The
+        ligands of the input maps that are merged into one output map, such as those of py21_merged, are combined.
+        A ligand is identified by its hash and the protein of the map, as the same ligand binding to different proteins
+        (e.g. in taf12 and brd41_ASH106) are different measurements.
+
+        Parameters
+        ----------
+        metadata: pandas.DataFrame
+            The output metadata, with the columns 'Group abbreviation', 'Protein', 'Input file naming scheme' and
+            'Output file naming scheme'.
+        level: str
+            'heavy' or 'full'.
+
+        Returns
+        -------
+        identities: dict
+            The set of (protein, ligand hash) of each output map, in the order of the metadata.
+        """
+        identities = {}
+        columns = ['Group abbreviation', 'Protein', 'Input file naming scheme', 'Output file naming scheme']
+        for group, protein, inp, out in metadata[columns].itertuples(index=False):
+            name = f'{group}/{inp}'
+            if name in self.data['maps']:
+                identities.setdefault(out, set()).update((protein, h) for h in self.identities(name, level))
+        return identities
+
+
+def shared_ligands(identities, order):
+    """
+    Find the ligands of every map that are already in a map before it, in one pass over all the ligands.
+
+    Parameters
+    ----------
+    identities: dict
+        The set of ligand hashes of each map.
+    order: list of str
+        The maps in order of precedence: a ligand is counted in the first map that has it.
+
+    Returns
+    -------
+    shared: dict
+        The maps that have ligands of earlier maps, with the number of those ligands in each earlier map, e.g.
+        {'throm_nozob_hip75_sbmcorr_out': {'thrombin_core_out': 11}}.
+    """
+    owner = {}
+    shared = {}
+    for name in order:
+        for ligand in identities.get(name, ()):
+            if ligand in owner:
+                first = owner[ligand]
+                shared.setdefault(name, Counter())[first] += 1
+            else:
+                owner[ligand] = name
+    return {name: dict(counts) for name, counts in shared.items()}
+
+
+def find_shared_ligands(index_path=DEFAULT_INDEX, metadata_csv=DEFAULT_METADATA, structure_dir=STRUCTURE_INPUTS,
+                        level='heavy'):
+    """
+    Bring the index up to date with the structure inputs and find the ligands that every output map shares with the
+    maps before it in the metadata, e.g. the thrombin JACS set ligands in the thrombin water displacement set.
+
+    Returns
+    -------
+    shared: dict
+        The maps that have ligands of earlier maps, as from shared_ligands.
+    """
+    index = LigandIndex(index_path)
+    if len(index.update(structure_dir)) > 0:
+        index.save()
+    identities = index.output_identities(pd.read_csv(metadata_csv), level)
+    return shared_ligands(identities, list(identities))
+
+
+def main(argv=None):
+    usage = """
+    The script hashes the ligands of every *_ligands.sdf file of the structure inputs and stores them in an index,
+    which process_fep_benchmark.py uses to find the ligands that are in more than one map. The index only needs to
+    be rebuilt when the structure inputs change:
+
+        > python ligand_index.py
+
+    The ligands that are shared between maps are listed with --shared.
+    """
+    description = """
+    Build the index of the ligand identities of the benchmark structure inputs.
+    """
+    parser = argparse.ArgumentParser(usage=usage, description=description)
+    parser.add_argument(
+        '-s',
+        '--structure_dir',
+        type=str,
+        default=STRUCTURE_INPUTS,
+        help="The directory of the structure inputs, with a subdirectory for each group, "
+             "default=../fep_benchmark_inputs/structure_inputs.")
+    parser.add_argument(
+        '-i',
+        '--index',
+        type=str,
+        default=DEFAULT_INDEX,
+        help="The JSON file of the index, default=~/.cache/fep_benchmark/ligand_index.json.")
+    parser.add_argument(
+        '-m',
+        '--metadata',
+        type=str,
+        default=DEFAULT_METADATA,
+        help="The CSV file with the output metadata, default=../21_4_results/benchmark_output_metadata.csv.")
+    parser.add_argument(
+        '--level',
+        type=str,
+        choices=['heavy', 'full'],
+        default='heavy',
+        help="Whether ligands are the same if their heavy-atom skeletons are the same (so that protomers and "
+             "tautomers are one ligand) or only if they are the same protomer and tautomer, default=heavy.")
+    parser.add_argument(
+        '--shared',
+        action='store_true',
+        help="Print the number of ligands that every map shares with the maps before it.")
+    args = parser.parse_args(argv)
+
+    index = LigandIndex(args.index)
+    updated = index.update(args.structure_dir)
+    index.save()
+    print(f'{len(index.data["maps"])} maps in {args.index}, {len(updated)} hashed')
+    if args.shared:
+        identities = index.output_identities(pd.read_csv(args.metadata), args.level)
+        for name, counts in shared_ligands(identities, list(identities)).items():
+            print(f'{name} ({len(identities[name])} ligands): ' +
+                  ', '.join(f'{n} in {first}' for first, n in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import ligand_index as li
+import profiling as prof
+import ragged
+import structure_store as ss
+
+# The distances (in angstroms) from the ligand heavy atoms within which protein heavy atoms are contacts, residues and
+# waters are in the pocket, and protein heavy atoms count towards the burial of a ligand atom.
+CONTACT_CUTOFF = 4.0
+POCKET_CUTOFF = 6.0
+BURIAL_CUTOFF = 8.0
+
+WATER_NAMES = ('HOH', 'WAT', 'SPC', 'TIP')
+
+
+def _residue_codes(atoms):
+    """
+    A number for the residue of every atom, from its chain, residue number and residue name.
+    """
+    keys = np.char.add(np.char.add(atoms['chain'], np.char.mod('%d', atoms['resnum'])), atoms['resname'])
+    return np.unique(keys, return_inverse=True)[1].ravel()
+
+
+def _pairs(tree, other, cutoff):
+    """
+    The (index in tree, index in other) of every pair of points closer than cutoff.
+    """
+    pairs = tree.sparse_distance_matrix(other, cutoff, output_type='ndarray')
+    return pairs['i'], pairs['j']
+
+
+def _count_unique(ids, values, n):
+    """
+    The number of distinct values of each id from 0 to n - 1.
+    """
+    if len(ids) == 0:
+        return np.zeros(n, dtype=int)
+    unique = np.unique(np.stack([ids, values], axis=1), axis=0)
+    return np.bincount(unique[:, 0], minlength=n)
+
+
+def map_features(store, name):
+    """
+    Calculate the pocket features of every ligand of one map. The ligands of the map are stacked into one array of
+    atoms with the offset of each ligand, and the protein atoms near any of them are found with one KD-tree query, so
+    every feature is a segment reduction over the ligands.
+
+    Parameters
+    ----------
+    store: structure_store.StructureStore
+        The store of the structure inputs.
+    name: str
+        The map, as group/input name.
+
+    Returns
+    -------
+    features: pandas.DataFrame
+        One row per ligand with the 'Group', 'Input name' and 'Ligand name', the number of ligand heavy atoms, the
+        number of protein heavy atom 'contacts' within CONTACT_CUTOFF, the numbers of residues, positively and
+        negatively charged residues (by the formal charges of their atoms) and waters within POCKET_CUTOFF, the mean
+        B-factor of the distinct protein heavy atoms within POCKET_CUTOFF, and the 'burial' (the mean number of
+        protein heavy atoms within BURIAL_CUTOFF of each ligand heavy atom).
+    """
+    group, input_name = name.split('/')
+    titles = store.titles(name)
+    ligands = [store.ligand(name, t) for t in titles]
+    heavy = [lig['atoms']['element'] != 'H' for lig in ligands]
+    xyz = [np.asarray(lig['coordinates'])[h] for lig, h in zip(ligands, heavy)]
+    counts = np.array([len(x) for x in xyz], dtype=int)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    lig_xyz = np.concatenate(xyz) if len(xyz) > 0 else np.zeros((0, 3))
+    ligand_of = np.repeat(np.arange(len(titles)), counts)
+
+    protein = store.protein(name)
+    atoms = np.asarray(protein['atoms'])
+    coordinates = np.asarray(protein['coordinates'], dtype=float)
+    water = np.isin(atoms['resname'], WATER_NAMES)
+    protein_heavy = np.flatnonzero((atoms['element'] != 'H') & ~water)
+    water_oxygens = np.flatnonzero(water & (atoms['element'] == 'O'))
+    residues = _residue_codes(atoms)
+    residue_charge = np.bincount(residues, weights=atoms['charge'].astype(float))
+
+    ligand_tree = cKDTree(lig_xyz)
+    protein_tree = cKDTree(coordinates[protein_heavy])
+    water_tree = cKDTree(coordinates[water_oxygens])
+    n = len(titles)
+
+    lig_atoms, prot_atoms = _pairs(ligand_tree, protein_tree, CONTACT_CUTOFF)
+    contacts = np.bincount(ligand_of[lig_atoms], minlength=n)
+
+    lig_atoms, prot_atoms = _pairs(ligand_tree, protein_tree, POCKET_CUTOFF)
+    pocket_residues = residues[protein_heavy[prot_atoms]]
+    owners = ligand_of[lig_atoms]
+    charge = residue_charge[pocket_residues]
+    # Each protein atom of the pocket counts once, however many of the ligand's atoms it is near.
+    pocket_atoms = np.unique(np.stack([owners, prot_atoms], axis=1), axis=0).reshape(-1, 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bfactor = np.bincount(pocket_atoms[:, 0], weights=atoms['bfactor'][protein_heavy[pocket_atoms[:, 1]]],
+                              minlength=n) / np.bincount(pocket_atoms[:, 0], minlength=n)
+
+    lig_atoms, water_atoms = _pairs(ligand_tree, water_tree, POCKET_CUTOFF)
+    burial = protein_tree.query_ball_point(lig_xyz, BURIAL_CUTOFF, return_length=True)
+
+    return pd.DataFrame({'Group': group,
+                         'Input name': input_name,
+                         'Ligand name': titles,
+                         'heavy atoms': counts,
+                         'contacts': contacts,
+                         'pocket residues': _count_unique(owners, pocket_residues, n),
+                         'positive residues': _count_unique(owners[charge > 0], pocket_residues[charge > 0], n),
+                         'negative residues': _count_unique(owners[charge < 0], pocket_residues[charge < 0], n),
+                         'pocket waters': _count_unique(ligand_of[lig_atoms], water_atoms, n),
+                         'pocket B-factor': bfactor,
+                         'burial': ragged.segment_sum(burial, offsets) / counts})
+
+
+def _map_features(args):
+    store_dir, name = args
+    return map_features(ss.StructureStore(store_dir), name)
+
+
+def featurize(store_dir=ss.DEFAULT_STORE, nprocs=None):
+    """
+    Calculate the pocket features of every ligand of every map of the store, with the maps shared out over a pool of
+    processes. Each process memory-maps the store, so the structures are not copied between processes.
+    """
+    names = ss.StructureStore(store_dir).maps
+    with ProcessPoolExecutor(max_workers=nprocs) as pool:
+        frames = list(pool.map(_map_features, [(store_dir, name) for name in names]))
+    return pd.concat(frames, ignore_index=True)
+
+
+def join_predictions(features, predictions_dir, metadata):
+    """
+    Join the features of every ligand to its predicted and experimental binding free energies in the ligand_predictions
+    CSV files, with the error of the prediction.
+
+    Parameters
+    ----------
+    features: pandas.DataFrame
+        The features from featurize.
+    predictions_dir: str
+        The directory of the ligand predictions, with a subdirectory of CSV files for each group.
+    metadata: pandas.DataFrame
+        The output metadata, which gives the output name of each map of the structure inputs.
+
+    Returns
+    -------
+    joined: pandas.DataFrame
+        One row per predicted ligand with the 'Group', 'Map' (the output name of the results), the columns of the
+        predictions and the features. Ligands without structures have no features.
+    """
+    frames = []
+    for path in sorted(glob(os.path.join(predictions_dir, '*', '*.csv'))):
+        df = pd.read_csv(path, dtype={'Ligand name': str, 'Ligand': str})
+        if 'Ligand name' not in df:
+            # A few files call the column of the ligand names 'Ligand'.
+            df = df.rename(columns={'Ligand': 'Ligand name'})
+        df.insert(0, 'Map', os.path.basename(path)[:-len('.csv')])
+        df.insert(0, 'Group', os.path.basename(os.path.dirname(path)))
+        frames.append(df)
+    predictions = pd.concat(frames, ignore_index=True)
+    predictions['Error (kcal/mol)'] = predictions['Pred. dG (kcal/mol)'] - predictions['Exp. dG (kcal/mol)']
+
+    names = metadata[['Group abbreviation', 'Input file naming scheme', 'Output file naming scheme']].rename(
+        columns={'Group abbreviation': 'Group', 'Input file naming scheme': 'Input name',
+                 'Output file naming scheme': 'Map'})
+    features = features.merge(names.drop_duplicates(['Group', 'Input name']), on=['Group', 'Input name'], how='left')
+    features = features.drop_duplicates(['Group', 'Map', 'Ligand name'])
+    return predictions.merge(features, on=['Group', 'Map', 'Ligand name'], how='left')
+
+
+def main(argv=None):
+    usage = """
+    The script calculates pocket features of every ligand of every map of the structure inputs: contacts with the
+    protein, nearby charged residues, pocket waters (HOH records), the B-factors of the pocket and burial. The
+    features are joined to the predictions of ../21_4_results/ligand_predictions, so that the errors of FEP+ can be
+    compared with them:
+
+        > python pocket_features.py -o pocket_features.csv
+
+    The structures are read from the store of structure_store.py, which is built first if it does not exist.
+    """
+    description = """
+    Calculate the pocket features of the ligands of the FEP+ benchmark.
+    """
+    parser = argparse.ArgumentParser(usage=usage, description=description)
+    parser.add_argument(
+        '--store',
+        type=str,
+        default=ss.DEFAULT_STORE,
+        help="The directory of the structure store, default=~/.cache/fep_benchmark/structure_store.")
+    parser.add_argument(
+        '-s',
+        '--structure_dir',
+        type=str,
+        default=li.STRUCTURE_INPUTS,
+        help="The directory of the structure inputs, used if the store has to be built, "
+             "default=../fep_benchmark_inputs/structure_inputs.")
+    parser.add_argument(
+        '-p',
+        '--predictions',
+        type=str,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '21_4_results', 'ligand_predictions'),
+        help="The directory of the ligand predictions, default=../21_4_results/ligand_predictions.")
+    parser.add_argument(
+        '-m',
+        '--metadata',
+        type=str,
+        default=li.DEFAULT_METADATA,
+        help="The CSV file with the output metadata, default=../21_4_results/benchmark_output_metadata.csv.")
+    parser.add_argument(
+        '-o',
+        '--output',
+        type=str,
+        default='pocket_features.csv',
+        help="The CSV file of the predictions and features, default=pocket_features.csv.")
+    parser.add_argument('-j', dest='nprocs', type=int, help="The number of maps to featurize in parallel, "
+                                                            "default=number of CPUs.", default=os.cpu_count())
+    prof.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+    prof.setup(args)
+
+    if not os.path.isfile(os.path.join(args.store, 'index.json')):
+        with prof.stage('store'):
+            ss.build_store(args.structure_dir, args.store)
+    with prof.stage('features'):
+        features = featurize(args.store, args.nprocs)
+    with prof.stage('join'):
+        joined = join_predictions(features, args.predictions, pd.read_csv(args.metadata))
+    joined.to_csv(args.output, index=False, float_format='%.3f')
+    print(f'Features of {len(features)} ligands of {features.groupby(["Group", "Input name"]).ngroups} maps, '
+          f'{joined["contacts"].notna().sum()} of {len(joined)} predictions matched, written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,33 @@ import pandas as pd
 from glob import glob
 import os
 
+import profiling as prof
+
+
+# TODO: GPCRs currently requires manually intervention.
+SKIPPED_GROUPS = ('gpcrs',)
+
+
+def metadata_names(df_meta, group_abbreviation):
+    """
+    Use the output metadata to create dictionaries that link the output file names of a group to their reference PDBs
+    and protein names.
+
+    Returns
+    -------
+    out2pdb: dict
+        The reference PDB of each output file name.
+    out2protein: dict
+        The protein name of each output file name.
+    """
+    out2pdb = {}
+    out2protein = {}
+    df_group = df_meta.loc[df_meta['Group abbreviation'] == group_abbreviation]
+    for i, row in df_group.iterrows():
+        out2pdb[row['Output file naming scheme']] = row['Reference PDB']
+        out2protein[row['Output file naming scheme']] = row['Protein']
+    return out2pdb, out2protein
+
 
 def main(argv=None):
     usage = """
@@ -38,7 +65,9 @@ def main(argv=None):
         '--metadata',
         type=str,
         help="The CSV file with the output metadata, default=None")
+    prof.add_profile_argument(parser)
     args = parser.parse_args(argv)
+    prof.setup(args)
 
     files = []
     for entry in glob(f'{args.upper_dir}/*'):
@@ -55,18 +84,11 @@ def main(argv=None):
             files = glob(f'{entry}/*fmp')
             if len(files) >= 1:
                 group_abbreviation = entry.split('/')[-1]
-                # TODO: GPCRs currently requires manually intervention.
-                if group_abbreviation == 'gpcrs':
+                if group_abbreviation in SKIPPED_GROUPS:
                     continue
                 print(group_abbreviation)
                 if df_meta is not None:
-                    # Use the metadata to create dictionaries
-                    out2pdb = {}
-                    out2protein = {}
-                    df_group = df_meta.loc[df_meta['Group abbreviation'] == group_abbreviation]
-                    for i, row in df_group.iterrows():
-                        out2pdb[row['Output file naming scheme']] = row['Reference PDB']
-                        out2protein[row['Output file naming scheme']] = row['Protein']
+                    out2pdb, out2protein = metadata_names(df_meta, group_abbreviation)
                     af.print_latex_table(files, out2pdb=out2pdb, out2protein=out2protein)
                 else:
                     af.print_latex_table(files)
@@ -1,11 +1,52 @@
-import analysis_functions as af
+import survey_table as st
+import numpy as np
 import argparse
 
+import profiling as prof
+
+# The headings used to report each comparison type of the survey metadata.
+CATEGORY_TITLES = {'Binding vs binding': 'Biophysical vs biophysical error',
+                   'Binding vs inhibition': 'Biophysical vs biochemical error',
+                   'Inhibition vs inhibition': 'Biochemical vs biochemical error'}
+
+
+def print_summary(table, samples, category=None):
+    """
+    Print the weighted statistics of one category of the survey, or of the whole survey, with bootstrap intervals.
+
+    Parameters
+    ----------
+    table: survey_table.SurveyTable
+        The loaded survey.
+    samples: dict
+        The bootstrap samples of every category from survey_table.SurveyTable.bootstrap.
+    category: str
+        The comparison type to summarize. If None, all comparisons are summarized.
+    """
+    by = 'Category' if category is not None else None
+    key = category if category is not None else 'All'
+    summary = table.summarize(by).loc[key]
+    samples = samples[key]
+
+    if category is not None:
+        print(f'Number of comparisons = {int(summary["comparisons"])}')
+    print('Total number of comparison data points (including repeated ligands) =', int(summary['number']))
+    print()
+    for stat in st.STATISTICS:
+        boot = samples[stat]
+        print('Weighted {} = {:.2} kcal/mol'.format(stat, summary[stat]))
+        print('Weighted bootstap {} = {:.2} [{:.2f}, {:.2f}] kcal/mol'.format(stat, np.nanmean(boot),
+                                                                            np.nanpercentile(boot, 2.5),
+                                                                            np.nanpercentile(boot, 97.5)))
+        print()
+
+
 def main(argv=None):
     usage = """
         As input, this script requires the directory that contains the CSV files of the individual experimental binding
-        free energy comparisons. This data has been taken from publicly assessible sources and the CSV filenames have
-        been hard-coded in this script. 
+        free energy comparisons. This data has been taken from publicly assessible sources. The comparisons that are
+        used and their categories are read from publicly_accessible_survey_metadata.csv, so a new comparison only
+        requires a new row in the metadata. 
          
         > python process_experimental_survey.py directory1
             
@@ -33,103 +74,54 @@ def main(argv=None):
         '--drug_discovery_dir',
         type=str,
         help="The directory that contains Schrodinger's drug discovery comparative assay data, default=None", default=None)
+    parser.add_argument(
+        '-m',
+        '--metadata',
+        type=str,
+        help="The metadata CSV of the survey, default=../experimental_survey_data/publicly_accessible_survey_metadata.csv",
+        default=st.DEFAULT_METADATA)
+    parser.add_argument(
+        '-b',
+        '--bootstrap',
+        type=str,
+        choices=['independent', 'hierarchical', 'stratified', 'uniform'],
+        help="How the comparisons are resampled: 'independent' resamples the whole survey and each comparison type "
+             "separately, as in the published intervals, 'hierarchical' resamples publications and then comparisons "
+             "within each comparison type, 'stratified' resamples comparisons within each comparison type and "
+             "'uniform' resamples all comparisons together, default=independent",
+        default='independent')
+    parser.add_argument(
+        '--nboots',
+        type=int,
+        help="The number of bootstrap samples, default=10000",
+        default=10000)
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help="The seed of the bootstrap random number generator, default=None",
+        default=None)
+    prof.add_profile_argument(parser)
     args = parser.parse_args(argv)
+    prof.setup(args)
 
-    dir1 = args.dir
-    dir2 = args.drug_discovery_dir
-    # Splitting the survey into the different catagories of comparison
-    binding_comparisons = [f'{dir1}/aaron2010_spr_itc.csv',
-                           f'{dir1}/hang2009_hcvpoly_con1_spr_fluor.csv',
-                           f'{dir1}/jecklin2009_ms_itc.csv',
-                           f'{dir1}/jecklin2009_ms_spr.csv',
-                           f'{dir1}/jecklin2009_spr_itc.csv',
-                           f'{dir1}/mandine2001_sh2_spa_spr.csv',
-                           f'{dir1}/mason2012_spr_lan.csv',
-                           f'{dir1}/murphy2006_binding.csv',
-                           f'{dir1}/murthy2007_itc_spr.csv',
-                           f'{dir1}/navratilova2007_caII_itc_spr.csv',
-                           f'{dir1}/newman2012_spr_itc.csv',
-                           f'{dir1}/peterson2018_itc_fp.csv',
-                           f'{dir1}/rogez2013_bovine_itc_tsa.csv',
-                           f'{dir1}/rogez2013_bovine_spr_itc.csv',
-                           f'{dir1}/rogez2013_bovine_spr_tsa.csv',
-                           f'{dir1}/rogez2013_human_itc_tsa.csv',
-                           f'{dir1}/rogez2013_human_spr_itc.csv',
-                           f'{dir1}/rogez2013_human_spr_tsa.csv',
-                           f'{dir1}/schnapp2016_dppiv_itc_spr.csv',
-                           f'{dir1}/ycas2020_bptf_labeled_spr_alphascreen.csv',
-                           f'{dir1}/ycas2020_bptf_nmr_alphascreen.csv',
-                           f'{dir1}/ycas2020_bptf_nmr_labeled_spr.csv',
-                           f'{dir1}/ycas2020_bptf_nmr_spr.csv',
-                           f'{dir1}/ycas2020_bptf_spr_alphascreen.csv']
-
-    if dir2 is not None:
-        binding_comparisons.extend([f'{dir2}/projectD_lantha_discover.csv', f'{dir2}/projectE_lantha_discover.csv'])
-
-    binding_vs_functional_comparisons = [f'{dir1}/baum2009_thrombin_ki_itc.csv',
-                                         f'{dir1}/hang2009_hcvpoly_bk_ic50_fluor.csv',
-                                         f'{dir1}/hang2009_hcvpoly_con1_ic50_fluor.csv',
-                                         f'{dir1}/kung2011_hsp90_spa_itc.csv',
-                                         f'{dir1}/li2016_dppiv_spr_ic50.csv',
-                                         f'{dir1}/mason2012_lan_ic50.csv',
-                                         f'{dir1}/mason2012_spr_ic50.csv',
-                                         f'{dir1}/nikolovska2004_xiap_ki_kd.csv',
-                                         f'{dir1}/crawford2016_binding_BRD41.csv',
-                                         f'{dir1}/crawford2016_binding_BRD42.csv',
-                                         f'{dir1}/crawford2016_binding_BRD9.csv',
-                                         f'{dir1}/crawford2016_binding_BRPF1.csv',
-                                         f'{dir1}/crawford2016_binding_CECR2.csv',
-                                         f'{dir1}/crawford2016_binding_CREBBP.csv',
-                                         f'{dir1}/crawford2016_binding_TAF12.csv',
-                                         f'{dir1}/patil2018_ic50_spr_nottopbottom.csv',
-                                         f'{dir1}/schnapp2016_dppiv_ic50_spr.csv',
-                                         f'{dir1}/schnapp2016_dppiv_itc_ic50.csv',
-                                         f'{dir1}/schindler2020_functional_spr.csv']
-
-    if dir2 is not None:
-        binding_vs_functional_comparisons.extend([ f'{dir2}/projectA_spr_biochem.csv',
-                                         f'{dir2}/projectB_biochem_phospho.csv',
-                                         f'{dir2}/projectC_spr_biochem.csv',
-                                         f'{dir2}/projectD_discover_trfret.csv',
-                                         f'{dir2}/projectD_discover_atpkm.csv',
-                                         f'{dir2}/projectD_lantha_atpkm.csv',
-                                         f'{dir2}/projectD_lantha_trfret.csv',
-                                         f'{dir2}/projectE_lantha_atpkm.csv',
-                                         f'{dir2}/projectE_lantha_trfret.csv',
-                                         f'{dir2}/projectE_discover_trfret.csv',
-                                         f'{dir2}/projectE_discover_atpkm.csv'])
-
-    functional_comparisons = [f'{dir1}/chen2013_angiotensin_inhibition.csv',
-                              f'{dir1}/jia2006_cot_inhibition_nottopbottom.csv',
-                              f'{dir1}/katz2003_upa_competition.csv',
-                              f'{dir1}/moonshot2020_covid_protease_inhibition_nottopbottom.csv']
-    if dir2 is not None:
-        functional_comparisons.extend([f'{dir2}/projectD_atpkm_trfret.csv',
-                              f'{dir2}/projectE_atpkm_trfret.csv'])
-
-    all_comparitive_files = binding_comparisons + binding_vs_functional_comparisons + functional_comparisons
+    table = st.SurveyTable(args.dir, args.metadata, args.drug_discovery_dir)
+    if args.bootstrap == 'independent':
+        samples = table.bootstrap_independent(args.nboots, seed=args.seed)
+    else:
+        # The overall and per-category intervals all come from the same replicates.
+        samples = table.bootstrap(args.nboots, stratify=args.bootstrap != 'uniform',
+                                  cluster=args.bootstrap == 'hierarchical', seed=args.seed)
 
     print('The overall experimental error in the survey')
     print('--------------------------------------------')
-    af.summarize_experimental_error(all_comparitive_files)
-
-    print('Biophysical vs biophysical error')
-    print('--------------------------------')
-    print(f'Number of comparisons = {len(binding_comparisons)}')
-    af.summarize_experimental_error(binding_comparisons)
+    print_summary(table, samples, None)
 
-    print('Biophysical vs biochemical error')
-    print('---------------------------------')
-    print(f'Number of comparisons = {len(binding_vs_functional_comparisons)}')
-    af.summarize_experimental_error(binding_vs_functional_comparisons)
+    for category in table.categories():
+        title = CATEGORY_TITLES.get(category, category)
+        print(title)
+        print('-' * (len(title) + 1))
+        print_summary(table, samples, category)
 
-    print('Biochemical vs biochemical error')
-    print('---------------------------------')
-    print(f'Number of comparisons = {len(functional_comparisons)}')
-    af.summarize_experimental_error(functional_comparisons)
 
 if __name__== '__main__':
     main()
-
-
-
@@ -1,8 +1,63 @@
 import analysis_functions as af
 import argparse
+import hashlib
 import importlib
+import json
 from glob import glob
+import numpy as np
 import os
+
+import incremental as inc
+import ligand_index as li
+import profiling as prof
+
+
+def correct_thrombin_overlap(results):
+    """
+    Correct for the ligands in the thrombin water displacement set map that overlap with thrombin JACS set map, by
+    removing the overlapping compounds from the number of compounds of the water displacement set.
+
+    Parameters
+    ----------
+    results: results_table.ResultsTable
+        The per-map results of the benchmark, which are changed in place.
+    """
+    throm_name_waterset = 'throm_nozob_hip75_sbmcorr_out'
+    throm_name_jacsset = 'thrombin_core_out'
+    if throm_name_waterset in results.entry_index and throm_name_jacsset in results.entry_index:
+        results.entry(throm_name_waterset)['number of compounds'] -= \
+            results.entry(throm_name_jacsset)['number of compounds']
+    return results
+
+
+def correct_shared_ligands(results, shared):
+    """
+    Correct for the ligands that are in more than one map, as found from the structure inputs by
+    ligand_index.find_shared_ligands, by removing them from the number of compounds of every map but the first that
+    has them.
+
+    Parameters
+    ----------
+    results: results_table.ResultsTable
+        The per-map results of the benchmark, which are changed in place.
+    shared: dict
+        The number of ligands that each map shares with each map before it.
+    """
+    for name, counts in shared.items():
+        if name in results.entry_index:
+            results.entry(name)['number of compounds'] -= sum(n for first, n in counts.items()
+                                                              if first in results.entry_index)
+    return results
+
+
+def _summarize(results, shared=None):
+    if shared is not None:
+        correct_shared_ligands(results, shared)
+    else:
+        correct_thrombin_overlap(results)
+    return inc.summary_to_lists(af.summarize_fep_error(results, verbose=False))
+
+
 def main(argv=None):
     usage = """
     The script takes output FMP or CSV files and returns aggregate accuracy statistics. The FMP or CSV files must be 
@@ -54,7 +109,27 @@ def main(argv=None):
         type=str,
         choices=['fmp', 'csv'],
         help="The file extension of the results. Results can be either FMP files or CSVs.")
+    parser.add_argument(
+        '--cache',
+        type=str,
+        help="A JSON file that keeps the metrics of each map and the summary between runs, so that only the maps "
+             "whose files have changed are recalculated.")
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help="The seed of numpy's random state before bootstrapping, so that the intervals are reproducible.")
+    parser.add_argument(
+        '--ligand_index',
+        type=str,
+        nargs='?',
+        const=li.DEFAULT_INDEX,
+        help="Find the ligands that are in more than one map from the structure inputs, with the index of their "
+             "identities in this JSON file (default=~/.cache/fep_benchmark/ligand_index.json), and count each ligand "
+             "once. Without this option, only the thrombin ligands that are in two maps are counted once, as in the "
+             "manuscript.")
+    prof.add_profile_argument(parser)
     args = parser.parse_args(argv)
+    prof.setup(args)
 
     if args.ext == 'fmp':
         if importlib.util.find_spec('schrodinger') is None:
@@ -64,30 +139,37 @@ def main(argv=None):
     for entry in glob(f'{args.upper_dir}/*'):
         if os.path.isdir(entry):
             files.extend(glob(f'{entry}/*{args.ext}'))
+    files = sorted(files)
 
-    # Get the analysis metrics for each map
-    if args.ext == 'fmp':
-        results, diffs = af.parse_fep_data(files)
-    elif args.ext == 'csv':
-        results, diffs = af.parse_fep_data_from_csv(files)
-    else:
-        raise Exception(f'Only "fmp" and "csv" are accessible file extenstions. You have entered {args.ext}.')
-
-    # Correcting for the ligands in the thrombin water displacement set map that overlap with thrombin JACS set map.
-    throm_name_waterset = 'throm_nozob_hip75_sbmcorr_out'
-    throm_name_jacsset = 'thrombin_core_out'
-    for i, name in enumerate(results['entries']):
-        if name == throm_name_waterset:
-            throm_name_waterset_ind = i
-        if name == throm_name_jacsset:
-            throm_name_jacsset_ind = i
-
-    if throm_name_waterset_ind is not None and throm_name_jacsset_ind is not None:
-        results['number of compounds'][throm_name_waterset_ind] -= results['number of compounds'][throm_name_jacsset_ind]
+    shared = li.find_shared_ligands(args.ligand_index) if args.ligand_index is not None else None
 
     print('FEP+ benchmark summary')
     print('-----------------------')
-    af.summarize_fep_error(results)
+    if args.cache is not None:
+        cache = inc.BenchmarkCache(args.cache)
+        name = 'FEP+ benchmark'
+        if shared is not None:
+            name += f' without shared ligands {hashlib.sha256(json.dumps(shared, sort_keys=True).encode()).hexdigest()}'
+        summary = cache.summary(name, files, lambda results: _summarize(results, shared), args.seed)
+        cache.prune(files)
+        cache.save()
+        inc.print_summary(summary)
+        print(f'({len(cache.recalculated_maps)} of {len(files)} maps recalculated)')
+    else:
+        # Get the analysis metrics for each map
+        if args.ext == 'fmp':
+            results, diffs = af.parse_fep_data(files)
+        elif args.ext == 'csv':
+            results, diffs = af.parse_fep_data_from_csv(files)
+        else:
+            raise Exception(f'Only "fmp" and "csv" are accessible file extenstions. You have entered {args.ext}.')
+        if shared is not None:
+            correct_shared_ligands(results, shared)
+        else:
+            correct_thrombin_overlap(results)
+        if args.seed is not None:
+            np.random.seed(args.seed)
+        af.summarize_fep_error(results)
     print()
 
 
@@ -0,0 +1,211 @@
+import atexit
+import contextlib
+import functools
+import json
+import os
+import time
+import tracemalloc
+
+import pandas as pd
+
+# Setting this environment variable to the name of a JSON file (or to 1 for profile.json) profiles any analysis script.
+ENV_VAR = 'FEP_ANALYSIS_PROFILE'
+# Setting this environment variable to 1 also records the peak memory of each stage.
+MEMORY_ENV_VAR = 'FEP_ANALYSIS_PROFILE_MEMORY'
+DEFAULT_TRACE = 'profile.json'
+
+# The number of maps that are listed in the summary as taking the most time.
+NOUTLIERS = 10
+
+_NULL = contextlib.nullcontext()
+
+
+class Profiler:
+    """
+    Records the wall time, CPU time, number of calls and, if requested, the peak allocated memory of named stages,
+    optionally per map. Stages can be nested; the time and memory of a stage include those of the stages inside it.
+    """
+
+    def __init__(self, trace_path=DEFAULT_TRACE, memory=False):
+        """
+        Parameters
+        ----------
+        trace_path: str
+            The JSON file that the trace and summary are written to at exit.
+        memory: bool
+            Whether to trace memory allocations with tracemalloc. This slows down Python code several times more than
+            numpy code, so the times of a profile with memory are not comparable between stages.
+        """
+        self.trace_path = trace_path
+        self.memory = memory
+        self.origin = time.perf_counter()
+        self.events = []
+        self.totals = {}
+        self._stack = []
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name, map=None):
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if len(self._stack) > 0:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+        frame = {'start memory': current, 'peak': current}
+        self._stack.append(frame)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            self._stack.pop()
+            if self.memory:
+                frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                if len(self._stack) > 0:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'], frame['peak'])
+            self._record(name, map, wall, cpu, frame['peak'] - frame['start memory'])
+
+    def _record(self, name, map, wall, cpu, peak):
+        end = time.perf_counter() - self.origin
+        event = {'name': name, 'ph': 'X', 'ts': 1e6 * (end - wall), 'dur': 1e6 * wall, 'pid': os.getpid(), 'tid': 0,
+                 'args': {'cpu (s)': cpu}}
+        if self.memory:
+            event['args']['peak memory (MB)'] = peak / 2 ** 20
+        if map is not None:
+            event['args']['map'] = map
+        self.events.append(event)
+
+        total = self.totals.setdefault((name, map), {'calls': 0, 'wall (s)': 0., 'cpu (s)': 0.})
+        total['calls'] += 1
+        total['wall (s)'] += wall
+        total['cpu (s)'] += cpu
+        if self.memory:
+            total['peak memory (MB)'] = max(total.get('peak memory (MB)', 0.), peak / 2 ** 20)
+
+    def _columns(self):
+        return ['wall (s)', 'cpu (s)'] + (['peak memory (MB)'] if self.memory else [])
+
+    def _rows(self):
+        return [dict(stage=name, map=map, **total) for (name, map), total in self.totals.items()]
+
+    def table(self):
+        """
+        The totals of every stage and map, with one row per (stage, map).
+        """
+        return pd.DataFrame(self._rows(), columns=['stage', 'map', 'calls'] + self._columns())
+
+    def summary(self):
+        """
+        The totals of every stage over all maps, and the maps that took the most wall time summed over their stages.
+        Stages nested in other stages of the same map would be counted twice, so only the outermost stage of each map is
+        used for the ranking.
+        """
+        df = self.table()
+        stages = df.groupby('stage', sort=False).agg({'calls': 'sum', 'wall (s)': 'sum', 'cpu (s)': 'sum',
+                                                      **({'peak memory (MB)': 'max'} if self.memory else {})})
+        per_map = df.loc[df['map'].notna()]
+        outer = per_map.loc[per_map.groupby('map')['wall (s)'].idxmax()]
+        maps = outer.set_index('map')[['stage'] + self._columns()]
+        return stages, maps.sort_values('wall (s)', ascending=False)
+
+    def report(self):
+        """
+        Write the JSON trace, which can be opened in chrome://tracing or Perfetto, and print the summary tables.
+        """
+        stages, maps = self.summary()
+        with open(self.trace_path, 'w') as f:
+            json.dump({'traceEvents': self.events,
+                       'totals': self._rows()}, f, allow_nan=False)
+        with pd.option_context('display.width', 200, 'display.max_columns', None,
+                               'display.float_format', '{:.3f}'.format):
+            print()
+            print('Profile by stage')
+            print(stages)
+            if len(maps) > 0:
+                print()
+                print(f'The {min(NOUTLIERS, len(maps))} slowest maps')
+                print(maps.head(NOUTLIERS))
+        print(f'Profile trace written to {self.trace_path}')
+
+
+_profiler = None
+
+
+def enable(trace_path=DEFAULT_TRACE, memory=False):
+    """
+    Start profiling, and report the profile when the program exits. The peak memory of each stage is only recorded if
+    memory is True.
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(trace_path, memory)
+        atexit.register(_profiler.report)
+    return _profiler
+
+
+def is_enabled():
+    return _profiler is not None
+
+
+def stage(name, map=None):
+    """
+    A context manager that profiles a stage of the analysis, optionally of one map. When profiling is disabled it does
+    nothing.
+
+    Parameters
+    ----------
+    name: str
+        The name of the stage, e.g. 'deserialize'.
+    map: str
+        The name of the map (or comparison) that the stage processes.
+    """
+    if _profiler is None:
+        return _NULL
+    return _profiler.stage(name, map)
+
+
+def profiled(name):
+    """
+    A decorator that profiles every call of a function as a stage.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_profile_argument(parser):
+    """
+    Add the --profile and --profile-memory options to the argument parser of a script.
+    """
+    parser.add_argument('--profile', type=str, nargs='?', const=DEFAULT_TRACE, default=None, metavar='JSON',
+                        help=f"Record the time of each stage and map, print a summary and write a trace to a JSON "
+                             f"file at exit, default={DEFAULT_TRACE}. Profiling can also be enabled by setting the "
+                             f"{ENV_VAR} environment variable to the name of the JSON file.")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help=f"With --profile, also record the peak memory of each stage and map with tracemalloc, "
+                             f"which slows down Python code much more than numpy code, so profile the time without "
+                             f"it. Can also be enabled by setting the {MEMORY_ENV_VAR} environment variable to 1.")
+
+
+def setup(args):
+    """
+    Enable profiling if it was requested with the --profile option or the environment variable, with memory if it
+    was requested with the --profile-memory option or its environment variable.
+    """
+    path = getattr(args, 'profile', None)
+    if path is None and os.environ.get(ENV_VAR):
+        path = os.environ[ENV_VAR]
+        if path == '1':
+            path = DEFAULT_TRACE
+    memory = getattr(args, 'profile_memory', False) or os.environ.get(MEMORY_ENV_VAR) == '1'
+    if path is not None:
+        enable(path, memory)
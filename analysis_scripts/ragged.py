@@ -0,0 +1,179 @@
+import numpy as np
+from scipy import stats
+
+# Kendall's tau of maps with more ligands than this is calculated one map at a time with scipy, instead of forming all
+# of their pairs at once.
+MAX_PAIRED_SIZE = 2000
+
+
+def segment_sum(values, offsets):
+    """
+    The sum of the values of each segment, where segment i is values[offsets[i]:offsets[i + 1]]. Empty segments sum to
+    zero, which np.add.reduceat does not do on its own.
+    """
+    values = np.asarray(values)
+    counts = np.diff(offsets)
+    out = np.zeros(len(counts), dtype=np.result_type(values.dtype, float))
+    nonempty = counts > 0
+    if np.any(nonempty):
+        out[nonempty] = np.add.reduceat(values, offsets[:-1][nonempty])
+    return out
+
+
+def pair_indices(offsets, segments=None):
+    """
+    The indices of every pair of elements i < j in the same segment, in the order of itertools.combinations within
+    each segment and with the segments in order.
+
+    Parameters
+    ----------
+    offsets: numpy.ndarray
+        The start of each segment and the end of the last.
+    segments: numpy.ndarray
+        The segments to pair, default=all.
+
+    Returns
+    -------
+    i: numpy.ndarray
+        The index of the first element of each pair.
+    j: numpy.ndarray
+        The index of the second element of each pair.
+    pair_offsets: numpy.ndarray
+        The offsets of the pairs of each of the segments.
+    """
+    offsets = np.asarray(offsets)
+    if segments is None:
+        segments = np.arange(len(offsets) - 1)
+    counts = np.diff(offsets)[segments]
+    npairs = counts * (counts - 1) // 2
+    pair_offsets = np.concatenate(([0], np.cumsum(npairs)))
+    i = np.empty(pair_offsets[-1], dtype=np.int64)
+    j = np.empty(pair_offsets[-1], dtype=np.int64)
+    # The pairs of all the segments of the same size are made at once.
+    for n in np.unique(counts[npairs > 0]):
+        same = np.flatnonzero(counts == n)
+        iu, ju = np.triu_indices(n, 1)
+        rows = pair_offsets[same][:, np.newaxis] + np.arange(len(iu))
+        starts = offsets[segments[same]][:, np.newaxis]
+        i[rows] = starts + iu
+        j[rows] = starts + ju
+    return i, j, pair_offsets
+
+
+class RaggedMaps:
+    """
+    Two data series (e.g. predicted and experimental binding free energies) of many maps, stored as two flat arrays
+    and the offsets of the maps in them. The statistics of every map are calculated at once with segment reductions,
+    without a Python loop over the maps, which matters when there are many small maps.
+
+    As in helper_functions, x is the first data series, y is the second and the errors are y - x.
+    """
+
+    def __init__(self, x, y, offsets):
+        """
+        Parameters
+        ----------
+        x: numpy.ndarray
+            The first data series of every map, one after another.
+        y: numpy.ndarray
+            The second data series, with the same length as x.
+        offsets: numpy.ndarray
+            The start of each map in x and y and the end of the last.
+        """
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if len(self.x) != len(self.y) or self.offsets[-1] != len(self.x):
+            raise Exception('Length of inputs do not match')
+        self.counts = np.diff(self.offsets)
+        self.ids = np.repeat(np.arange(len(self.counts)), self.counts)
+
+    @classmethod
+    def from_series(cls, xs, ys):
+        """
+        Make the ragged arrays from a list of the data series of each map.
+        """
+        counts = [len(x) for x in xs]
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        def flat(series):
+            return np.concatenate([np.asarray(s, dtype=float) for s in series]) if len(series) > 0 else np.zeros(0)
+        return cls(flat(xs), flat(ys), offsets)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def mean(self, values):
+        """
+        The mean of a flat array of values over each map.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return segment_sum(values, self.offsets) / self.counts
+
+    def centered(self, values):
+        """
+        The values minus the mean of their map.
+        """
+        return values - self.mean(values)[self.ids]
+
+    def absolute_rmse(self):
+        return np.sqrt(self.mean((self.y - self.x) ** 2))
+
+    def absolute_mue(self):
+        return self.mean(np.abs(self.y - self.x))
+
+    def pairwise_rmse(self):
+        """
+        The pairwise RMSE of each map from the variance of its errors, sqrt(2 var(e)) with n - 1 degrees of freedom, as
+        in fast_stats.pairwise_rmse.
+        """
+        de = self.centered(self.y - self.x)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(2 * segment_sum(de ** 2, self.offsets) / (self.counts - 1))
+
+    def pairwise_mue(self):
+        """
+        The pairwise MUE of each map from its sorted errors, as in fast_stats.pairwise_mue. The errors are sorted
+        within each map at once, and the k-th smallest of a map of n has the coefficient 2k - n + 1.
+        """
+        e = self.y - self.x
+        order = np.lexsort((e, self.ids))
+        k = np.arange(len(e)) - self.offsets[self.ids]
+        coeffs = 2 * k - self.counts[self.ids] + 1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return segment_sum(coeffs * e[order], self.offsets) / (self.counts * (self.counts - 1) / 2)
+
+    def r_squared(self):
+        """
+        The square of the Pearson correlation coefficient of each map.
+        """
+        dx = self.centered(self.x)
+        dy = self.centered(self.y)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return segment_sum(dx * dy, self.offsets) ** 2 / (segment_sum(dx ** 2, self.offsets) *
+                                                               segment_sum(dy ** 2, self.offsets))
+
+    def kendall_tau(self):
+        """
+        Kendall's tau-b of each map, as calculated by scipy.stats.kendalltau. The signs of the differences of all the
+        pairs of every map up to MAX_PAIRED_SIZE are summed at once.
+        """
+        taus = np.full(len(self), np.nan)
+        small = np.flatnonzero(self.counts <= MAX_PAIRED_SIZE)
+        i, j, pair_offsets = pair_indices(self.offsets, small)
+        sx = np.sign(self.x[i] - self.x[j])
+        sy = np.sign(self.y[i] - self.y[j])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            taus[small] = segment_sum(sx * sy, pair_offsets) / np.sqrt(segment_sum(sx ** 2, pair_offsets) *
+                                                                       segment_sum(sy ** 2, pair_offsets))
+        for s in np.flatnonzero(self.counts > MAX_PAIRED_SIZE):
+            start, end = self.offsets[s], self.offsets[s + 1]
+            taus[s] = stats.kendalltau(self.x[start:end], self.y[start:end]).correlation
+        return taus
+
+    def pairwise_diffs(self):
+        """
+        The pairwise errors (y_i - y_j) - (x_i - x_j) of every map, in the same order as
+        helper_functions.get_pairwise_diffs applied to each map in turn.
+        """
+        i, j, pair_offsets = pair_indices(self.offsets)
+        return (self.y[i] - self.y[j]) - (self.x[i] - self.x[j])
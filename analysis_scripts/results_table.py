@@ -0,0 +1,174 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def group_of(path):
+    """
+    The group of a results file, which is the name of the directory that contains it.
+    """
+    return os.path.basename(os.path.dirname(path))
+
+
+class ResultsTable(dict):
+    """
+    The per-map results of a benchmark or survey, stored as the columns of one numpy structured array with one row per
+    map. It is a dictionary of the columns, as returned by the parse functions before, but the values are views of the
+    structured array, so changing an element of a column (e.g. results['number of compounds'][i] -= 1) changes the
+    table. The group of every row is kept alongside the columns, with indexes of the rows of every group and entry.
+
+    The rows of a group are selected without copying when they are contiguous, as they are when the files are read
+    group by group.
+    """
+
+    def __init__(self, data, groups=None):
+        """
+        Parameters
+        ----------
+        data: numpy.ndarray
+            A structured array with a field for every column, including 'entries'.
+        groups: list-like of str
+            The group of each row, default=no group.
+        """
+        super().__init__((name, data[name]) for name in data.dtype.names)
+        self.data = data
+        self.groups = np.asarray(groups if groups is not None else [''] * len(data), dtype=str)
+        self._group_index = None
+        self._entry_index = None
+
+    @classmethod
+    def from_columns(cls, columns, groups=None):
+        """
+        Make a table from a dictionary of equal length list-like columns. The type of each column is the type numpy
+        gives it, e.g. integers for the numbers of compounds and fixed length strings for the entries.
+        """
+        arrays = {name: np.asarray(values) for name, values in columns.items()}
+        nrows = len(next(iter(arrays.values()))) if len(arrays) > 0 else 0
+        data = np.empty(nrows, dtype=[(name, a.dtype) for name, a in arrays.items()])
+        for name, a in arrays.items():
+            data[name] = a
+        return cls(data, groups)
+
+    @classmethod
+    def from_records(cls, records, groups=None, columns=None):
+        """
+        Make a table from one dictionary of values per row, such as the metrics of parse_fep_map.
+
+        Parameters
+        ----------
+        records: list of dict
+            The values of each row.
+        groups: list-like of str
+            The group of each row.
+        columns: list of str
+            The columns of the table, default=the keys of the first record. Needed if there may be no records.
+        """
+        if columns is None:
+            columns = list(records[0]) if len(records) > 0 else []
+        return cls.from_columns({c: [r[c] for r in records] for c in columns}, groups)
+
+    @classmethod
+    def from_frame(cls, df, groups=None):
+        """
+        Make a table from a data frame, e.g. a {group}_results.csv file.
+        """
+        return cls.from_columns({c: df[c].values for c in df.columns}, groups)
+
+    @property
+    def nrows(self):
+        return len(self.data)
+
+    @property
+    def group_index(self):
+        """
+        The rows of each group: a slice if they are contiguous and an array of row numbers otherwise.
+        """
+        if self._group_index is None:
+            self._group_index = {}
+            for g in dict.fromkeys(self.groups):
+                rows = np.flatnonzero(self.groups == g)
+                contiguous = rows[-1] - rows[0] + 1 == len(rows)
+                self._group_index[g] = slice(rows[0], rows[-1] + 1) if contiguous else rows
+        return self._group_index
+
+    @property
+    def entry_index(self):
+        """
+        The row of each entry.
+        """
+        if self._entry_index is None:
+            self._entry_index = {e: i for i, e in enumerate(self.data['entries'])}
+        return self._entry_index
+
+    def group(self, name):
+        """
+        The table of the maps of one group, which shares its data with this table if the group's rows are contiguous.
+        """
+        rows = self.group_index[name]
+        return ResultsTable(self.data[rows], self.groups[rows])
+
+    def entry(self, name):
+        """
+        The row of one entry. Changing a field of the row changes the table.
+        """
+        return self.data[self.entry_index[name]]
+
+    def select(self, entries):
+        """
+        The table of a list of entries, in the order given.
+        """
+        rows = np.array([self.entry_index[e] for e in entries], dtype=int)
+        return ResultsTable(self.data[rows], self.groups[rows])
+
+    def to_frame(self, group_column=None):
+        """
+        The table as a data frame, optionally with the group of each row in a column.
+        """
+        df = pd.DataFrame(self)
+        if group_column is not None:
+            df.insert(0, group_column, self.groups)
+        return df
+
+    def join(self, metadata, columns=None, left_on='entries', right_on='Output file naming scheme', group_on=None):
+        """
+        Look up columns of a metadata table, such as ../21_4_results/benchmark_output_metadata.csv, for every row.
+
+        Parameters
+        ----------
+        metadata: pandas.DataFrame
+            The metadata table. If a key appears in more than one row, the first row is used.
+        columns: list of str
+            The columns of the metadata to look up, default=all except the keys.
+        left_on: str
+            The column of this table to match.
+        right_on: str
+            The column of the metadata to match.
+        group_on: str
+            The column of the metadata to match to the group of each row as well, e.g. 'Group abbreviation'. If None,
+            the rows are matched by right_on only.
+
+        Returns
+        -------
+        joined: dict of numpy.ndarray
+            The values of each metadata column for each row, which are missing (None or NaN) for the rows that are not
+            in the metadata.
+        """
+        keys = [right_on] if group_on is None else [group_on, right_on]
+        metadata = metadata.drop_duplicates(keys)
+        if columns is None:
+            columns = [c for c in metadata.columns if c not in keys]
+        if group_on is None:
+            inds = pd.Index(metadata[right_on]).get_indexer(self[left_on])
+        else:
+            index = pd.MultiIndex.from_arrays([metadata[group_on], metadata[right_on]])
+            inds = index.get_indexer(pd.MultiIndex.from_arrays([self.groups, self[left_on]]))
+        found = inds >= 0
+        joined = {}
+        for c in columns:
+            values = metadata[c].values
+            column = np.full(len(inds), np.nan if values.dtype.kind == 'f' else None,
+                             dtype=values.dtype if values.dtype.kind == 'f' else object)
+            column[found] = values[inds[found]]
+            joined[c] = column
+        return joined
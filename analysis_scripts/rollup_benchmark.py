@@ -0,0 +1,312 @@
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+import fast_stats as fs
+import fep_benchmark as fb
+import process_fep_benchmark as pfb
+import profiling as prof
+import results_table as rt
+
+DEFAULT_METADATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '21_4_results',
+                                'benchmark_output_metadata.csv')
+DEFAULT_MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fep_benchmark_inputs',
+                                'fep_plus_inputs', 'corrections_manifest.json')
+
+# The corrections of the steps of the correction manifest. Removing the incomplete edges is not a correction type.
+STEP_CORRECTIONS = {'pKa': {'pka', 'solvent_pka'},
+                    'binding mode': {'binding_mode'},
+                    'symmetry': {'symmetry'}}
+
+# The corrections that are marked in the output file names, e.g. jak2_set1_pkacorr_bmcorr_out, for the maps that are
+# not in the correction manifest. A 'sym' prefix marks the symmetry correction. The 'sb' prefix of
+# a2a_hip278_sbpkacorr_out marks the symmetry and binding mode corrections (see gpcrs/run_a2a_corrs.sh in the FEP+
+# inputs), but that of throm_nozob_hip75_sbmcorr_out does not, as that map only has a binding mode correction.
+CORRECTIONS = {'pKa': r'(sym|sb)?pkacorr?',
+               'binding mode': r'(sym|s)?bmcorr?|sbpkacorr?',
+               'symmetry': r'sym\w*corr?|sbpkacorr?'}
+
+# The edges of the bins of the number of compounds of each map.
+MAP_SIZE_BINS = (0, 10, 20, 40, np.inf)
+
+# The statistics of the roll-ups: the column of the results, whether it is combined as a root-mean-square and the
+# column of its weights.
+STATISTICS = {'Pairwise RMSE': (True, 'number of compounds'),
+              'Pairwise MUE': (False, 'number of compounds'),
+              'Edgewise RMSE': (True, 'number of edges'),
+              'Edgewise MUE': (False, 'number of edges'),
+              'R-squared': (False, 'number of compounds'),
+              'Kendall tau': (False, 'number of compounds')}
+
+
+def manifest_corrections(path=DEFAULT_MANIFEST):
+    """
+    The corrections of every map of a correction manifest of the FEP+ inputs.
+
+    Returns
+    -------
+    corrections: dict
+        For each group, the corrections by the output file name of each map ('outputs', in which the input file names
+        have no corrections) and by the name of each map ('names').
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    corrections = {}
+    for group, entry in manifest['groups'].items():
+        outputs, names = {}, {}
+        for m in entry['maps']:
+            steps = {step['type'] for step in m.get('steps', [])}
+            found = [c for c, types in STEP_CORRECTIONS.items() if len(steps & types) > 0]
+            names[m['name']] = ' + '.join(found) if len(found) > 0 else 'none'
+            for fep_file in m['inputs'] if 'inputs' in m else [m['input']]:
+                outputs[os.path.splitext(os.path.basename(fep_file))[0]] = 'none'
+            outputs[os.path.splitext(os.path.basename(m['output']))[0]] = names[m['name']]
+        corrections[group] = {'outputs': outputs, 'names': names}
+    return corrections
+
+
+def correction_type(entry, group=None, corrections=None):
+    """
+    The corrections of a map, e.g. 'pKa + binding mode'. If its group is in the corrections of the manifest, from
+    manifest_corrections, these are the corrections of the map with the same output or input file name, or else of
+    the map with the longest name that the output file name starts with. Otherwise they are read from the tokens of
+    the output file name.
+    """
+    manifest = corrections.get(group) if corrections is not None else None
+    if manifest is not None:
+        if entry in manifest['outputs']:
+            return manifest['outputs'][entry]
+        prefixes = [name for name in manifest['names'] if entry.startswith(f'{name}_')]
+        if len(prefixes) > 0:
+            return manifest['names'][max(prefixes, key=len)]
+    tokens = entry.split('_')
+    found = [c for c, pattern in CORRECTIONS.items() if any(re.fullmatch(pattern, t) for t in tokens)]
+    return ' + '.join(found) if len(found) > 0 else 'none'
+
+
+def map_size(num_compounds):
+    """
+    The size bin of each map, e.g. '10-19', from its number of compounds.
+    """
+    labels = [f'{int(lo)}+' if np.isinf(hi) else f'{int(lo)}-{int(hi) - 1}'
+              for lo, hi in zip(MAP_SIZE_BINS[:-1], MAP_SIZE_BINS[1:])]
+    return pd.cut(num_compounds, MAP_SIZE_BINS, right=False, labels=labels).astype(str)
+
+
+class BenchmarkRollup:
+    """
+    The weighted statistics of the benchmark for any combination of keys, such as the protein, the correction type or
+    the size of the map, from a single reading of the results. Every map is labelled with its keys once, and the cells
+    of any number of roll-ups are summarized together: the weighted sums of all the cells are one matrix product with
+    the indicator matrix of the cells, and the bootstrap intervals of every cell come from the same replicates.
+
+    Note
+    ----
+    The replicates are Poisson bootstrap weights: each map is given an independent Poisson(1) number of draws in each
+    replicate. Unlike a multinomial resample of all the maps, the draws of the maps of one cell do not depend on the
+    other cells, so the same replicates can be shared by cells of different sizes and overlapping roll-ups. For large
+    cells the intervals match those of resampling the cell on its own; a replicate in which a cell is not drawn at all
+    is left out of its interval.
+    """
+
+    def __init__(self, results, metadata=None, corrections=None):
+        """
+        Parameters
+        ----------
+        results: results_table.ResultsTable
+            The per-map results of the benchmark, with the group of each map.
+        metadata: pandas.DataFrame
+            The output metadata, e.g. ../21_4_results/benchmark_output_metadata.csv, every column of which is a key of
+            each map. If None, only the group and the derived keys are available.
+        corrections: dict
+            The corrections of the maps of the correction manifest, from manifest_corrections. If None, the
+            corrections are read from the output file names.
+        """
+        self.results = results
+        keys = {'Group': results.groups}
+        if metadata is not None:
+            joined = results.join(metadata, group_on='Group abbreviation')
+            keys.update({c: pd.Series(v).fillna('unknown').astype(str).values for c, v in joined.items()})
+        keys['Correction'] = np.array([correction_type(e, g, corrections)
+                                       for e, g in zip(results['entries'], results.groups)])
+        keys['Map size'] = np.asarray(map_size(results['number of compounds']))
+        self.keys = pd.DataFrame(keys)
+        self.statistics = [s for s, (rms, weight) in STATISTICS.items() if s in results and weight in results]
+
+    def cells(self, rollups):
+        """
+        The cells of every roll-up.
+
+        Parameters
+        ----------
+        rollups: list of list of str
+            The keys of each roll-up, e.g. [['Protein'], ['Correction', 'Map size']]. An empty list is the whole
+            benchmark.
+
+        Returns
+        -------
+        cells: pandas.DataFrame
+            One row per cell, with the roll-up ('Roll-up', its keys joined by ' x ') and the value of every key.
+        indicator: numpy.ndarray
+            An array of shape (nmaps, ncells) that is 1 where a map is in a cell.
+        """
+        frames, columns = [], []
+        for by in rollups:
+            unknown = [k for k in by if k not in self.keys]
+            if len(unknown) > 0:
+                raise KeyError(f'Unknown keys {unknown}, the keys are {list(self.keys.columns)}.')
+            labels = self.keys[list(by)] if len(by) > 0 else pd.DataFrame(index=self.keys.index)
+            codes = labels.groupby(list(by), sort=True).ngroup().values if len(by) > 0 else np.zeros(len(labels),
+                                                                                                     dtype=int)
+            first = np.unique(codes, return_index=True)[1]
+            cells = labels.iloc[first].reset_index(drop=True)
+            cells.insert(0, 'Roll-up', ' x '.join(by) if len(by) > 0 else 'All')
+            frames.append(cells)
+            columns.append(codes[:, np.newaxis] == np.arange(len(first)))
+        return pd.concat(frames, ignore_index=True), np.hstack(columns).astype(float)
+
+    def bootstrap_weights(self, nboots=10000, seed=None):
+        """
+        The Poisson bootstrap replicates, as an array of shape (nboots, nmaps) with the number of draws of each map.
+        """
+        rng = np.random.default_rng(seed)
+        return rng.poisson(1., size=(nboots, self.results.nrows)).astype(float)
+
+    def summarize(self, rollups, nboots=10000, seed=None):
+        """
+        The weighted statistics of every cell of every roll-up, with bootstrap intervals. Each map is weighted by its
+        number of compounds (or edges, for the edgewise statistics); RMSEs are combined as the weighted
+        root-mean-square and the other statistics as the weighted mean, as in analysis_functions.summarize_fep_error.
+
+        Parameters
+        ----------
+        rollups: list of list of str
+            The keys of each roll-up, as for cells.
+        nboots: int
+            The number of bootstrap replicates.
+        seed: int
+            The seed of the random number generator.
+
+        Returns
+        -------
+        summary: pandas.DataFrame
+            One row per cell with the numbers of maps, compounds and edges (if any), and the value and the 2.5% and
+            97.5% bootstrap limits of each statistic.
+        """
+        cells, indicator = self.cells(rollups)
+        replicates = self.bootstrap_weights(nboots, seed)
+        summary = cells.copy()
+        summary['number of maps'] = indicator.sum(axis=0).astype(int)
+        for weight in ('number of compounds', 'number of edges'):
+            if weight in self.results:
+                summary[weight] = (np.asarray(self.results[weight], dtype=float) @ indicator).astype(int)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for stat in self.statistics:
+                rms, weight = STATISTICS[stat]
+                num = np.asarray(self.results[weight], dtype=float)
+                values = np.asarray(self.results[stat], dtype=float)
+                values = values ** 2 if rms else values
+                # The first row is the full sample and the others are the replicates.
+                w = np.vstack([num, replicates * num])
+                totals = (w * values) @ indicator / (w @ indicator)
+                totals = np.sqrt(totals) if rms else totals
+                summary[stat] = totals[0]
+                limits = np.array([fs.interval(totals[1:, c]) if np.any(np.isfinite(totals[1:, c]))
+                                   else (np.nan, np.nan) for c in range(len(cells))]).reshape(-1, 2)
+                summary[f'{stat} lower'], summary[f'{stat} upper'] = limits[:, 0], limits[:, 1]
+        return summary
+
+
+def main(argv=None):
+    usage = """
+    The script reads the FMP or CSV files of the benchmark once and summarizes them for any number of groupings of the
+    maps, which are given with --by as comma separated keys. The keys are the group directory ('Group'), the columns
+    of the output metadata (e.g. 'Group name', 'Protein' and 'Reference PDB'), the corrections of the correction
+    manifest of the FEP+ inputs, or of the output file names of the maps that are not in it ('Correction'), and the
+    size of the map ('Map size'). For example
+
+        > python rollup_benchmark.py ../21_4_results/ligand_predictions -e csv --by Protein --by Correction "Map size" --by Group,Correction -o rollups.csv
+
+    makes a table of the statistics of every protein, of every correction type, of every map size and of every
+    correction type within each group, with a row for the whole benchmark. As in process_fep_benchmark.py, the ligands
+    of the thrombin water displacement map that are in the thrombin JACS set map are only counted once.
+    """
+    description = """
+    Summarize the FEP+ benchmark by any combination of the metadata of the maps.
+    """
+    parser = argparse.ArgumentParser(usage=usage, description=description)
+    parser.add_argument(
+        'upper_dir',
+        type=str,
+        help="The upper directory with a subdirectory of FMP or CSV files for each group.")
+    parser.add_argument(
+        '-e',
+        '--ext',
+        type=str,
+        choices=['fmp', 'csv'],
+        help="The file extension of the results. Results can be either FMP files or CSVs.")
+    parser.add_argument(
+        '--by',
+        type=str,
+        nargs='+',
+        action='append',
+        default=[],
+        help="The keys of a roll-up, separated by commas. Can be given several times, and each of several values "
+             "given at once is a separate roll-up.")
+    parser.add_argument(
+        '-m',
+        '--metadata',
+        type=str,
+        default=DEFAULT_METADATA,
+        help="The CSV file with the output metadata, default=../21_4_results/benchmark_output_metadata.csv.")
+    parser.add_argument(
+        '--manifest',
+        type=str,
+        default=DEFAULT_MANIFEST,
+        help="The correction manifest of the FEP+ inputs, "
+             "default=../fep_benchmark_inputs/fep_plus_inputs/corrections_manifest.json.")
+    parser.add_argument(
+        '-o',
+        '--output',
+        type=str,
+        help="The CSV file of the roll-ups. If not given, the roll-ups are printed.")
+    parser.add_argument(
+        '--nboots',
+        type=int,
+        default=10000,
+        help="The number of bootstrap replicates, default=10000.")
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help="The seed of the bootstrap replicates.")
+    prof.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+    prof.setup(args)
+
+    with prof.stage('load'):
+        session = fb.BenchmarkSession(args.upper_dir, args.ext)
+        results = session.results()
+        results = rt.ResultsTable(results.data.copy(), results.groups)
+        pfb.correct_thrombin_overlap(results)
+        metadata = pd.read_csv(args.metadata) if args.metadata is not None else None
+        corrections = manifest_corrections(args.manifest) if args.manifest is not None else None
+        rollup = BenchmarkRollup(results, metadata, corrections)
+
+    rollups = [[]] + [[k.strip() for k in value.split(',')] for values in args.by for value in values]
+    with prof.stage('rollup'):
+        summary = rollup.summarize(rollups, args.nboots, args.seed)
+    if args.output is not None:
+        summary.to_csv(args.output, index=False, float_format='%.2f')
+    else:
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200,
+                               'display.float_format', '{:.2f}'.format):
+            print(summary.fillna('').to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+import argparse
+import hashlib
+import importlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import analysis_functions as af
+import distribution_fit as dfit
+import incremental as inc
+import process_fep_benchmark as pfb
+import profiling as prof
+import results_table as rt
+import write_group_summary_tables as wgst
+
+# Bump this when the contents of the partial results change.
+PARTIAL_VERSION = 1
+
+# The environment variable with the task index of a job array, and the variable with the first index of the array and
+# the first index if it is not set. The default shard is the task index less the first index, so that arrays counted
+# from 1, as they are by SGE and LSF, start with shard 0. Other schedulers need the shard to be given with --shard.
+TASK_ID_VARS = {'SLURM_ARRAY_TASK_ID': ('SLURM_ARRAY_TASK_MIN', 0),
+                'SGE_TASK_ID': ('SGE_TASK_FIRST', 1),
+                'LSB_JOBINDEX': (None, 1)}
+
+
+def list_maps(upper_dir, ext):
+    """
+    The paths of all the maps relative to upper_dir, as group/file, in the order that process_fep_benchmark.py reads
+    them.
+    """
+    groups = inc.find_group_files(upper_dir, ext)
+    return sorted(os.path.relpath(f, upper_dir) for files in groups.values() for f in files)
+
+
+def shard_maps(maps, shard, nshards):
+    """
+    The maps of one shard. The maps are dealt out in turn, so every shard gets maps from every group.
+    """
+    if not 0 <= shard < nshards:
+        raise ValueError(f'The shard must be between 0 and {nshards - 1}, not {shard}.')
+    return maps[shard::nshards]
+
+
+def map_partial(path, ext, width=0.05, limit=10.):
+    """
+    Calculate everything that the merge needs from one map: its metrics, the sufficient statistics of its pairwise
+    errors and their histogram on the grid of distribution_fit.grid_counts.
+    """
+    if ext == 'fmp':
+        metrics, diffs, uncertainties = af.parse_fep_map(path)
+    else:
+        metrics, diffs = af.parse_fep_csv(path)
+    diffs = np.asarray(diffs, dtype=float)
+    abs_diffs = np.abs(diffs)
+    metrics = {k: v.item() if isinstance(v, np.generic) else v for k, v in metrics.items()}
+    return {'metrics': metrics,
+            'pairs': {'number': len(diffs),
+                      'sum of squares': float(np.sum(diffs ** 2)),
+                      'sum of absolute values': float(np.sum(abs_diffs)),
+                      'number less than 1': int(np.sum(abs_diffs < 1)),
+                      'number greater than 2': int(np.sum(abs_diffs > 2)),
+                      'largest absolute value': float(np.max(abs_diffs)) if len(diffs) > 0 else 0.,
+                      'histogram': dfit.grid_counts(diffs, width, limit).tolist()}}
+
+
+def write_partial(upper_dir, ext, shard, nshards, path):
+    """
+    Process the maps of one shard and write the partial results to a JSON file.
+    """
+    maps = list_maps(upper_dir, ext)
+    partial = {'version': PARTIAL_VERSION, 'ext': ext, 'shard': shard, 'nshards': nshards,
+               'all maps': hashlib.sha256('\n'.join(maps).encode()).hexdigest(), 'number of maps': len(maps),
+               'maps': {}}
+    for name in shard_maps(maps, shard, nshards):
+        with prof.stage('map', name):
+            partial['maps'][name] = map_partial(os.path.join(upper_dir, name), ext)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(partial, f)
+    os.replace(tmp, path)
+    return partial
+
+
+def read_partials(paths):
+    """
+    Read and check the partial results of every shard.
+
+    Returns
+    -------
+    ext: str
+        The file extension of the results.
+    maps: dict
+        The partial results of every map, by the path of the map relative to the upper directory, in sorted order.
+    """
+    partials = []
+    for path in paths:
+        with open(path) as f:
+            partials.append(json.load(f))
+    first = partials[0]
+    for p in partials:
+        if p['version'] != PARTIAL_VERSION:
+            raise Exception(f'Partial results of version {p["version"]} cannot be merged, rerun the shards.')
+        if (p['ext'], p['nshards'], p['all maps']) != (first['ext'], first['nshards'], first['all maps']):
+            raise Exception('The partial results come from different directories, file types or numbers of shards.')
+    shards = sorted(p['shard'] for p in partials)
+    if shards != list(range(first['nshards'])):
+        missing = sorted(set(range(first['nshards'])) - set(shards))
+        raise Exception(f'Shards {missing} are missing' if missing else f'Some shards are repeated: {shards}')
+    maps = {}
+    for p in partials:
+        maps.update(p['maps'])
+    if len(maps) != first['number of maps']:
+        raise Exception(f'The partial results have {len(maps)} of {first["number of maps"]} maps.')
+    return first['ext'], dict(sorted(maps.items()))
+
+
+def _results(maps):
+    return rt.ResultsTable.from_records([m['metrics'] for m in maps.values()], [os.path.dirname(n) for n in maps])
+
+
+def merge(maps, ext, seed=None, outdir='.', fit_seed=0):
+    """
+    Combine the partial results of the maps into the group tables of write_group_summary_tables.py, the benchmark
+    summary of process_fep_benchmark.py and the pairwise error distribution statistics of
+    generate_boxplots_and_histograms.py. With the same seed, these are the same as those of the single process scripts.
+    """
+    table = _results(maps)
+    edges = ext == 'fmp'
+    group_summaries = []
+    os.makedirs(outdir, exist_ok=True)
+    for group in sorted(table.group_index):
+        results = table.group(group)
+        inc.atomic_to_csv(pd.DataFrame(results), os.path.join(outdir, f'{group}_results.csv'), index=False,
+                          float_format='%.2f')
+        if seed is not None:
+            np.random.seed(seed)
+        group_summaries.append(wgst._group_summary(group, results, af.summarize_fep_error(results, verbose=False),
+                                                   edges))
+    inc.atomic_to_csv(wgst.summary_table(group_summaries, edges), os.path.join(outdir, 'group_summaries.csv'),
+                      index=False, float_format='%.2f')
+
+    # The group tables share their data with the table of all the maps, which is only corrected after they are written.
+    results = table
+    pfb.correct_thrombin_overlap(results)
+    if seed is not None:
+        np.random.seed(seed)
+    print('FEP+ benchmark summary')
+    print('-----------------------')
+    af.summarize_fep_error(results)
+    print()
+
+    pairs = [m['pairs'] for m in maps.values()]
+    total = sum(p['number'] for p in pairs)
+    print('FEP pairwise error distribution stats:')
+    print('--------------------------------------')
+    af.print_error_diff_counts(total, sum(p['number less than 1'] for p in pairs),
+                               sum(p['number greater than 2'] for p in pairs))
+    print(f'Pooled pairwise RMSE = {np.sqrt(sum(p["sum of squares"] for p in pairs) / total):.2f} kcal/mol, '
+          f'MUE = {sum(p["sum of absolute values"] for p in pairs) / total:.2f} kcal/mol')
+    print()
+    print('Normal and t-distributions fitted to the symmetrized differences by binned maximum likelihood:')
+    counts = np.sum([p['histogram'] for p in pairs], axis=0)
+    bin_edges, raw = dfit.trim_counts(counts, max(p['largest absolute value'] for p in pairs))
+    dfit.print_fits(dfit.fit_binned(bin_edges, raw, seed=fit_seed))
+    print()
+    print('Median pairwise RMSE from assays: {:.2f} kcal/mol'.format(np.percentile(results['Pairwise RMSE'], 50)))
+    print()
+
+
+def _default_shard():
+    for var, (first_var, first) in TASK_ID_VARS.items():
+        if os.environ.get(var, '').isdigit():
+            if os.environ.get(first_var or '', '').isdigit():
+                first = int(os.environ[first_var])
+            return int(os.environ[var]) - first
+    return None
+
+
+def main(argv=None):
+    usage = """
+    The analysis of the benchmark can be split over several processes, e.g. the tasks of a job array on a cluster. Each
+    shard reads a fixed share of the maps (in the same directory structure as process_fep_benchmark.py) and writes their
+    partial results to a JSON file:
+
+        > $SCHRODINGER/run python3 shard_benchmark.py shard upper_dir -e fmp -k 0 -n 8 -o partial_0.json
+
+    In a SLURM, SGE or LSF job array, the shard defaults to the task index counted from the first task of the array,
+    so an array of tasks 1-8 runs shards 0-7. With other schedulers, the shard is given with -k. Locally, the shards
+    can be run as background processes:
+
+        > for k in 0 1 2 3; do python shard_benchmark.py shard ../21_4_results/ligand_predictions -e csv -k $k -n 4 -o partial_$k.json & done; wait
+
+    When all the shards have finished, the partial results are merged into the group tables, the benchmark summary and
+    the pairwise error statistics:
+
+        > python shard_benchmark.py merge partial_*.json --seed 0
+
+    With the same seed, the results are the same as those of write_group_summary_tables.py and process_fep_benchmark.py.
+    """
+    description = """
+    Process the FEP+ benchmark in shards and merge their results.
+    """
+    parser = argparse.ArgumentParser(usage=usage, description=description)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    shard = subparsers.add_parser('shard', help="Process one shard of the maps.")
+    shard.add_argument(
+        'upper_dir',
+        type=str,
+        help="The upper directory with a subdirectory of FMP or CSV files for each group.")
+    shard.add_argument(
+        '-e',
+        '--ext',
+        type=str,
+        choices=['fmp', 'csv'],
+        help="The file extension of the results. Results can be either FMP files or CSVs.")
+    shard.add_argument(
+        '-k',
+        '--shard',
+        type=int,
+        default=_default_shard(),
+        help="The index of the shard, from 0 to nshards - 1, default=the task index of the job array.")
+    shard.add_argument(
+        '-n',
+        '--nshards',
+        type=int,
+        required=True,
+        help="The number of shards.")
+    shard.add_argument(
+        '-o',
+        '--output',
+        type=str,
+        help="The JSON file of the partial results, default=partial_{shard}_of_{nshards}.json.")
+    prof.add_profile_argument(shard)
+
+    merge_parser = subparsers.add_parser('merge', help="Merge the partial results of all the shards.")
+    merge_parser.add_argument(
+        'partials',
+        type=str,
+        nargs='+',
+        help="The JSON files of the partial results of every shard.")
+    merge_parser.add_argument(
+        '-o',
+        '--outdir',
+        type=str,
+        default='.',
+        help="The directory of the group tables, default=working directory.")
+    merge_parser.add_argument(
+        '--seed',
+        type=int,
+        help="The seed of numpy's random state before bootstrapping each summary.")
+    prof.add_profile_argument(merge_parser)
+    args = parser.parse_args(argv)
+    prof.setup(args)
+
+    if args.command == 'shard':
+        if args.shard is None:
+            parser.error('the shard must be given with -k when not running in a job array')
+        if args.ext == 'fmp':
+            if importlib.util.find_spec('schrodinger') is None:
+                raise Exception('Schrodinger must be installed to use FMP files as input. Use CSV files instead.')
+        output = args.output if args.output is not None else f'partial_{args.shard}_of_{args.nshards}.json'
+        partial = write_partial(args.upper_dir, args.ext, args.shard, args.nshards, output)
+        print(f'{len(partial["maps"])} of {partial["number of maps"]} maps written to {output}')
+    else:
+        ext, maps = read_partials(args.partials)
+        with prof.stage('merge'):
+            merge(maps, ext, args.seed, args.outdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+import argparse
+import hashlib
+import json
+import os
+from glob import glob
+
+import numpy as np
+
+import incremental as inc
+import ligand_index as li
+
+DEFAULT_STORE = os.path.join(os.path.expanduser('~'), '.cache', 'fep_benchmark', 'structure_store')
+
+# Bump this when the layout of the store changes so that old stores are rebuilt.
+STORE_VERSION = 2
+
+# The per-atom fields of the store, besides the coordinates. Ligand atoms have the residue name 'LIG' and no chain,
+# residue number or B-factor.
+ATOM_DTYPE = np.dtype([('element', 'U2'), ('name', 'U4'), ('resname', 'U3'), ('chain', 'U1'), ('resnum', np.int32),
+                       ('hetatm', bool), ('charge', np.int8), ('bfactor', np.float32)])
+
+# The rows of the record table: the atoms and bonds of each protein or ligand record are the rows start:end of the
+# atom and bond arrays, and the bonds are numbered from the first atom of the record.
+RECORD_DTYPE = np.dtype([('atom_start', np.int64), ('atom_end', np.int64), ('bond_start', np.int64),
+                         ('bond_end', np.int64)])
+
+
+def read_pdb(path):
+    """
+    Read the ATOM and HETATM records and the CONECT bonds of a PDB file.
+
+    Returns
+    -------
+    coordinates: numpy.ndarray
+        The coordinates of every atom, with shape (natoms, 3).
+    atoms: numpy.ndarray
+        The fields of ATOM_DTYPE of every atom.
+    bonds: numpy.ndarray
+        The (atom 1, atom 2, order) of each bond of the CONECT records, with atoms counted from zero. PDB files only
+        give the bonds of some HETATM records, and their order is always 1.
+    """
+    coordinates, rows, serials, conect = [], [], {}, set()
+    with open(path) as f:
+        for line in f:
+            record = line[:6]
+            if record in ('ATOM  ', 'HETATM'):
+                serials[line[6:11].strip()] = len(rows)
+                coordinates.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+                element = line[76:78].strip() or line[12:14].strip().lstrip('0123456789')
+                charge = line[78:80].strip()
+                rows.append((element.capitalize(), line[12:16].strip(), line[17:20].strip(), line[21].strip(),
+                             int(line[22:26]), record == 'HETATM', int(charge[::-1]) if charge else 0,
+                             float(line[60:66] or 0)))
+            elif record == 'CONECT':
+                fields = [line[k:k + 5].strip() for k in range(6, 31, 5)]
+                for other in fields[1:]:
+                    if other:
+                        conect.add(tuple(sorted((fields[0], other))))
+    bonds = [(serials[a], serials[b], 1) for a, b in sorted(conect) if a in serials and b in serials]
+    return (np.array(coordinates, dtype=np.float32).reshape(-1, 3), np.array(rows, dtype=ATOM_DTYPE),
+            np.array(bonds, dtype=np.int32).reshape(-1, 3))
+
+
+def _ligand_arrays(molecule):
+    natoms = len(molecule['elements'])
+    atoms = np.zeros(natoms, dtype=ATOM_DTYPE)
+    atoms['element'] = molecule['elements']
+    atoms['resname'] = 'LIG'
+    atoms['hetatm'] = True
+    atoms['charge'] = molecule['charges']
+    return (np.array(molecule['coordinates'], dtype=np.float32).reshape(-1, 3), atoms,
+            np.array(molecule['bonds'], dtype=np.int32).reshape(-1, 3))
+
+
+def build_store(structure_dir=li.STRUCTURE_INPUTS, store_dir=DEFAULT_STORE):
+    """
+    Convert the protein PDB and ligand SD files of every map of the structure inputs into a binary store, once. Files
+    and ligand records with the same content, such as the proteins that several maps share, are stored once. The
+    ligands of a map are stored by title, so every title of an SD file must be unique.
+
+    The store is a directory of numpy arrays, which are memory-mapped when loaded:
+    coordinates.npy (float32, natoms x 3), atoms.npy (ATOM_DTYPE), bonds.npy (int32, nbonds x 3) and records.npy
+    (RECORD_DTYPE, one row per unique protein or ligand), and index.json, which gives the record of the protein and
+    of every ligand (by title) of each map, and the byte offset and length of each ligand in its SD file.
+
+    Returns
+    -------
+    index: dict
+        The contents of index.json.
+    """
+    coordinates, atoms, bonds, records = [], [], [], []
+    natoms = nbonds = 0
+    unique = {}
+
+    def add(key, arrays):
+        nonlocal natoms, nbonds
+        if key not in unique:
+            xyz, fields, bond_rows = arrays()
+            unique[key] = len(records)
+            records.append((natoms, natoms + len(xyz), nbonds, nbonds + len(bond_rows)))
+            coordinates.append(xyz)
+            atoms.append(fields)
+            bonds.append(bond_rows)
+            natoms += len(xyz)
+            nbonds += len(bond_rows)
+        return unique[key]
+
+    index = {'version': STORE_VERSION, 'structure_dir': os.path.abspath(structure_dir), 'maps': {}}
+    for sdf in sorted(glob(os.path.join(structure_dir, '*', '*_ligands.sdf'))):
+        group = os.path.basename(os.path.dirname(sdf))
+        name = os.path.basename(sdf)[:-len('_ligands.sdf')]
+        pdb = os.path.join(os.path.dirname(sdf), f'{name}_protein.pdb')
+        entry = {'sdf': os.path.relpath(sdf, structure_dir), 'protein': None, 'ligands': {}}
+        if os.path.isfile(pdb):
+            entry['protein'] = add(inc.file_digest(pdb), lambda: read_pdb(pdb))
+        with open(sdf, 'rb') as f:
+            text = f.read()
+        for molecule in li.read_sdf(sdf):
+            if molecule['title'] in entry['ligands']:
+                raise Exception(f'The ligand {molecule["title"]} appears more than once in {sdf}, the ligands of a map '
+                                f'are stored by title.')
+            block = text[molecule['offset']:molecule['offset'] + molecule['length']]
+            record = add(hashlib.sha256(block).hexdigest(), lambda: _ligand_arrays(molecule))
+            entry['ligands'][molecule['title']] = {'record': record, 'offset': molecule['offset'],
+                                                   'length': molecule['length']}
+        index['maps'][f'{group}/{name}'] = entry
+
+    os.makedirs(store_dir, exist_ok=True)
+    arrays = {'coordinates': np.concatenate(coordinates) if coordinates else np.zeros((0, 3), dtype=np.float32),
+              'atoms': np.concatenate(atoms) if atoms else np.zeros(0, dtype=ATOM_DTYPE),
+              'bonds': np.concatenate(bonds) if bonds else np.zeros((0, 3), dtype=np.int32),
+              'records': np.array(records, dtype=RECORD_DTYPE)}
+    for key, values in arrays.items():
+        np.save(os.path.join(store_dir, f'{key}.npy'), values)
+    tmp = os.path.join(store_dir, 'index.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, os.path.join(store_dir, 'index.json'))
+    return index
+
+
+class StructureStore:
+    """
+    Random access to the structures of a store made by build_store. The arrays are memory-mapped, so loading the
+    store reads only its index, and a structure is read from disk when its atoms are used.
+    """
+
+    def __init__(self, store_dir=DEFAULT_STORE):
+        with open(os.path.join(store_dir, 'index.json')) as f:
+            self.index = json.load(f)
+        if self.index.get('version') != STORE_VERSION:
+            raise Exception(f'The structure store in {store_dir} is out of date, rebuild it with structure_store.py.')
+        self.store_dir = store_dir
+        self.coordinates = np.load(os.path.join(store_dir, 'coordinates.npy'), mmap_mode='r')
+        self.atoms = np.load(os.path.join(store_dir, 'atoms.npy'), mmap_mode='r')
+        self.bonds = np.load(os.path.join(store_dir, 'bonds.npy'), mmap_mode='r')
+        self.records = np.load(os.path.join(store_dir, 'records.npy'), mmap_mode='r')
+
+    @property
+    def maps(self):
+        """
+        The maps of the store, as group/input name, e.g. 'jacs_set/thrombin_core'.
+        """
+        return list(self.index['maps'])
+
+    def record(self, row):
+        """
+        The 'coordinates', 'atoms' and 'bonds' of one record, as views of the memory-mapped arrays.
+        """
+        r = self.records[row]
+        return {'coordinates': self.coordinates[r['atom_start']:r['atom_end']],
+                'atoms': self.atoms[r['atom_start']:r['atom_end']],
+                'bonds': self.bonds[r['bond_start']:r['bond_end']]}
+
+    def protein(self, name):
+        """
+        The protein of a map.
+        """
+        return self.record(self.index['maps'][name]['protein'])
+
+    def titles(self, name):
+        """
+        The titles of the ligands of a map, in the order of its SD file.
+        """
+        return list(self.index['maps'][name]['ligands'])
+
+    def ligand(self, name, title):
+        """
+        One ligand of a map, by its title.
+        """
+        return self.record(self.index['maps'][name]['ligands'][title]['record'])
+
+    def ligand_records(self, name):
+        """
+        The record rows of the ligands of a map, in the order of titles.
+        """
+        return np.array([ligand['record'] for ligand in self.index['maps'][name]['ligands'].values()], dtype=np.int64)
+
+    def sdf_block(self, name, title):
+        """
+        The text of one ligand's record in its SD file, read directly from its byte offset.
+        """
+        entry = self.index['maps'][name]
+        ligand = entry['ligands'][title]
+        with open(os.path.join(self.index['structure_dir'], entry['sdf']), 'rb') as f:
+            f.seek(ligand['offset'])
+            return f.read(ligand['length']).decode()
+
+
+def main(argv=None):
+    usage = """
+    The script converts the protein PDB and ligand SD files of ../fep_benchmark_inputs/structure_inputs into a binary
+    store of numpy arrays, which structural analyses load memory-mapped instead of parsing
+    the text files again. The store only needs to be rebuilt when the structure inputs change:
+
+        > python structure_store.py
+    """
+    description = """
+    Build the binary store of the benchmark structure inputs.
+    """
+    parser = argparse.ArgumentParser(usage=usage, description=description)
+    parser.add_argument(
+        '-s',
+        '--structure_dir',
+        type=str,
+        default=li.STRUCTURE_INPUTS,
+        help="The directory of the structure inputs, with a subdirectory for each group, "
+             "default=../fep_benchmark_inputs/structure_inputs.")
+    parser.add_argument(
+        '-o',
+        '--store',
+        type=str,
+        default=DEFAULT_STORE,
+        help="The directory of the store, default=~/.cache/fep_benchmark/structure_store.")
+    args = parser.parse_args(argv)
+
+    index = build_store(args.structure_dir, args.store)
+    store = StructureStore(args.store)
+    nligands = sum(len(entry['ligands']) for entry in index['maps'].values())
+    print(f'{len(index["maps"])} maps with {nligands} ligands stored in {args.store} as {len(store.records)} unique '
+          f'records of {len(store.coordinates)} atoms')
+
+
+if __name__ == '__main__':
+    main()
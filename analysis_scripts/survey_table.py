@@ -0,0 +1,300 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+# The location of the survey in this repository.
+SURVEY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'experimental_survey_data')
+DEFAULT_METADATA = os.path.join(SURVEY_DIR, 'publicly_accessible_survey_metadata.csv')
+DEFAULT_DATA_DIR = os.path.join(SURVEY_DIR, 'publicly_accessible_survey_data')
+
+# The comparison types of the metadata, in the order that they are reported.
+CATEGORIES = ('Binding vs binding', 'Binding vs inhibition', 'Inhibition vs inhibition')
+
+# The comparisons from Schrodinger's drug discovery projects, which are not part of this repository and have no
+# metadata file.
+DRUG_DISCOVERY_COMPARISONS = {
+    'Binding vs binding': ['projectD_lantha_discover', 'projectE_lantha_discover'],
+    'Binding vs inhibition': ['projectA_spr_biochem', 'projectB_biochem_phospho', 'projectC_spr_biochem',
+                              'projectD_discover_trfret', 'projectD_discover_atpkm', 'projectD_lantha_atpkm',
+                              'projectD_lantha_trfret', 'projectE_lantha_atpkm', 'projectE_lantha_trfret',
+                              'projectE_discover_trfret', 'projectE_discover_atpkm'],
+    'Inhibition vs inhibition': ['projectD_atpkm_trfret', 'projectE_atpkm_trfret'],
+}
+
+STATISTICS = ('Pairwise RMSE', 'Pairwise MUE', 'Absolute RMSE', 'Absolute MUE', 'R-squared', 'Kendall tau')
+
+
+def read_metadata(metadata_csv=DEFAULT_METADATA, used_only=True):
+    """
+    Read the survey metadata.
+
+    Parameters
+    ----------
+    metadata_csv: str
+        The metadata CSV file, with the columns 'Comparison type', 'CSV filename' and 'Used in reproducibility survey?'.
+    used_only: bool
+        Whether to only keep the comparisons that are used in the reproducibility survey.
+
+    Returns
+    -------
+    metadata: pandas.DataFrame
+        The metadata indexed by the comparison name (the CSV filename without the extension), with the comparison type
+        in the 'Category' column.
+    """
+    metadata = pd.read_csv(metadata_csv)
+    metadata.columns = [c.strip() for c in metadata.columns]
+    metadata['CSV filename'] = metadata['CSV filename'].str.strip()
+    metadata['Category'] = metadata['Comparison type'].str.strip()
+    if used_only:
+        metadata = metadata.loc[metadata['Used in reproducibility survey?'].str.strip() == 'Yes']
+    return metadata.set_index('CSV filename', drop=False).rename_axis('Comparison')
+
+
+def drug_discovery_metadata():
+    """
+    The metadata of the comparisons from Schrodinger's drug discovery projects.
+    """
+    rows = [{'CSV filename': name, 'Comparison type': category, 'Category': category}
+            for category, names in DRUG_DISCOVERY_COMPARISONS.items() for name in names]
+    return pd.DataFrame(rows).set_index('CSV filename', drop=False).rename_axis('Comparison')
+
+
+def read_measurements(metadata, data_dirs):
+    """
+    Read every comparison CSV file once into a single table.
+
+    Parameters
+    ----------
+    metadata: pandas.DataFrame
+        The metadata of the comparisons, from read_metadata.
+    data_dirs: list-like of str
+        The directories in which to look for the CSV files, in order.
+
+    Returns
+    -------
+    measurements: pandas.DataFrame
+        One row per ligand of every comparison, with the columns 'Comparison', 'Category', 'dG1' and 'dG2' (in
+        kcal/mol).
+    """
+    frames = []
+    for name, category in zip(metadata.index, metadata['Category']):
+        paths = [os.path.join(d, f'{name}.csv') for d in data_dirs if os.path.isfile(os.path.join(d, f'{name}.csv'))]
+        if len(paths) == 0:
+            raise FileNotFoundError(f'Unable to find {name}.csv in {", ".join(data_dirs)}.')
+        df = pd.read_csv(paths[0])
+        if df.shape[1] != 2:
+            raise Exception(f'Only 2 columns are expected in CSV file. File {paths[0]} contains {df.shape[1]} columns.')
+        frames.append(pd.DataFrame({'Comparison': name, 'Category': category,
+                                    'dG1': df.iloc[:, 0].values.astype(float), 'dG2': df.iloc[:, 1].values.astype(float)}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def comparison_statistics(measurements):
+    """
+    Calculate the error and correlation statistics of every comparison with grouped array operations.
+
+    Note
+    ----
+    The pairwise differences are never formed. With e = dG2 - dG1, the sum of (e_i - e_j)^2 over all n(n-1)/2 pairs is
+    n times the sum of (e_i - mean(e))^2, and with e sorted in ascending order the sum of |e_i - e_j| is the sum of
+    (2k - n + 1) e_k.
+
+    Parameters
+    ----------
+    measurements: pandas.DataFrame
+        The table from read_measurements.
+
+    Returns
+    -------
+    comparisons: pandas.DataFrame
+        Indexed by comparison, with the 'number' of ligands and the statistics in STATISTICS.
+    """
+    df = measurements.assign(err=measurements['dG2'] - measurements['dG1'])
+    grouped = df.groupby('Comparison', sort=False)
+    n = grouped['err'].size()
+
+    comparisons = pd.DataFrame({'number': n})
+    comparisons['Pairwise RMSE'] = np.sqrt(2 * grouped['err'].var(ddof=1))
+
+    df = df.sort_values(['Comparison', 'err'])
+    rank = df.groupby('Comparison', sort=False).cumcount()
+    size = df['Comparison'].map(n)
+    abs_sum = ((2 * rank - size + 1) * df['err']).groupby(df['Comparison']).sum()
+    comparisons['Pairwise MUE'] = abs_sum / (n * (n - 1) / 2)
+
+    comparisons['Absolute RMSE'] = np.sqrt((df['err'] ** 2).groupby(df['Comparison']).mean())
+    comparisons['Absolute MUE'] = df['err'].abs().groupby(df['Comparison']).mean()
+    comparisons['R-squared'] = grouped.apply(lambda g: np.corrcoef(g['dG1'], g['dG2'])[0, 1] ** 2)
+    comparisons['Kendall tau'] = grouped.apply(lambda g: stats.kendalltau(g['dG1'], g['dG2']).correlation)
+    return comparisons
+
+
+def publications(comparisons):
+    """
+    The publication of each comparison, which is its DOI or web link from the metadata. Comparisons without one, such
+    as the drug discovery projects, are grouped by the part of their name before the first underscore (e.g.
+    'projectD').
+    """
+    prefix = pd.Series(comparisons.index.str.split('_').str[0], index=comparisons.index)
+    if 'DOI or weblink of source' not in comparisons:
+        return prefix
+    return comparisons['DOI or weblink of source'].fillna(prefix)
+
+
+class SurveyTable:
+    """
+    The experimental survey loaded once: the measurements of every comparison, and a table of the statistics of every
+    comparison joined with its metadata. Category summaries are group-bys of the comparison table.
+    """
+
+    def __init__(self, data_dir=DEFAULT_DATA_DIR, metadata_csv=DEFAULT_METADATA, drug_discovery_dir=None,
+                 used_only=True):
+        """
+        Parameters
+        ----------
+        data_dir: str
+            The directory that contains the publicly accessible survey CSV files.
+        metadata_csv: str
+            The metadata of the publicly accessible comparisons, which sets their category and whether they are used.
+        drug_discovery_dir: str
+            The optional directory that contains Schrodinger's drug discovery comparative assay data.
+        used_only: bool
+            Whether to only load the comparisons that are used in the reproducibility survey.
+        """
+        metadata = read_metadata(metadata_csv, used_only)
+        data_dirs = [data_dir]
+        if drug_discovery_dir is not None:
+            metadata = pd.concat([metadata, drug_discovery_metadata()])
+            data_dirs.append(drug_discovery_dir)
+
+        self.metadata = metadata
+        self.measurements = read_measurements(metadata, data_dirs)
+        self.comparisons = comparison_statistics(self.measurements).join(metadata)
+        self.comparisons['Publication'] = publications(self.comparisons)
+
+    def categories(self):
+        """
+        The categories that have comparisons, in the order of CATEGORIES.
+        """
+        present = set(self.comparisons['Category'])
+        return [c for c in CATEGORIES if c in present] + sorted(present - set(CATEGORIES))
+
+    def summarize(self, by='Category'):
+        """
+        The weighted statistics of every group of comparisons. Each comparison is weighted by its number of ligands;
+        RMSEs are combined as the weighted root-mean-square and the other statistics as the weighted mean.
+
+        Parameters
+        ----------
+        by: str or None
+            The column of the comparison table to group by. If None, the whole survey is summarized.
+
+        Returns
+        -------
+        summary: pandas.DataFrame
+            One row per group with the number of comparisons, the total number of data points and each statistic.
+        """
+        df = self.comparisons
+        keys = df[by] if by is not None else pd.Series('All', index=df.index)
+        w = df['number']
+        weighted = pd.DataFrame({s: w * (df[s] ** 2 if 'RMSE' in s else df[s]) for s in STATISTICS})
+        weighted['number'] = w
+        sums = weighted.groupby(keys, sort=False).sum()
+        summary = pd.DataFrame({'comparisons': keys.groupby(keys, sort=False).size(), 'number': sums['number']})
+        for s in STATISTICS:
+            mean = sums[s] / sums['number']
+            summary[s] = np.sqrt(mean) if 'RMSE' in s else mean
+        return summary
+
+    def bootstrap_counts(self, nboots=10000, stratify=True, cluster=True, seed=None):
+        """
+        Draw bootstrap replicates of the survey as the number of times each comparison is drawn.
+
+        Note
+        ----
+        With stratification, each comparison type is resampled separately so that every replicate has the same number
+        of comparisons of each type. With clustering, the publications of each stratum are resampled first and then the
+        comparisons of each drawn publication, as comparisons from the same publication (such as rogez2013_* or
+        crawford2016_*) are not independent. Drawing a publication k times and its m comparisons m times for each draw
+        is a single multinomial draw of k * m comparisons, so every replicate is drawn at once for each publication.
+
+        Parameters
+        ----------
+        nboots: int
+            The number of bootstrap replicates.
+        stratify: bool
+            Whether to resample within each comparison type.
+        cluster: bool
+            Whether to resample publications before comparisons.
+        seed: int
+            The seed of the random number generator.
+
+        Returns
+        -------
+        counts: numpy.ndarray
+            An array of shape (nboots, ncomparisons) with the number of times each comparison is drawn.
+        """
+        rng = np.random.default_rng(seed)
+        df = self.comparisons
+        strata = df['Category'] if stratify else pd.Series('All', index=df.index)
+        clusters = df['Publication'] if cluster else pd.Series(np.arange(len(df)), index=df.index)
+        counts = np.zeros((nboots, len(df)), dtype=int)
+        for _, stratum in df.groupby(strata, sort=False):
+            members = stratum.groupby(clusters.loc[stratum.index], sort=False).indices
+            positions = [df.index.get_indexer(stratum.index[i]) for i in members.values()]
+            draws = rng.multinomial(len(positions), np.full(len(positions), 1. / len(positions)), size=nboots)
+            for k, pos in enumerate(positions):
+                counts[:, pos] = rng.multinomial(draws[:, k] * len(pos), np.full(len(pos), 1. / len(pos)))
+        return counts
+
+    def bootstrap_independent(self, nboots=10000, seed=None):
+        """
+        Bootstrap the weighted statistics as in the published analysis: the comparisons of the whole survey and of each
+        comparison type are resampled uniformly and independently of one another.
+
+        Returns
+        -------
+        samples: dict
+            As returned by bootstrap.
+        """
+        whole, categories = np.random.SeedSequence(seed).spawn(2)
+        samples = self.bootstrap(nboots, stratify=True, cluster=False, seed=categories)
+        samples['All'] = self.bootstrap(nboots, stratify=False, cluster=False, seed=whole)['All']
+        return samples
+
+    def bootstrap(self, nboots=10000, stratify=True, cluster=True, seed=None):
+        """
+        Bootstrap the weighted statistics of the whole survey and of each comparison type from the same replicates.
+
+        Parameters
+        ----------
+        nboots: int
+            The number of bootstrap replicates.
+        stratify: bool
+            Whether to resample within each comparison type.
+        cluster: bool
+            Whether to resample publications before comparisons.
+        seed: int
+            The seed of the random number generator.
+
+        Returns
+        -------
+        samples: dict
+            For 'All' and every category, a dictionary from statistic to its bootstrap samples. Replicates in which a
+            category is not drawn (possible without stratification) are NaN.
+        """
+        df = self.comparisons
+        weights = self.bootstrap_counts(nboots, stratify, cluster, seed) * df['number'].values
+        groups = {'All': np.ones(len(df), dtype=bool)}
+        groups.update({c: (df['Category'] == c).values for c in self.categories()})
+        values = np.column_stack([df[s].values ** 2 if 'RMSE' in s else df[s].values for s in STATISTICS])
+
+        samples = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for key, mask in groups.items():
+                totals = weights[:, mask] @ values[mask] / weights[:, mask].sum(axis=1)[:, np.newaxis]
+                samples[key] = {s: np.sqrt(totals[:, k]) if 'RMSE' in s else totals[:, k]
+                                for k, s in enumerate(STATISTICS)}
+        return samples
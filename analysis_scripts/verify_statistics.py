@@ -0,0 +1,473 @@
+import argparse
+import glob
+import importlib
+import os
+import re
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import analysis_functions as af
+import distribution_fit as dfit
+import fast_stats as fs
+import helper_functions as hf
+import incremental as inc
+import rollup_benchmark as rb
+import shard_benchmark as sb
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '21_4_results')
+FEP_INPUTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fep_benchmark_inputs',
+                              'fep_plus_inputs')
+
+# Point estimates must agree to floating point rounding. The published tables and CCC DDGs are rounded to 2 decimals.
+POINT_TOLERANCE = 1e-9
+PUBLISHED_TOLERANCE = 0.01
+
+# The statistics of summarize_fep_error, in the order that they are returned, and their columns in group_summaries.csv.
+SUMMARY_STATISTICS = {True: ['Pairwise RMSE', 'Pairwise MUE', 'Edgewise RMSE', 'Edgewise MUE', 'R-squared',
+                             'Kendall tau'],
+                      False: ['Pairwise RMSE', 'Pairwise MUE', 'R-squared', 'Kendall tau']}
+
+# The per-map statistics that can be calculated from the CSV files of ligand_predictions, in the *_results.csv tables.
+MAP_STATISTICS = ['number of compounds', 'Pairwise RMSE', 'Pairwise MUE', 'R-squared', 'Kendall tau']
+
+# The checks that main runs.
+CHECKS = ['maps', 'results', 'paths', 'groups', 'closure', 'distribution', 'corrections']
+
+# Known differences from the published tables, by (check, group, map), or for every map of a group if the map is
+# empty, which are reported but do not fail the verification. The published tables were calculated from the FMP files,
+# which handle the ligands with several protomers, tautomers or binding modes properly, and the CSV files of
+# ligand_predictions of some of the corrected maps count or weight these ligands differently.
+FMP_LIGANDS = ('The published per-map results were calculated from the FMP files, whose ligands differ from those of '
+               'the CSV files of ligand_predictions for maps with several protomers, tautomers or binding modes '
+               'of a ligand.')
+MISSING_LIGAND = 'The CSV file of ligand_predictions has one ligand fewer than the published map.'
+OLD_SUMMARY = ('The published charge_annhil row of group_summaries.csv has the same number of compounds as '
+               'charge_annhil_results.csv but larger errors, so it was made from another version of the per-map '
+               'results.')
+EXPECTED_DIFFERENCES = {('results', 'charge_annhil', ''): FMP_LIGANDS,
+                        ('published', 'charge_annhil', ''): OLD_SUMMARY,
+                        ('results', 'fragments', 'jak2_set1_pkacorr_bmcorr_out'): FMP_LIGANDS,
+                        ('results', 'gpcrs', 'a2a_hip278_sbpkacorr_out'): FMP_LIGANDS,
+                        ('results', 'janssen_bace', 'retrospective_custom_core_extra_pkacorr_out'): FMP_LIGANDS,
+                        ('results', 'merck', 'syk_pkacorr_out'): FMP_LIGANDS,
+                        ('results', 'merck', 'eg5_extraprotomers_manual_pkacorr_out'): FMP_LIGANDS,
+                        ('results', 'merck', 'tnks2_fullmap_symcorr_pkacorr_out'): FMP_LIGANDS,
+                        ('results', 'macrocycles', '2Q15_lig17to21_alpha05_out'): MISSING_LIGAND}
+
+
+def expected_difference(check, group, name):
+    """
+    The reason for a known difference from the published tables, or None if there is no known difference.
+    """
+    return EXPECTED_DIFFERENCES.get((check, group, name), EXPECTED_DIFFERENCES.get((check, group, '')))
+
+
+def percentile_tolerance(samples, q, z=3.):
+    """
+    The Monte Carlo tolerance of a bootstrap percentile: the largest change of the percentile of the samples when the
+    percentile level moves by z binomial standard errors, sqrt(p (1 - p) / nboots).
+
+    Parameters
+    ----------
+    samples: numpy.ndarray
+        The bootstrap samples of the reference implementation.
+    q: float
+        The percentile, e.g. 2.5.
+    z: float
+        The number of standard errors.
+    """
+    samples = np.asarray(samples)[np.isfinite(samples)]
+    p = q / 100.
+    delta = 100 * z * np.sqrt(p * (1 - p) / len(samples))
+    levels = np.clip([q - delta, q, q + delta], 0., 100.)
+    lower, mid, upper = np.percentile(samples, levels)
+    return max(mid - lower, upper - mid)
+
+
+def _row(check, group, name, quantity, reference, accelerated, tolerance):
+    difference = abs(accelerated - reference)
+    tolerance = max(tolerance, POINT_TOLERANCE)
+    return {'Check': check, 'Group': group, 'Map': name, 'Quantity': quantity, 'Reference': reference,
+            'Accelerated': accelerated, 'Difference': difference, 'Tolerance': tolerance,
+            'Agree': bool(difference <= tolerance or (np.isnan(reference) and np.isnan(accelerated)))}
+
+
+def verify_map(path, nboots=1000, seed=0):
+    """
+    Compare the statistics of one map from the reference implementation (the explicit pairwise differences and the
+    bootstrap loops of helper_functions, as used by parse_fep_data_from_csv) with fast_stats. Both bootstraps draw their
+    indices from numpy's global random state after seeding it with the same seed.
+
+    Returns
+    -------
+    rows: list of dict
+        One row per compared quantity.
+    """
+    group = os.path.basename(os.path.dirname(path))
+    name = os.path.splitext(os.path.basename(path))[0]
+    df = pd.read_csv(path)
+    exp = df['Exp. dG (kcal/mol)'].values.astype(float)
+    pred = df['Pred. dG (kcal/mol)'].values.astype(float)
+
+    diffs = hf.get_pairwise_diffs(pred, exp, verbose=False)
+    rmsd, mue, r2, tau = hf.get_absolute_stats(pred, exp, verbose=False)
+    reference = {'Pairwise RMSE': np.sqrt(np.mean(diffs ** 2)), 'Pairwise MUE': np.mean(np.abs(diffs)),
+                 'Absolute RMSE': rmsd, 'Absolute MUE': mue, 'R-squared': r2, 'Kendall tau': tau}
+    # Bootstrap samples that repeat one ligand have undefined correlations, which both implementations make NaN.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        np.random.seed(seed)
+        boot_mues, boot_rmsds = hf.bootstrap_pairwise_error(pred, exp, nboots)
+        np.random.seed(seed)
+        abs_mues, abs_rmsds, abs_r2, abs_taus = hf.bootstrap_absolute_stats(pred, exp, nboots)
+    reference_samples = {'Pairwise RMSE': boot_rmsds, 'Pairwise MUE': boot_mues, 'Absolute RMSE': abs_rmsds,
+                         'Absolute MUE': abs_mues, 'R-squared': abs_r2, 'Kendall tau': abs_taus}
+
+    np.random.seed(seed)
+    values, samples = fs.bootstrap_statistics(pred, exp, nboots)
+
+    rows = []
+    for s in fs.STATISTICS:
+        rows.append(_row('maps', group, name, s, reference[s], values[s], POINT_TOLERANCE))
+        for q, label in ((2.5, 'lower 95%'), (97.5, 'upper 95%')):
+            rows.append(_row('maps', group, name, f'{s}, {label}', np.nanpercentile(reference_samples[s], q),
+                             np.nanpercentile(samples[s], q), percentile_tolerance(reference_samples[s], q)))
+    return rows
+
+
+def reference_metrics(path):
+    """
+    The per-map statistics of MAP_STATISTICS of one CSV file of ligand predictions, from the explicit pairwise
+    differences of helper_functions.
+    """
+    df = pd.read_csv(path)
+    exp = df['Exp. dG (kcal/mol)'].values.astype(float)
+    pred = df['Pred. dG (kcal/mol)'].values.astype(float)
+    diffs = hf.get_pairwise_diffs(pred, exp, verbose=False)
+    rmsd, mue, r2, tau = hf.get_absolute_stats(pred, exp, verbose=False)
+    return {'number of compounds': len(df), 'Pairwise RMSE': np.sqrt(np.mean(diffs ** 2)),
+            'Pairwise MUE': np.mean(np.abs(diffs)), 'R-squared': r2, 'Kendall tau': tau}
+
+
+def verify_results(path, predictions_dir):
+    """
+    Compare the per-map statistics of a published *_results.csv table with those of the reference implementation on
+    the CSV files of the group in ligand_predictions. Maps without a CSV file are left out.
+
+    Returns
+    -------
+    rows: list of dict
+        One row per compared quantity.
+    """
+    group = os.path.basename(path).replace('_results.csv', '')
+    published = pd.read_csv(path)
+    rows = []
+    for _, row in published.iterrows():
+        csv = os.path.join(predictions_dir, group, f'{row["entries"]}.csv')
+        if not os.path.isfile(csv):
+            continue
+        reference = reference_metrics(csv)
+        for s in MAP_STATISTICS:
+            tolerance = POINT_TOLERANCE if s == 'number of compounds' else PUBLISHED_TOLERANCE
+            rows.append(_row('results', group, row['entries'], s, float(row[s]), float(reference[s]), tolerance))
+    return rows
+
+
+def _by_map(results):
+    return {(g, e): {s: float(results[s][k]) for s in MAP_STATISTICS}
+            for k, (g, e) in enumerate(zip(results.groups, results['entries']))}
+
+
+def verify_paths(predictions_dir, nshards=3):
+    """
+    Compare the per-map statistics of the reference implementation with those of the other paths that the tables are
+    made by: the segment reductions of ragged.py (analysis_functions.parse_fep_data_from_csv on all the maps at once),
+    the cache of incremental.py (one map at a time, as write_group_summary_tables.py --cache and watch_benchmark.py)
+    and the merged partial results of nshards shards of shard_benchmark.py.
+
+    Returns
+    -------
+    rows: list of dict
+        One row per compared quantity.
+    """
+    files = sorted(glob.glob(os.path.join(predictions_dir, '*', '*.csv')))
+    tables = {'ragged': _by_map(af.parse_fep_data_from_csv(files)[0]),
+              'incremental': _by_map(inc.BenchmarkCache().results(files))}
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, f'partial_{k}.json') for k in range(nshards)]
+        for k, path in enumerate(paths):
+            sb.write_partial(predictions_dir, 'csv', k, nshards, path)
+        maps = sb.read_partials(paths)[1]
+    tables['sharded'] = {(os.path.dirname(name), m['metrics']['entries']): {s: float(m['metrics'][s])
+                                                                           for s in MAP_STATISTICS}
+                         for name, m in maps.items()}
+
+    rows = []
+    for path in files:
+        group = os.path.basename(os.path.dirname(path))
+        name = os.path.splitext(os.path.basename(path))[0]
+        reference = reference_metrics(path)
+        for label, table in tables.items():
+            values = table.get((group, name), {})
+            for s in MAP_STATISTICS:
+                rows.append(_row('paths', group, name, f'{label}: {s}', float(reference[s]), values.get(s, np.nan),
+                                 POINT_TOLERANCE))
+    return rows
+
+
+def read_group_results(path):
+    """
+    Read the per-map statistics of a group, as written by write_group_summary_tables.py.
+    """
+    df = pd.read_csv(path)
+    return {k: df[k].values for k in df}
+
+
+def verify_group(path, nboots=10000, seed=0, published=None):
+    """
+    Compare the weighted statistics of a group from analysis_functions.summarize_fep_error with
+    fast_stats.summarize_fep_error, on the same per-map results and seed. If the published group summary is given, the
+    reference statistics are also compared with it, with the intervals allowed to differ by the Monte Carlo tolerance
+    as the published seed is unknown.
+
+    Returns
+    -------
+    rows: list of dict
+        One row per compared quantity.
+    """
+    group = os.path.basename(path).replace('_results.csv', '')
+    results = read_group_results(path)
+    edges = 'number of edges' in results
+    np.random.seed(seed)
+    reference = af.summarize_fep_error(results, verbose=False)
+    np.random.seed(seed)
+    accelerated = fs.summarize_fep_error(results, nboots)
+
+    # The Monte Carlo tolerance is estimated from the spread of a separate set of weighted bootstrap samples.
+    rng = np.random.default_rng(seed)
+    rows = []
+    for s, ref, acc in zip(SUMMARY_STATISTICS[edges], reference, accelerated):
+        num = results['number of edges'] if s.startswith('Edgewise') else results['number of compounds']
+        samples = fs.bootstrap_weighted(num, results[s], nboots, rng, rms='RMSE' in s)
+        tolerances = [POINT_TOLERANCE, percentile_tolerance(samples, 2.5), percentile_tolerance(samples, 97.5)]
+        for label, r, a, tol in zip(('', ', lower 95%', ', upper 95%'), ref, acc, tolerances):
+            rows.append(_row('groups', group, '', s + label, r, a, tol))
+            # In the published rows, the reference is the published value and the recomputed value is compared to it.
+            if published is not None and published.get(s + label) is not None:
+                mc = 0. if label == '' else tol
+                rows.append(_row('published', group, '', s + label, published[s + label], r, PUBLISHED_TOLERANCE + mc))
+    return rows
+
+
+def verify_distribution_fit(ndiffs=100000, scale=1.2, seed=0, level=0.01):
+    """
+    Check the likelihood ratio test of distribution_fit on normally distributed differences, for which the t fit
+    must reach the normal limit: the t log-likelihood must not be below the normal one (beyond the rounding of the t
+    CDF at the upper bound of the degrees of freedom), and the likelihood ratio statistic must be within the 1 -
+    level quantile of its null distribution, an equal mixture of chi-squared distributions with 0 and 1 degrees of
+    freedom.
+
+    Returns
+    -------
+    rows: list of dict
+        One row per compared quantity.
+    """
+    diffs = np.random.default_rng(seed).normal(0., scale, ndiffs)
+    fits = dfit.fit_distributions(diffs, nboots=10, seed=seed)
+    lr = 2 * (fits['t']['loglike'] - fits['normal']['loglike'])
+    return [_row('distribution', '', '', 'Log-likelihood of t below normal (normal data)', 0.,
+                 max(0., -lr / 2), 1e-3),
+            _row('distribution', '', '', 'Likelihood ratio of t against normal (normal data)', 0., lr,
+                 stats.chi2.isf(2 * level, 1))]
+
+
+def _stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def manifest_correction(name, group, manifest, cm):
+    """
+    The corrections of an output file name from the steps of the correction manifest, without the name patterns of
+    rollup_benchmark: those of the map of its group with the same output file name, none if it is the input file name
+    of a map, or else those of the map with the longest name that it starts with. None if the map is not in the
+    manifest.
+    """
+    maps = [m for g, m in cm.iter_maps(manifest) if g == group]
+    matches = [m for m in maps if _stem(m['output']) == name]
+    if len(matches) == 0:
+        if any(_stem(f) == name for m in maps for f in m.get('inputs', [m.get('input')])):
+            return 'none'
+        matches = sorted([m for m in maps if name.startswith(m['name'] + '_')], key=lambda m: len(m['name']))[-1:]
+    if len(matches) == 0:
+        return None
+    steps = [step['type'] for step in matches[0].get('steps', [])]
+    found = [c for c, types in rb.STEP_CORRECTIONS.items() if any(t in types for t in steps)]
+    return ' + '.join(found) if len(found) > 0 else 'none'
+
+
+def verify_corrections(metadata, fep_inputs_dir):
+    """
+    Check the correction types that rollup_benchmark.correction_type gives the output file names of the metadata. The
+    corrections of the maps of the correction manifest must be those of its steps, and every token that marks a
+    correction (one that ends in 'cor' or 'corr') in the names of the other maps must be recognised. The reference of
+    each row is 1 and the result is 1 if the name passes.
+
+    Returns
+    -------
+    rows: list of dict
+        One row per output file name that is in the manifest or has a correction in its name.
+    """
+    cm = _import_fep_inputs('correction_manifest', fep_inputs_dir)
+    manifest = cm.load_manifest(os.path.join(fep_inputs_dir, 'corrections_manifest.json'))
+    corrections = rb.manifest_corrections(os.path.join(fep_inputs_dir, 'corrections_manifest.json'))
+    rows = []
+    for group, name in zip(metadata['Group abbreviation'], metadata['Output file naming scheme']):
+        found = rb.correction_type(name, group, corrections)
+        expected = manifest_correction(name, group, manifest, cm)
+        marked = [t for t in name.split('_') if re.search('corr?$', t)]
+        if expected is None and len(marked) == 0:
+            continue
+        if expected is not None:
+            agree = found == expected
+        else:
+            agree = all(rb.correction_type(t) != 'none' for t in marked)
+        rows.append(_row('corrections', group, name, f'Correction type: {found}', 1., float(agree), POINT_TOLERANCE))
+    return rows
+
+
+def _import_fep_inputs(module, fep_inputs_dir):
+    if fep_inputs_dir not in sys.path:
+        sys.path.insert(0, fep_inputs_dir)
+    return importlib.import_module(module)
+
+
+def verify_closure(path, fma, tolerance=PUBLISHED_TOLERANCE):
+    """
+    Compare the cycle closure of fep_map_arrays with the CCC DDGs of FEP+ in an edge prediction CSV file. Only the
+    largest difference of the map is reported.
+
+    Returns
+    -------
+    rows: list of dict
+        A single row for the map.
+    """
+    group = os.path.basename(os.path.dirname(path))
+    name = os.path.splitext(os.path.basename(path))[0]
+    df = pd.read_csv(path, dtype={0: str, 1: str})
+    df = df.loc[pd.notna(df['Bennett ddG (kcal/mol)'])]
+    arrays = fma.MapArrays.from_edge_csv(path)
+    dg = arrays.solve(arrays.ddg)
+    ddg = dg[arrays.dst] - dg[arrays.src]
+    published = df['CCC ddG (kcal/mol)'].values.astype(float)
+    known = np.isfinite(published)
+    if not np.any(known):
+        return []
+    k = np.argmax(np.abs(ddg[known] - published[known]))
+    return [_row('closure', group, name, 'Largest CCC ddG difference', published[known][k], ddg[known][k],
+                 tolerance)]
+
+
+def main(argv=None):
+    description = """
+    Check that the accelerated statistics give the same results as the reference implementation. The reference and
+    accelerated implementations are run side by side on the same inputs and seeds: the statistics of every map in
+    ligand_predictions (helper_functions against fast_stats, and against the ragged, incremental and sharded paths
+    that make the tables), the per-map statistics of the published *_results.csv files in summary_statistics, the
+    weighted group statistics of every *_results.csv file (analysis_functions.summarize_fep_error against
+    fast_stats.summarize_fep_error), which are also compared with the published group_summaries.csv, and the cycle
+    closure of fep_map_arrays against the CCC DDGs in edge_predictions. The likelihood ratio test of distribution_fit
+    is checked on normally distributed differences, which must not favour the t-distribution, and the correction
+    types of the output file names of benchmark_output_metadata.csv are checked. Point estimates must agree exactly
+    (to floating point rounding), the published values to their rounding, and interval bounds within the Monte Carlo
+    error of the bootstrap percentiles. Every disagreement is printed and all comparisons are written to a CSV file.
+    The known differences from the published tables (EXPECTED_DIFFERENCES) are reported, and the exit status is 1 if
+    anything else disagrees.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('results_dir', type=str, nargs='?', default=RESULTS_DIR,
+                        help="The results directory with ligand_predictions, summary_statistics and "
+                             "edge_predictions subdirectories, default=../21_4_results.")
+    parser.add_argument('-c', '--checks', type=str, nargs='+', choices=CHECKS,
+                        help="The checks to run, default=all.", default=CHECKS)
+    parser.add_argument('-o', '--output', type=str, help="The CSV file of all comparisons, default=verification.csv.",
+                        default='verification.csv')
+    parser.add_argument('--map-boots', type=int, help="The number of bootstrap samples of each map, default=1000.",
+                        default=1000)
+    parser.add_argument('--group-boots', type=int, help="The number of bootstrap samples of each group, "
+                                                        "default=10000.", default=10000)
+    parser.add_argument('--seed', type=int, help="The seed of numpy's random state, default=0.", default=0)
+    parser.add_argument('--shards', type=int, help="The number of shards of the sharded path, default=3.", default=3)
+    parser.add_argument('--fep-inputs', type=str, help="The directory of fep_map_arrays.py and the correction manifest "
+                                                        "for the closure and corrections checks.",
+                        default=FEP_INPUTS_DIR)
+    args = parser.parse_args(argv)
+
+    rows = []
+    if 'maps' in args.checks:
+        for path in sorted(glob.glob(os.path.join(args.results_dir, 'ligand_predictions', '*', '*.csv'))):
+            rows.extend(verify_map(path, args.map_boots, args.seed))
+
+    if 'results' in args.checks:
+        predictions_dir = os.path.join(args.results_dir, 'ligand_predictions')
+        for path in sorted(glob.glob(os.path.join(args.results_dir, 'summary_statistics', '*_results.csv'))):
+            rows.extend(verify_results(path, predictions_dir))
+
+    if 'paths' in args.checks:
+        rows.extend(verify_paths(os.path.join(args.results_dir, 'ligand_predictions'), args.shards))
+
+    if 'groups' in args.checks:
+        summary_dir = os.path.join(args.results_dir, 'summary_statistics')
+        published = {}
+        if os.path.isfile(os.path.join(summary_dir, 'group_summaries.csv')):
+            df = pd.read_csv(os.path.join(summary_dir, 'group_summaries.csv'))
+            published = {r['Name']: r.to_dict() for _, r in df.iterrows()}
+        for path in sorted(glob.glob(os.path.join(summary_dir, '*_results.csv'))):
+            group = os.path.basename(path).replace('_results.csv', '')
+            rows.extend(verify_group(path, args.group_boots, args.seed, published.get(group)))
+
+    if 'distribution' in args.checks:
+        rows.extend(verify_distribution_fit(seed=args.seed))
+
+    if 'corrections' in args.checks:
+        rows.extend(verify_corrections(pd.read_csv(os.path.join(args.results_dir, 'benchmark_output_metadata.csv')),
+                                       os.path.abspath(args.fep_inputs)))
+
+    if 'closure' in args.checks:
+        fma = _import_fep_inputs('fep_map_arrays', os.path.abspath(args.fep_inputs))
+        for path in sorted(glob.glob(os.path.join(args.results_dir, 'edge_predictions', '*', '*.csv'))):
+            try:
+                rows.extend(verify_closure(path, fma))
+            except Exception as e:
+                print(f'Unable to check the cycle closure of {path}: {type(e).__name__}: {e}')
+
+    df = pd.DataFrame(rows)
+    df['Expected'] = [not agree and expected_difference(c, g, m) is not None
+                      for c, g, m, agree in zip(df['Check'], df['Group'], df['Map'], df['Agree'])]
+    df.to_csv(args.output, index=False)
+    failed = df.loc[~df['Agree'] & ~df['Expected']]
+    for check, g in df.groupby('Check', sort=False):
+        known = f', {g["Expected"].sum()} known differences' if g['Expected'].any() else ''
+        print(f'{check}: {g["Agree"].sum()} of {len(g)} comparisons agree{known}')
+    known = df.loc[df['Expected']].drop_duplicates(['Check', 'Group', 'Map'])
+    if len(known) > 0:
+        print()
+        print('Known differences')
+        reasons = [expected_difference(c, g, m) for c, g, m in zip(known['Check'], known['Group'], known['Map'])]
+        for reason, maps in known.groupby(reasons, sort=False):
+            print(reason)
+            print('    ' + ', '.join(f'{c} {g} {m}'.strip() for c, g, m in zip(maps['Check'], maps['Group'],
+                                                                             maps['Map'])))
+    if len(failed) > 0:
+        print()
+        print('Disagreements')
+        with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.max_rows', None):
+            print(failed.to_string(index=False))
+    print(f'All comparisons written to {args.output}')
+    return 1 if len(failed) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
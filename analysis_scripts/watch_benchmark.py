@@ -0,0 +1,177 @@
+import argparse
+import importlib
+import os
+import time
+
+import incremental as inc
+import profiling as prof
+import write_group_summary_tables as wgst
+
+
+def stable_groups(cache, groups, settle, now=None):
+    """
+    Decide which files to use in the tables. Files modified less than settle seconds ago may still be being written,
+    so the previous version of such a file is used if it is in the cache, and otherwise the file is left out until it
+    has settled. Files that cannot be parsed are also left out. The metrics of the files that are used are calculated
+    (or taken from the cache) on the way.
+
+    Parameters
+    ----------
+    cache: incremental.BenchmarkCache
+        The cache of the per-map metrics.
+    groups: dict
+        The list of files of each group, as from incremental.find_group_files.
+    settle: float
+        The number of seconds since a file was last modified before it is read.
+    now: float
+        The current time, default=time.time().
+
+    Returns
+    -------
+    groups: dict
+        The list of files of each group that are used.
+    pending: list of str
+        The new or changed files that have not been read yet.
+    """
+    now = time.time() if now is None else now
+    cache.held = set()
+    stable, pending = {}, []
+    for group, files in groups.items():
+        stable[group] = []
+        for f in files:
+            try:
+                if now - os.stat(f).st_mtime < settle:
+                    pending.append(f)
+                    if f not in cache.data['maps']:
+                        continue
+                    cache.held.add(f)
+                with prof.stage('metrics', os.path.basename(f)):
+                    cache.metrics(f)
+            except Exception as e:
+                print(f'Unable to read {f}, it will be tried again: {type(e).__name__}: {e}')
+                pending.append(f)
+                continue
+            stable[group].append(f)
+    return stable, pending
+
+
+def update(cache, upper_dir, ext, seed=None, outdir='.', settle=30., previous=None):
+    """
+    Bring the group tables up to date with the files in upper_dir. Only new or changed files are read, only the groups
+    that contain them are bootstrapped again, and the CSV files are only rewritten if something has changed. The
+    tables of groups whose files have all been removed are deleted.
+
+    Parameters
+    ----------
+    previous: dict
+        The groups of the previous update. If the files of every group are the same and nothing was recalculated, the
+        tables are not rewritten.
+
+    Returns
+    -------
+    groups: dict
+        The files of each group that are in the tables.
+    pending: list of str
+        The files that were left out of this update.
+    """
+    cache.clear_recalculated()
+    found = inc.find_group_files(upper_dir, ext)
+    # The groups of the previous update and of the cache that are no longer found are kept without files, so that their
+    # tables are removed and they are left out of the summary.
+    for group in set(previous or {}) | set(cache.data['summaries']):
+        found.setdefault(group, [])
+    groups, pending = stable_groups(cache, dict(sorted(found.items())), settle)
+    if groups == previous and len(cache.recalculated_maps) == 0:
+        return groups, pending
+    with prof.stage('tables'):
+        wgst.write_cached_tables(cache, groups, ext, seed, outdir)
+    cache.prune([f for files in groups.values() for f in files] + pending)
+    cache.save()
+    print(f'{time.strftime("%Y-%m-%d %H:%M:%S")}: {sum(len(f) for f in groups.values())} maps, '
+          f'{len(cache.recalculated_maps)} maps and {len(cache.recalculated_summaries)} groups recalculated, '
+          f'{len(pending)} files pending')
+    return groups, pending
+
+
+def main(argv=None):
+    usage = """
+    The script watches a directory of groups of FMP or CSV files, with the same structure as for
+    write_group_summary_tables.py, while the results of a benchmark are being produced. The directory is checked every
+    --interval seconds, and the group tables ({group}_results.csv and group_summaries.csv) are updated whenever a file
+    is added, changed or removed. Only the new or changed files are read and only their groups are bootstrapped again.
+    For example
+
+        > $SCHRODINGER/run python3 watch_benchmark.py upper_dir -e fmp -o tables
+
+    The per-map metrics and group summaries are kept in a cache file in the output directory, so the watch can be
+    stopped (with Ctrl-C) and restarted without reading every file again.
+    """
+    description = """
+    Keep the FEP+ group summary tables up to date as new results are produced.
+    """
+    parser = argparse.ArgumentParser(usage=usage, description=description)
+    parser.add_argument(
+        'upper_dir',
+        type=str,
+        help="The upper directory with a subdirectory of FMP or CSV files for each group.")
+    parser.add_argument(
+        '-e',
+        '--ext',
+        type=str,
+        choices=['fmp', 'csv'],
+        help="The file extension of the results. Results can be either FMP files or CSVs.")
+    parser.add_argument(
+        '-o',
+        '--outdir',
+        type=str,
+        default='.',
+        help="The directory of the group tables, default=working directory.")
+    parser.add_argument(
+        '--cache',
+        type=str,
+        help="The JSON file of the cache, default=summary_cache.json in the output directory.")
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help="The seed of numpy's random state before bootstrapping each group, default=0.")
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=60.,
+        help="The number of seconds between checks of the directory, default=60.")
+    parser.add_argument(
+        '--settle',
+        type=float,
+        default=30.,
+        help="The number of seconds since a file was last modified before it is read, so that files that are still "
+             "being written are not read, default=30.")
+    parser.add_argument(
+        '--once',
+        action='store_true',
+        help="Update the tables once and exit.")
+    prof.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+    prof.setup(args)
+
+    if args.ext == 'fmp':
+        if importlib.util.find_spec('schrodinger') is None:
+            raise Exception('Schrodinger must be installed to use FMP files as input. Use CSV files instead.')
+
+    os.makedirs(args.outdir, exist_ok=True)
+    cache = inc.BenchmarkCache(args.cache if args.cache is not None else os.path.join(args.outdir,
+                                                                                      'summary_cache.json'))
+    groups = None
+    try:
+        while True:
+            with prof.stage('update'):
+                groups, pending = update(cache, args.upper_dir, args.ext, args.seed, args.outdir, args.settle, groups)
+            if args.once:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print('Stopped watching')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,133 @@
 import analysis_functions as af
 import argparse
 import importlib
-from glob import glob
+import numpy as np
 import os
 import pandas as pd
 
+import incremental as inc
+import profiling as prof
+
+
+def _summarize(results):
+    return inc.summary_to_lists(af.summarize_fep_error(results, verbose=False))
+
+
+def _group_summary(group_name, results, stats, edges):
+    if edges:
+        return [group_name, results['number of compounds'].sum(), results['number of edges'].sum(), stats]
+    return [group_name, results['number of compounds'].sum(), stats]
+
+
+def write_cached_tables(cache, groups, ext, seed=None, outdir='.'):
+    """
+    Write the per-map results of each group and the summary table of the groups from a cache, recalculating only the
+    maps whose files have changed and the groups that contain them. Only the per-map tables of recalculated groups are
+    rewritten, and the tables of groups without files are removed. The CSV files are replaced atomically, so they can
+    be read while they are being updated.
+
+    Parameters
+    ----------
+    cache: incremental.BenchmarkCache
+        The cache of the per-map metrics and group summaries.
+    groups: dict
+        The list of files of each group, as from incremental.find_group_files.
+    ext: str
+        The file extension of the results, 'fmp' or 'csv'.
+    seed: int
+        The seed of numpy's random state before bootstrapping each group.
+    outdir: str
+        The directory of the CSV files.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        The summary table of the groups.
+    """
+    group_summaries = []
+    for group_name, files in groups.items():
+        path = os.path.join(outdir, f'{group_name}_results.csv')
+        if len(files) == 0:
+            # The table of a group whose files have all been removed would otherwise be left behind.
+            if os.path.isfile(path):
+                os.remove(path)
+            cache.forget_summary(group_name)
+            continue
+        results = cache.results(files)
+        stats = cache.summary(group_name, files, _summarize, seed)
+        if group_name in cache.recalculated_summaries or not os.path.isfile(path):
+            inc.atomic_to_csv(pd.DataFrame(results), path, index=False, float_format='%.2f')
+        group_summaries.append(_group_summary(group_name, results, stats, ext == 'fmp'))
+
+    df = summary_table(group_summaries, ext == 'fmp')
+    inc.atomic_to_csv(df, os.path.join(outdir, 'group_summaries.csv'), index=False, float_format='%.2f')
+    return df
+
+
+def summary_table(group_summaries, edges):
+    """
+    Make the summary table of the groups, with one row per group.
+
+    Parameters
+    ----------
+    group_summaries: list
+        The name, number of compounds, number of edges (if edges is True) and summarize_fep_error statistics of each
+        group.
+    edges: bool
+        Whether the statistics include the edgewise errors, which they do for FMP files.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        The summary table.
+    """
+    # Every stat has confidence intervals calculated by boostrap sampling.
+    if edges:
+        group_results = {'Name':[], 'No. compounds':[], 'No. edges':[],
+                         'Pairwise MUE':[], 'Pairwise MUE, lower 95%':[], 'Pairwise MUE, upper 95%':[],
+                         'Pairwise RMSE':[],'Pairwise RMSE, lower 95%':[], 'Pairwise RMSE, upper 95%':[],
+                         'Edgewise MUE':[], 'Edgewise MUE, lower 95%':[],'Edgewise MUE, upper 95%':[],
+                         'Edgewise RMSE':[], 'Edgewise RMSE, lower 95%':[],'Edgewise RMSE, upper 95%':[],
+                         'R-squared': [], 'R-squared, lower 95%':[], 'R-squared, upper 95%':[],
+                         'Kendall tau':[], 'Kendall tau, lower 95%':[], 'Kendall tau, upper 95%':[]}
+    else:
+        group_results = {'Name':[], 'No. compounds':[],
+                         'Pairwise MUE':[], 'Pairwise MUE, lower 95%':[], 'Pairwise MUE, upper 95%':[],
+                         'Pairwise RMSE':[],'Pairwise RMSE, lower 95%':[], 'Pairwise RMSE, upper 95%':[],
+                         'R-squared': [], 'R-squared, lower 95%':[], 'R-squared, upper 95%':[],
+                         'Kendall tau':[], 'Kendall tau, lower 95%':[], 'Kendall tau, upper 95%':[]}
+
+    for summary in group_summaries:
+        group_results['Name'].append(summary[0])
+        group_results['No. compounds'].append(summary[1])
+        if edges:
+            group_results['No. edges'].append(summary[2])
+            pair_rmse, pair_mue, edge_rmse, edge_mue, r2, tau = summary[3]
+        else:
+            pair_rmse, pair_mue, r2, tau = summary[2]
+        group_results['Pairwise MUE'].append(pair_mue[0])
+        group_results['Pairwise MUE, lower 95%'].append(pair_mue[1])
+        group_results['Pairwise MUE, upper 95%'].append(pair_mue[2])
+        group_results['Pairwise RMSE'].append(pair_rmse[0])
+        group_results['Pairwise RMSE, lower 95%'].append(pair_rmse[1])
+        group_results['Pairwise RMSE, upper 95%'].append(pair_rmse[2])
+        if edges:
+            group_results['Edgewise MUE'].append(edge_mue[0])
+            group_results['Edgewise MUE, lower 95%'].append(edge_mue[1])
+            group_results['Edgewise MUE, upper 95%'].append(edge_mue[2])
+            group_results['Edgewise RMSE'].append(edge_rmse[0])
+            group_results['Edgewise RMSE, lower 95%'].append(edge_rmse[1])
+            group_results['Edgewise RMSE, upper 95%'].append(edge_rmse[2])
+        group_results['R-squared'].append(r2[0])
+        group_results['R-squared, lower 95%'].append(r2[1])
+        group_results['R-squared, upper 95%'].append(r2[2])
+        group_results['Kendall tau'].append(tau[0])
+        group_results['Kendall tau, lower 95%'].append(tau[1])
+        group_results['Kendall tau, upper 95%'].append(tau[2])
+
+    return pd.DataFrame(group_results)
+
+
 def main(argv=None):
     usage = """
     The script expects that all output fmp or csv files are located in subdirectories of the supplied main directory. 
@@ -35,7 +158,10 @@ def main(argv=None):
     NOTE: using the CSVs files in ../21_4_results/ligand_predictions only provides approximately accurate statistics as 
     ligands with multple protomers or tautomers are over-counted.
     
-    The output CSVs are written to the working directory.
+    The output CSVs are written to the working directory. When the results of a few maps change, only those maps and
+    their groups are recalculated if the tables are written with a cache, e.g.
+
+        > python write_group_summary_tables.py ../21_4_results/ligand_predictions -e csv --cache summary_cache.json --seed 0
     """
     description = """
     Write out the per-group FEP+ accuracy results to CSV files as well as the summary accuracy for each group.
@@ -53,82 +179,49 @@ def main(argv=None):
         type=str,
         choices=['fmp', 'csv'],
         help="The file extension of the results. Results can be either FMP files or CSVs.")
+    parser.add_argument(
+        '--cache',
+        type=str,
+        help="A JSON file that keeps the metrics of each map and the summary of each group between runs. Only the "
+             "maps whose files have changed, and the groups that contain them, are recalculated.")
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help="The seed of numpy's random state before bootstrapping each group, so that the intervals are "
+             "reproducible. The cached summaries of a group are only reused with the same seed.")
+    prof.add_profile_argument(parser)
     args = parser.parse_args(argv)
+    prof.setup(args)
 
     if args.ext == 'fmp':
         if importlib.util.find_spec('schrodinger') is None:
             raise Exception('Schrodinger must be installed to use FMP files as input. Use CSV files instead.')
 
-    group_summaries = []
-    for entry in glob(f'{args.upper_dir}/*'):
-        if os.path.isdir(entry):
-            group_name = (entry.split('/')[-1])
-            files = glob(f'{entry}/*{args.ext}')
-            if args.ext == 'fmp':
-                results, diffs = af.parse_fep_data(files)
-            elif args.ext == 'csv':
-                results, diffs = af.parse_fep_data_from_csv(files)
-            else:
-                raise Exception(f'Only "fmp" and "csv" are accessible file extenstions. You have entered {args.ext}.')
-            df = pd.DataFrame(results)
-            df.to_csv(f'{group_name}_results.csv', index=False, float_format='%.2f')
-            if args.ext == 'fmp':
-                summary = [group_name,
-                           results['number of compounds'].sum(),
-                           results['number of edges'].sum(),
-                           af.summarize_fep_error(results, verbose=False)]
-            else:
-                summary = [group_name,
-                           results['number of compounds'].sum(),
-                           af.summarize_fep_error(results, verbose=False)]
-            group_summaries.append(summary)
-
-    # Now write out the summary table for each group. Every stat has confidence intervals calculated by boostrap
-    # sampling.
-    if args.ext == 'fmp':
-        group_results = {'Name':[], 'No. compounds':[], 'No. edges':[],
-                         'Pairwise MUE':[], 'Pairwise MUE, lower 95%':[], 'Pairwise MUE, upper 95%':[],
-                         'Pairwise RMSE':[],'Pairwise RMSE, lower 95%':[], 'Pairwise RMSE, upper 95%':[],
-                         'Edgewise MUE':[], 'Edgewise MUE, lower 95%':[],'Edgewise MUE, upper 95%':[],
-                         'Edgewise RMSE':[], 'Edgewise RMSE, lower 95%':[],'Edgewise RMSE, upper 95%':[],
-                         'R-squared': [], 'R-squared, lower 95%':[], 'R-squared, upper 95%':[],
-                         'Kendall tau':[], 'Kendall tau, lower 95%':[], 'Kendall tau, upper 95%':[]}
-    else:
-        group_results = {'Name':[], 'No. compounds':[],
-                         'Pairwise MUE':[], 'Pairwise MUE, lower 95%':[], 'Pairwise MUE, upper 95%':[],
-                         'Pairwise RMSE':[],'Pairwise RMSE, lower 95%':[], 'Pairwise RMSE, upper 95%':[],
-                         'R-squared': [], 'R-squared, lower 95%':[], 'R-squared, upper 95%':[],
-                         'Kendall tau':[], 'Kendall tau, lower 95%':[], 'Kendall tau, upper 95%':[]}
+    groups = inc.find_group_files(args.upper_dir, args.ext)
+    if args.cache is not None:
+        cache = inc.BenchmarkCache(args.cache)
+        write_cached_tables(cache, groups, args.ext, args.seed)
+        cache.prune([f for files in groups.values() for f in files])
+        cache.save()
+        print(f'{len(cache.recalculated_maps)} maps and {len(cache.recalculated_summaries)} groups recalculated')
+        return
 
-    for summary in group_summaries:
-        group_results['Name'].append(summary[0])
-        group_results['No. compounds'].append(summary[1])
+    group_summaries = []
+    for group_name, files in groups.items():
         if args.ext == 'fmp':
-            group_results['No. edges'].append(summary[2])
-            pair_rmse, pair_mue, edge_rmse, edge_mue, r2, tau = summary[3]
+            results, diffs = af.parse_fep_data(files)
+        elif args.ext == 'csv':
+            results, diffs = af.parse_fep_data_from_csv(files)
         else:
-            pair_rmse, pair_mue, r2, tau = summary[2]
-        group_results['Pairwise MUE'].append(pair_mue[0])
-        group_results['Pairwise MUE, lower 95%'].append(pair_mue[1])
-        group_results['Pairwise MUE, upper 95%'].append(pair_mue[2])
-        group_results['Pairwise RMSE'].append(pair_rmse[0])
-        group_results['Pairwise RMSE, lower 95%'].append(pair_rmse[1])
-        group_results['Pairwise RMSE, upper 95%'].append(pair_rmse[2])
-        if args.ext == 'fmp':
-            group_results['Edgewise MUE'].append(edge_mue[0])
-            group_results['Edgewise MUE, lower 95%'].append(edge_mue[1])
-            group_results['Edgewise MUE, upper 95%'].append(edge_mue[2])
-            group_results['Edgewise RMSE'].append(edge_rmse[0])
-            group_results['Edgewise RMSE, lower 95%'].append(edge_rmse[1])
-            group_results['Edgewise RMSE, upper 95%'].append(edge_rmse[2])
-        group_results['R-squared'].append(r2[0])
-        group_results['R-squared, lower 95%'].append(r2[1])
-        group_results['R-squared, upper 95%'].append(r2[2])
-        group_results['Kendall tau'].append(tau[0])
-        group_results['Kendall tau, lower 95%'].append(tau[1])
-        group_results['Kendall tau, upper 95%'].append(tau[2])
+            raise Exception(f'Only "fmp" and "csv" are accessible file extenstions. You have entered {args.ext}.')
+        df = pd.DataFrame(results)
+        df.to_csv(f'{group_name}_results.csv', index=False, float_format='%.2f')
+        if args.seed is not None:
+            np.random.seed(args.seed)
+        group_summaries.append(_group_summary(group_name, results, af.summarize_fep_error(results, verbose=False),
+                                              args.ext == 'fmp'))
 
-    df = pd.DataFrame(group_results)
+    df = summary_table(group_summaries, args.ext == 'fmp')
     df.to_csv('group_summaries.csv', index=False, float_format='%.2f')
 
 
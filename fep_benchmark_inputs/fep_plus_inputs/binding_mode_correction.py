@@ -8,7 +8,9 @@ import numpy as np
 from schrodinger.application.desmond.constants import BOLTZMANN
 from schrodinger.application.desmond.measurement import Measurement
 from schrodinger.application.scisol.packages.fep import graph
-from schrodinger.structutils import analyze
+
+import edge_corrections
+import smiles_cache
 
 
 def clean_bennett_from_map(g: graph.Graph):
@@ -44,10 +46,12 @@ def get_binding_mode_nodes(g: graph.Graph) -> List[List[graph.Node]]:
         the list contains all the nodes of the different binding modes of the
         same ligand.
     """
-    # Extract the unique SMILES of each node in the graph and place matching SMILES into the same dict entry
+    # Extract the unique SMILES of each node in the graph and place matching SMILES into the same dict entry. SMILES
+    # are only generated for structures that are not already in the persistent cache.
+    nodes = list(g.nodes_iter())
+    smiles = smiles_cache.get_default_cache().get_smiles([n.struc for n in nodes])
     mode_nodes_dict = defaultdict(list)
-    for n in g.nodes_iter():
-        smile = analyze.generate_smiles(n.struc, unique=True)
+    for n, smile in zip(nodes, smiles):
         mode_nodes_dict[smile].append(n)
 
     # Return the nodes whose SMILES appear multiple times
@@ -68,18 +72,53 @@ def calc_mode_corrections(mode_nodes: List[List[graph.Node]],
     :returns: The binding mode corrections for each ligand. Each correction
         accounts for the presence of the other nodes of the same ligand.
     """
+    return calc_mode_corrections_from_dgs([np.array([n.pred_dg.val for n in nodes]) for nodes in mode_nodes],
+                                          temperature)
+
+
+def calc_mode_corrections_from_dgs(mode_dgs: List[np.ndarray],
+                                   temperature: float = 300.) -> List[np.ndarray]:
+    """
+    Calculate the binding mode corrections from the predicted DGs of the
+    binding modes of each ligand.
+
+    :param mode_dgs: The predicted DGs of the binding modes of each ligand.
+    :param temperature: The temperature of the simulation in Kelvin.
+
+    :returns: The binding mode corrections for each ligand.
+    """
     kT = BOLTZMANN * temperature
     corrections = []
-    for nodes in mode_nodes:
-        dgs = np.array([n.pred_dg.val for n in nodes])
-        corrs = np.zeros(len(dgs))
-        for i in range(len(dgs)):
-            corrs[i] = -kT * np.log(np.sum(np.exp(-(dgs - dgs[i]) / kT)))
+    for dgs in mode_dgs:
+        corrs = -kT * np.log(np.sum(np.exp(-(dgs[np.newaxis, :] - dgs[:, np.newaxis]) / kT), axis=1))
         corrections.append(corrs)
 
     return corrections
 
 
+def add_binding_mode_corrections(layer: edge_corrections.EdgeCorrections,
+                                 mode_nodes: List[List[graph.Node]],
+                                 temperature: float = 300.) -> List[np.ndarray]:
+    """
+    Add the binding mode corrections to a correction layer without applying
+    them. The corrections are calculated from the node DGs that include the
+    other corrections that are pending in the layer.
+
+    :param layer: The corrections of the map that will be applied together.
+    :param mode_nodes: A list of lists that contains the nodes of the different
+        binding modes of the same ligand.
+    :param temperature: The temperature of the simulation in Kelvin.
+
+    :returns: The binding mode corrections for each ligand.
+    """
+    corrections = calc_mode_corrections_from_dgs([layer.predicted_dgs(nodes) for nodes in mode_nodes], temperature)
+    for nodes, corrs in zip(mode_nodes, corrections):
+        # Deducting the correction from the edges that leave a node is an offset of -corr on the node.
+        layer.add_node_offsets(nodes, -corrs)
+
+    return corrections
+
+
 def apply_corrections(mode_nodes: List[List[graph.Node]],
                       corrections: List[np.ndarray]):
     """
@@ -103,12 +142,16 @@ def apply_corrections(mode_nodes: List[List[graph.Node]],
 
 
 def correct_multiple_binding_modes(
-        g: graph.Graph) -> (List[List[graph.Node]], List[np.ndarray]):
+        g: graph.Graph,
+        layer: edge_corrections.EdgeCorrections = None
+) -> (List[List[graph.Node]], List[np.ndarray]):
     """
     Automatically detects different modes, calculates the free energy correction, and applies it to the map. The input
     map is modified in place.
 
     :param g: An FEP+ graph that contains multiple binding modes.
+    :param layer: The other corrections of the map (e.g. symmetry) that have not been applied yet. These are applied
+        together with the binding mode correction with a single cycle closure.
 
     :returns mode_nodes: A list of lists that contains the nodes of the different binding modes of the same ligand.
     :returns corrections: The binding mode corrections for each ligand.
@@ -117,10 +160,11 @@ def correct_multiple_binding_modes(
     clean_bennett_from_map(g)
     # Find which ligands have multiple binding modes using canonicalized SMILES:
     mode_nodes = get_binding_mode_nodes(g)
-    # Calculate the binding mode corrections and apply to the map:
-    corrections = calc_mode_corrections(mode_nodes)
-    apply_corrections(mode_nodes, corrections)
-    g.calc_cycle_closure()
+    # Calculate the binding mode corrections and apply them to the map along with the pending corrections:
+    if layer is None:
+        layer = edge_corrections.EdgeCorrections(g)
+    corrections = add_binding_mode_corrections(layer, mode_nodes)
+    layer.apply()
 
     return mode_nodes, corrections
 
@@ -0,0 +1,270 @@
+import argparse
+import os
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+import fep_map_arrays as fma
+
+
+class ModeGroups:
+    """
+    The nodes of a map grouped by ligand, where a ligand with alternate binding modes has more than one node. The nodes
+    are sorted by ligand once, so that sums and minima over the modes of every ligand are single reductions.
+    """
+
+    def __init__(self, arrays: fma.MapArrays, mode_names: List[List[str]]):
+        """
+        :param arrays: The map.
+        :param mode_names: The node names of the binding modes of each ligand with alternate modes. Nodes that are not
+            listed are ligands with a single mode.
+        """
+        self.arrays = arrays
+        node_ligand = np.full(arrays.nnodes, -1)
+        for lig, names in enumerate(mode_names):
+            node_ligand[arrays.node_indices(names)] = lig
+        single = np.flatnonzero(node_ligand < 0)
+        node_ligand[single] = len(mode_names) + np.arange(len(single))
+        self.node_ligand = node_ligand
+        self.nligands = len(mode_names) + len(single)
+        self.nmulti = len(mode_names)
+
+        self.order = np.argsort(node_ligand, kind='stable')
+        counts = np.bincount(node_ligand, minlength=self.nligands)
+        self.starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        self.ligand_names = [' / '.join(arrays.names[i] for i in np.flatnonzero(node_ligand == l))
+                             for l in range(self.nligands)]
+
+        with np.errstate(invalid='ignore'):
+            exp_sum = np.bincount(node_ligand, np.nan_to_num(arrays.exp_dg), minlength=self.nligands)
+            exp_count = np.bincount(node_ligand, arrays.has_exp, minlength=self.nligands)
+            self.exp_dg = np.where(exp_count > 0, exp_sum / np.maximum(exp_count, 1), np.nan)
+
+        # The edges between different ligands with experimental data, for the edgewise RMSE.
+        has_exp = np.isfinite(self.exp_dg)
+        lig_src, lig_dst = node_ligand[arrays.src], node_ligand[arrays.dst]
+        keep = (lig_src != lig_dst) & has_exp[lig_src] & has_exp[lig_dst]
+        edges = sorted(set(zip(lig_src[keep], lig_dst[keep])))
+        self.edge_incidence = np.zeros((len(edges), self.nligands))
+        for e, (i, j) in enumerate(edges):
+            self.edge_incidence[e, j] += 1
+            self.edge_incidence[e, i] -= 1
+
+    def mixed_dgs(self, dgs: np.ndarray, kT: np.ndarray) -> np.ndarray:
+        """
+        The DG of each ligand over all of its binding modes, -kT ln sum_i exp(-DG_i / kT).
+
+        :param dgs: The DGs of the nodes, shape (nnodes, nsamples).
+        :param kT: The thermal energies, shape (ntemps,).
+
+        :return: The ligand DGs, shape (nligands, nsamples, ntemps).
+        """
+        x = -dgs[self.order, :, np.newaxis] / kT
+        shift = np.maximum.reduceat(x, self.starts, axis=0)
+        total = np.add.reduceat(np.exp(x - shift[self.node_ligand[self.order]]), self.starts, axis=0)
+        return -kT * (shift + np.log(total))
+
+    def kept_modes(self, dgs: np.ndarray) -> np.ndarray:
+        """
+        Whether each node is the mode that merge_ligand_nodes keeps, which is the most favourable mode of its ligand.
+        This does not depend on the temperature.
+
+        :param dgs: The DGs of the nodes, shape (nnodes, nsamples).
+
+        :return: A boolean array of shape (nnodes, nsamples).
+        """
+        lowest = np.minimum.reduceat(dgs[self.order], self.starts, axis=0)
+        return dgs <= lowest[self.node_ligand]
+
+    def metrics(self, ligand_dgs: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        The edgewise and pairwise RMSE of the merged map for every sample and temperature.
+
+        :param ligand_dgs: The ligand DGs, shape (nligands, nsamples, ntemps).
+        """
+        nligands, nsamples, ntemps = ligand_dgs.shape
+        metrics = fma.scan_metrics(ligand_dgs.reshape(nligands, -1), self.edge_incidence, self.exp_dg)
+        return {k: v.reshape(nsamples, ntemps) for k, v in metrics.items()}
+
+
+def sample_node_dgs(arrays: fma.MapArrays, nsamples: int, rng: np.random.Generator,
+                    method: str = 'closure') -> np.ndarray:
+    """
+    Sample the node DGs of a map from their uncertainties.
+
+    :param arrays: The map.
+    :param nsamples: The number of samples.
+    :param rng: The random number generator.
+    :param method: 'closure' to draw the edge DDGs from their uncertainties and solve the cycle closure of all samples
+        at once, which keeps the correlations between the nodes, or 'independent' to draw each node DG independently
+        with its propagated uncertainty.
+
+    :return: The node DGs, shape (nnodes, nsamples).
+    """
+    if method == 'closure':
+        return arrays.solve(arrays.sample_ddgs(nsamples, rng))
+    elif method == 'independent':
+        dg = arrays.solve(arrays.ddg)
+        unc = arrays.node_uncertainties()
+        return dg[:, np.newaxis] + unc[:, np.newaxis] * rng.standard_normal((arrays.nnodes, nsamples))
+    raise ValueError(f'Unknown sampling method {method}. Choose from "closure" or "independent".')
+
+
+def run_sensitivity(arrays: fma.MapArrays, mode_names: List[List[str]], temperatures: Sequence[float] = (300.,),
+                    nsamples: int = 1000, seed: int = 0, method: str = 'closure') -> Dict[str, pd.DataFrame]:
+    """
+    Monte Carlo sensitivity of the binding mode correction of a map to the uncertainty of the node DGs and the
+    temperature. The correction of mode i is -kT ln sum_j exp(-(DG_j - DG_i) / kT), as in calc_mode_corrections.
+
+    :param arrays: The map.
+    :param mode_names: The node names of the binding modes of each ligand with alternate modes.
+    :param temperatures: The temperatures in K.
+    :param nsamples: The number of Monte Carlo samples.
+    :param seed: The seed of the random number generator.
+    :param method: How the node DGs are sampled, see sample_node_dgs.
+
+    :return: A dictionary of dataframes: 'modes' with the distribution of the correction of every mode and how often
+        it is kept, 'ligands' with how often the kept mode changes, and 'metrics' with the spread of the accuracy of
+        the merged map.
+    """
+    groups = ModeGroups(arrays, mode_names)
+    temperatures = np.asarray(temperatures, dtype=float)
+    kT = fma.BOLTZMANN * temperatures
+    rng = np.random.default_rng(seed)
+
+    # Every sample is shifted by the same constant as the point estimate, which aligns it to experiment.
+    closure = arrays.solve(arrays.ddg)
+    dg0 = arrays.align_to_experiment(closure) if np.any(arrays.has_exp) else closure
+    dgs = sample_node_dgs(arrays, nsamples, rng, method) + (dg0 - closure)[:, np.newaxis]
+    ligand_dgs = groups.mixed_dgs(dgs, kT)
+    corrections = ligand_dgs[groups.node_ligand] - dgs[:, :, np.newaxis]
+    point = groups.mixed_dgs(dg0[:, np.newaxis], kT)[:, 0]
+    point_corrections = point[groups.node_ligand] - dg0[:, np.newaxis]
+    kept = groups.kept_modes(dgs)
+    kept0 = groups.kept_modes(dg0[:, np.newaxis])[:, 0]
+
+    multi = np.flatnonzero(groups.node_ligand < groups.nmulti)
+    multi = multi[np.argsort(groups.node_ligand[multi], kind='stable')]
+    rows = []
+    for t, temperature in enumerate(temperatures):
+        lower, median, upper = np.percentile(corrections[multi, :, t], [2.5, 50, 97.5], axis=1)
+        for k, i in enumerate(multi):
+            rows.append({'Ligand': groups.ligand_names[groups.node_ligand[i]],
+                         'Mode': arrays.names[i],
+                         'Temperature (K)': temperature,
+                         'Pred. dG (kcal/mol)': dg0[i],
+                         'Correction (kcal/mol)': point_corrections[i, t],
+                         'Mean correction (kcal/mol)': corrections[i, :, t].mean(),
+                         'Correction std. (kcal/mol)': corrections[i, :, t].std(),
+                         'Median correction (kcal/mol)': median[k],
+                         'Lower correction (kcal/mol)': lower[k],
+                         'Upper correction (kcal/mol)': upper[k],
+                         'Kept': bool(kept0[i]),
+                         'Fraction kept': kept[i].mean()})
+    df_modes = pd.DataFrame(rows)
+
+    rows = []
+    for lig in range(groups.nmulti):
+        nodes = np.flatnonzero(groups.node_ligand == lig)
+        kept_node = nodes[kept0[nodes]][0]
+        rows.append({'Ligand': groups.ligand_names[lig],
+                     'Number of modes': len(nodes),
+                     'Kept mode': arrays.names[kept_node],
+                     'Fraction kept mode changes': 1 - kept[kept_node].mean()})
+    df_ligands = pd.DataFrame(rows)
+
+    metrics = groups.metrics(ligand_dgs)
+    point_metrics = groups.metrics(point[:, np.newaxis, :])
+    rows = []
+    for name, values in metrics.items():
+        lower, upper = np.percentile(values, [2.5, 97.5], axis=0)
+        for t, temperature in enumerate(temperatures):
+            rows.append({'Metric': f'{name.capitalize()} RMSE (kcal/mol)',
+                         'Temperature (K)': temperature,
+                         'Value': point_metrics[name][0, t],
+                         'Mean': values[:, t].mean(),
+                         'Std.': values[:, t].std(),
+                         'Lower': lower[t],
+                         'Upper': upper[t]})
+    df_metrics = pd.DataFrame(rows)
+
+    return {'modes': df_modes, 'ligands': df_ligands, 'metrics': df_metrics}
+
+
+def read_modes_file(path: str) -> List[List[str]]:
+    """
+    Read the binding modes of the ligands from a text file with the comma separated node names of the modes of one
+    ligand on each line.
+    """
+    with open(path) as f:
+        return [[n.strip() for n in line.split(',')] for line in f if line.strip() != '']
+
+
+def load_fmp(path: str) -> Tuple[fma.MapArrays, List[List[str]]]:
+    """
+    Read a map and detect its binding modes with the same SMILES grouping as binding_mode_correction.py. Requires a
+    Schrodinger installation.
+    """
+    from schrodinger.application.scisol.packages.fep import graph
+    import binding_mode_correction as bmc
+    import edge_corrections as ec
+
+    g = graph.Graph.deserialize(path)
+    arrays = fma.MapArrays.from_graph(g)
+    mode_names = [[ec.get_ligname(n) for n in nodes] for nodes in bmc.get_binding_mode_nodes(g)]
+    return arrays, mode_names
+
+
+def main(argv=None):
+    usage = """
+    Estimate how sensitive the binding mode correction of a map is to the uncertainty of the calculations, either
+    directly from an FEP+ map
+
+        $SCHRODINGER/run binding_mode_sensitivity.py map_out.fmp -t 280 300 320 -n 2000
+
+    or, without a Schrodinger license, from an edge prediction CSV and a file that lists the modes of each ligand
+
+        python binding_mode_sensitivity.py map_out.csv --modes map_modes.txt
+    """
+    description = """
+    Sample the node DGs from their uncertainties and sweep the temperature to report the distribution of the binding
+    mode correction of every mode, how often the kept mode of each ligand changes and the spread of the map metrics
+    after the modes have been merged. All samples and temperatures are evaluated at once.
+    """
+    parser = argparse.ArgumentParser(usage=usage, description=description)
+    parser.add_argument('infile', type=str, help="An out fmp file or an edge prediction CSV file.")
+    parser.add_argument('--modes', type=str, help="A file with the comma separated names of the modes of a ligand on "
+                                                  "each line. Required for CSV input.", default=None)
+    parser.add_argument('-o', dest='prefix', type=str,
+                        help="The prefix of the output CSV files, default=the input name.", default=None)
+    parser.add_argument('-t', '--temperatures', type=float, nargs='+', help="The temperatures in K, default=300.",
+                        default=[300.])
+    parser.add_argument('-n', dest='nsamples', type=int, help="The number of Monte Carlo samples, default=1000.",
+                        default=1000)
+    parser.add_argument('--method', type=str, choices=['closure', 'independent'],
+                        help="Sample the edge DDGs and solve the cycle closure (closure), or sample the node DGs "
+                             "independently (independent), default=closure.", default='closure')
+    parser.add_argument('--seed', type=int, help="The seed of the random number generator, default=0.", default=0)
+    args = parser.parse_args(argv)
+
+    if args.infile.endswith('.fmp'):
+        arrays, mode_names = load_fmp(args.infile)
+    else:
+        if args.modes is None:
+            parser.error('--modes is required for CSV input.')
+        arrays = fma.MapArrays.from_edge_csv(args.infile)
+    if args.modes is not None:
+        mode_names = read_modes_file(args.modes)
+
+    results = run_sensitivity(arrays, mode_names, args.temperatures, args.nsamples, args.seed, args.method)
+
+    prefix = args.prefix if args.prefix is not None else os.path.splitext(args.infile)[0]
+    for name, df in results.items():
+        df.to_csv(f'{prefix}_bm_{name}.csv', index=False)
+    print(results['ligands'].to_string(index=False))
+    print(results['metrics'].to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
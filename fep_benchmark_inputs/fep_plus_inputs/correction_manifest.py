@@ -0,0 +1,103 @@
+import json
+import os
+from typing import Dict, Iterator, Optional, Tuple
+
+# The manifest that lists every map of the benchmark and the post-simulation corrections it requires.
+DEFAULT_MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corrections_manifest.json')
+
+# kT in kcal/mol at 300 K, as used by all of the correction scripts.
+KT = 0.596
+
+STEP_TYPES = ('remove_incomplete', 'symmetry', 'binding_mode', 'pka', 'solvent_pka')
+
+
+def load_manifest(path: Optional[str] = None) -> Dict:
+    """
+    Read and check a correction manifest.
+
+    The manifest is a JSON file with a 'groups' entry. Each group has the name of the text file that lists its output
+    maps ('outs_file') and a list of 'maps'. Every map has a 'name', the 'input' fmp (or a list of 'inputs' that are
+    merged into one map), the 'output' fmp, an optional table of 'symmetry_numbers' and an ordered list of correction
+    'steps'. Maps with '"skip": true' are kept in the manifest for their tables but are not processed. All paths of a map are relative to its group directory, which in turn is relative to the manifest.
+
+    :param path: The location of the manifest. Defaults to corrections_manifest.json next to this module.
+
+    :return: The manifest as a dictionary.
+    """
+    if path is None:
+        path = DEFAULT_MANIFEST
+    with open(path) as f:
+        manifest = json.load(f)
+
+    for group_name, group in manifest['groups'].items():
+        names = set()
+        for m in group['maps']:
+            if m['name'] in names:
+                raise ValueError(f'Map {m["name"]} appears more than once in group {group_name} of {path}.')
+            names.add(m['name'])
+            if ('input' in m) == ('inputs' in m):
+                raise ValueError(f'Map {m["name"]} must have either an "input" or a list of "inputs".')
+            for step in m.get('steps', []):
+                if step['type'] not in STEP_TYPES:
+                    raise ValueError(f'Unknown correction "{step["type"]}" for map {m["name"]}. '
+                                     f'Choose from {STEP_TYPES}.')
+                if step['type'] == 'symmetry' and 'symmetry_numbers' not in m:
+                    raise ValueError(f'Map {m["name"]} has a symmetry correction but no "symmetry_numbers".')
+
+    return manifest
+
+
+def iter_maps(manifest: Dict) -> Iterator[Tuple[str, Dict]]:
+    """
+    Loop over every map in the manifest in order.
+
+    :return: Pairs of the group name and the map entry.
+    """
+    for group_name, group in manifest['groups'].items():
+        for m in group['maps']:
+            yield group_name, m
+
+
+def get_map(name: str, manifest: Optional[Dict] = None, group: Optional[str] = None) -> Dict:
+    """
+    Return the manifest entry of a map by name.
+
+    :param name: The name of the map, e.g. 'a2a_hip278'.
+    :param manifest: A loaded manifest. The default manifest is read if None.
+    :param group: The group of the map. Only required if maps in different groups share the name.
+    """
+    if manifest is None:
+        manifest = load_manifest()
+    matches = [m for group_name, m in iter_maps(manifest)
+               if m['name'] == name and (group is None or group_name == group)]
+    if len(matches) == 0:
+        raise KeyError(f'Map {name} is not in the correction manifest.')
+    if len(matches) > 1:
+        raise KeyError(f'Map {name} appears in more than one group of the correction manifest. Specify the group.')
+    return matches[0]
+
+
+def get_symmetry_numbers(name: str, manifest: Optional[Dict] = None) -> Dict:
+    """
+    Return the symmetry number table of a map. The table has a dictionary of per-ligand 'ligands' symmetry numbers and
+    an optional 'default' symmetry number of the other ligands.
+
+    :param name: The name of the map, e.g. 'a2a_hip278'.
+    :param manifest: A loaded manifest. The default manifest is read if None.
+    """
+    return get_map(name, manifest)['symmetry_numbers']
+
+
+def symmetry_number(table: Dict, ligand: str) -> int:
+    """
+    Look up the symmetry number of a ligand in a symmetry number table. Tables without a 'default' must list every
+    ligand of the map.
+
+    :raise KeyError: If the ligand is not in a table without a 'default'.
+    """
+    ligands = table.get('ligands', {})
+    if ligand in ligands:
+        return ligands[ligand]
+    if 'default' not in table:
+        raise KeyError(f'Ligand {ligand} is not in the symmetry number table, which has no default.')
+    return table['default']
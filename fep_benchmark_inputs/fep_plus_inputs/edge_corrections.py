@@ -0,0 +1,96 @@
+from typing import Dict, List
+
+import numpy as np
+
+from schrodinger.application.scisol.packages.fep import graph
+
+import correction_manifest as cm
+
+
+def get_ligname(node: graph.Node) -> str:
+    return node.short_id_title.split(':')[1].strip()
+
+
+class EdgeCorrections:
+    """
+    Accumulate the post-simulation corrections of a map and apply them with a single cycle closure.
+
+    Every correction in this benchmark (symmetry, solvent pKa and binding mode) is a free energy offset c of each node,
+    which changes the DDG of the edge i -> j by c[i] - c[j]. As the offsets are a potential on the nodes, cycle closure
+    of the corrected edges gives exactly the previous node DGs minus c. The corrections can therefore be composed as a
+    vector of node offsets, turned into one vector of edge offsets and solved once, rather than solving after each
+    correction.
+
+    The ligand names of the nodes are parsed once, when the layer is made. Nodes must not be added or removed from the
+    graph until the corrections have been applied.
+    """
+
+    def __init__(self, g: graph.Graph):
+        """
+        :param g: An FEP+ graph with output data. Cycle closure must have been run.
+        """
+        self.g = g
+        self.nodes = list(g.nodes_iter())
+        self.node_index = {n: i for i, n in enumerate(self.nodes)}
+        self.lignames = [get_ligname(n) for n in self.nodes]
+        self.edges = list(g.edges_iter())
+        self.src = np.array([self.node_index[e.direction[0]] for e in self.edges], dtype=int)
+        self.dst = np.array([self.node_index[e.direction[1]] for e in self.edges], dtype=int)
+        self.node_offsets = np.zeros(len(self.nodes))
+
+    def add_node_offsets(self, nodes: List[graph.Node], offsets: np.ndarray):
+        """
+        Add free energy offsets to some of the nodes.
+
+        :param nodes: The nodes that will be offset.
+        :param offsets: The offset of each node in kcal/mol. The DDG of an edge i -> j changes by offsets[i] - offsets[j].
+        """
+        inds = np.array([self.node_index[n] for n in nodes], dtype=int)
+        np.add.at(self.node_offsets, inds, offsets)
+
+    def add_symmetry(self, symmetry_numbers: Dict, kT: float = cm.KT):
+        """
+        Add the rotational symmetry correction kT ln(sigma) of each ligand.
+
+        :param symmetry_numbers: The symmetry number table of the map from the correction manifest.
+        :param kT: The thermal energy in kcal/mol.
+        """
+        sigma = np.array([cm.symmetry_number(symmetry_numbers, l) for l in self.lignames], dtype=float)
+        self.node_offsets += kT * np.log(sigma)
+
+    def add_solvent_pka(self, pka_dict: Dict, ph: float = 7., kT: float = cm.KT):
+        """
+        Add the free energy penalty -kT ln(1 + 10^(pKa - pH)) to isolate the neutral form of each ligand in solvent.
+
+        :param pka_dict: The macro pKas of the ligands by ligand name. Every ligand in the map must have a pKa.
+        :param ph: The pH of the solvent.
+        :param kT: The thermal energy in kcal/mol.
+        """
+        pkas = np.array([pka_dict[l] for l in self.lignames], dtype=float)
+        self.node_offsets += -kT * np.log(1 + 10 ** (pkas - ph))
+
+    def predicted_dgs(self, nodes: List[graph.Node]) -> np.ndarray:
+        """
+        Return the node DGs that the pending corrections will produce, up to an additive constant, without solving the
+        cycle closure.
+        """
+        inds = np.array([self.node_index[n] for n in nodes], dtype=int)
+        pred = np.array([n.pred_dg.val for n in nodes])
+        return pred - self.node_offsets[inds]
+
+    def edge_offsets(self) -> np.ndarray:
+        """
+        The offset of every edge in the graph, in the order of self.edges.
+        """
+        return self.node_offsets[self.src] - self.node_offsets[self.dst]
+
+    def apply(self):
+        """
+        Add the edge offsets to the complex DDG of every edge with results and run cycle closure once. The graph is
+        modified in place and the pending corrections are reset.
+        """
+        for e, offset in zip(self.edges, self.edge_offsets()):
+            if e.complex_dg is not None and offset != 0:
+                e.complex_dg += float(offset)
+        self.g.calc_cycle_closure()
+        self.node_offsets = np.zeros(len(self.nodes))
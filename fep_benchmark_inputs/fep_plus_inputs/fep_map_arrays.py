@@ -0,0 +1,607 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import minimize
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+import correction_manifest as cm
+
+# The Boltzmann constant in kcal/mol/K that gives the kT of the correction scripts at 300 K.
+BOLTZMANN = cm.KT / 300.
+
+
+class MapArrays:
+    """
+    A licence-free array representation of a perturbation map: the edge endpoints, the raw (Bennett) DDG of each edge
+    and the experimental DG of each node.
+
+    Cycle closure is the unweighted least-squares fit of node DGs to the edge DDGs, which reproduces the FEP+ cycle
+    closure DDGs in 21_4_results/edge_predictions to within their rounding. The normal equations are factorized once, so
+    every subsequent closure, for example with different corrections added to the edges, is a pair of triangular
+    solves.
+    """
+
+    def __init__(self, names: Sequence[str], src: np.ndarray, dst: np.ndarray, ddg: np.ndarray,
+                 exp_dg: Optional[np.ndarray] = None, unc: Optional[np.ndarray] = None):
+        """
+        :param names: The name of each node.
+        :param src: The index of the initial node of each edge.
+        :param dst: The index of the final node of each edge.
+        :param ddg: The DDG of each edge, DG[dst] - DG[src], in kcal/mol.
+        :param exp_dg: The experimental DG of each node. Nodes without experimental data are NaN.
+        :param unc: The statistical uncertainty of the DDG of each edge. Defaults to zero.
+        """
+        self.names = list(names)
+        self.name_index = {n: i for i, n in enumerate(self.names)}
+        self.src = np.asarray(src, dtype=int)
+        self.dst = np.asarray(dst, dtype=int)
+        self.ddg = np.asarray(ddg, dtype=float)
+        nnodes = len(self.names)
+        if exp_dg is None:
+            exp_dg = np.full(nnodes, np.nan)
+        self.exp_dg = np.asarray(exp_dg, dtype=float)
+        self.unc = np.zeros(len(self.ddg)) if unc is None else np.asarray(unc, dtype=float)
+
+        # The incidence matrix, with B @ dg = dg[dst] - dg[src].
+        nedges = len(self.src)
+        self.incidence = np.zeros((nedges, nnodes))
+        self.incidence[np.arange(nedges), self.dst] += 1
+        self.incidence[np.arange(nedges), self.src] -= 1
+
+        # The graph Laplacian is singular along the mean of each connected component. Fixing the mean of each component
+        # to zero makes the normal equations positive definite.
+        adjacency = coo_matrix((np.ones(nedges), (self.src, self.dst)), shape=(nnodes, nnodes))
+        ncomps, self.component = connected_components(adjacency, directed=False)
+        comp = np.zeros((nnodes, ncomps))
+        comp[np.arange(nnodes), self.component] = 1
+        comp /= np.sqrt(comp.sum(axis=0))
+        self._factor = cho_factor(self.incidence.T @ self.incidence + comp @ comp.T)
+
+        self.has_exp = np.isfinite(self.exp_dg)
+        self.exp_edges = self.has_exp[self.src] & self.has_exp[self.dst]
+
+    @classmethod
+    def from_graph(cls, g) -> 'MapArrays':
+        """
+        Extract the arrays from an FEP+ graph. Edges without results are skipped.
+
+        :param g: A schrodinger.application.scisol.packages.fep.graph.Graph with output data.
+        """
+        nodes = list(g.nodes_iter())
+        node_index = {n: i for i, n in enumerate(nodes)}
+        names = [n.short_id_title.split(':')[1].strip() for n in nodes]
+        exp_dg = np.array([n.exp_dg.val if n.exp_dg is not None else np.nan for n in nodes])
+        src, dst, ddg, unc = [], [], [], []
+        for e in g.edges_iter():
+            if e.complex_dg is None or e.solvent_dg is None:
+                continue
+            n1, n2 = e.direction
+            src.append(node_index[n1])
+            dst.append(node_index[n2])
+            ddg.append(e.complex_dg.val - e.solvent_dg.val)
+            unc.append(np.sqrt(e.complex_dg.unc ** 2 + e.solvent_dg.unc ** 2))
+        return cls(names, src, dst, ddg, exp_dg, unc)
+
+    @classmethod
+    def from_edge_csv(cls, edge_csv: str, ligand_csv: Optional[str] = None) -> 'MapArrays':
+        """
+        Read the arrays from the CSV files in 21_4_results, so that no Schrodinger installation is required.
+
+        :param edge_csv: A file from 21_4_results/edge_predictions, whose first two columns are the ligand names of the
+            edge and which has 'Bennett ddG (kcal/mol)' and 'Exp. ddG (kcal/mol)' columns.
+        :param ligand_csv: A file from 21_4_results/ligand_predictions with the experimental DG of each ligand. If None,
+            the experimental DGs are reconstructed from the experimental DDGs of the edges, up to a constant.
+        """
+        df = pd.read_csv(edge_csv, dtype={0: str, 1: str})
+        lig1 = df.iloc[:, 0].astype(str).values
+        lig2 = df.iloc[:, 1].astype(str).values
+        df = df.loc[pd.notna(df['Bennett ddG (kcal/mol)'])]
+        lig1, lig2 = lig1[df.index], lig2[df.index]
+        names = list(dict.fromkeys(list(lig1) + list(lig2)))
+        name_index = {n: i for i, n in enumerate(names)}
+        src = np.array([name_index[n] for n in lig1], dtype=int)
+        dst = np.array([name_index[n] for n in lig2], dtype=int)
+        arrays = cls(names, src, dst, df['Bennett ddG (kcal/mol)'].values,
+                     unc=np.nan_to_num(df['Bennett std. error (kcal/mol)'].values))
+
+        if ligand_csv is not None:
+            df_lig = pd.read_csv(ligand_csv, dtype={'Ligand name': str})
+            lig2exp = dict(zip(df_lig['Ligand name'], df_lig['Exp. dG (kcal/mol)']))
+            exp_dg = np.array([lig2exp.get(n, np.nan) for n in names], dtype=float)
+        else:
+            exp_ddg = df['Exp. ddG (kcal/mol)'].values
+            known = np.isfinite(exp_ddg)
+            exp_arrays = cls(names, src[known], dst[known], exp_ddg[known])
+            exp_dg = exp_arrays.solve(exp_arrays.ddg)
+            touched = np.zeros(len(names), dtype=bool)
+            touched[src[known]] = True
+            touched[dst[known]] = True
+            exp_dg[~touched] = np.nan
+        return cls(names, src, dst, arrays.ddg, exp_dg, arrays.unc)
+
+    @property
+    def nnodes(self) -> int:
+        return len(self.names)
+
+    @property
+    def nedges(self) -> int:
+        return len(self.src)
+
+    def node_indices(self, names: Sequence[str]) -> np.ndarray:
+        return np.array([self.name_index[n] for n in names], dtype=int)
+
+    def solve(self, ddg: np.ndarray) -> np.ndarray:
+        """
+        Cycle closure with the cached factorization.
+
+        :param ddg: The edge DDGs, either one array of length nedges or an array of shape (nedges, k) to solve k sets of
+            DDGs at once.
+
+        :return: The node DGs, with zero mean in each connected component.
+        """
+        return cho_solve(self._factor, self.incidence.T @ ddg)
+
+    def node_uncertainties(self) -> np.ndarray:
+        """
+        The standard error of each node DG from cycle closure, propagated from the uncertainties of the edge DDGs.
+        """
+        # The node DGs are a linear function of the edge DDGs, dg = (B^T B + C C^T)^-1 B^T ddg.
+        response = cho_solve(self._factor, self.incidence.T)
+        return np.sqrt(np.sum((response * self.unc) ** 2, axis=1))
+
+    def sample_ddgs(self, nsamples: int, rng: np.random.Generator) -> np.ndarray:
+        """
+        Draw the edge DDGs from normal distributions with their uncertainties.
+
+        :return: The samples, shape (nedges, nsamples).
+        """
+        return self.ddg[:, np.newaxis] + self.unc[:, np.newaxis] * rng.standard_normal((self.nedges, nsamples))
+
+    def solve_offsets(self, node_offsets: np.ndarray) -> np.ndarray:
+        """
+        Cycle closure of the raw DDGs after the DDG of each edge i -> j has been changed by
+        node_offsets[i] - node_offsets[j], which is how the symmetry, pKa and binding mode corrections enter.
+
+        :param node_offsets: The offsets of every node, shape (nnodes,) or (nnodes, k).
+        """
+        edge_offsets = node_offsets[self.src] - node_offsets[self.dst]
+        ddg = self.ddg if edge_offsets.ndim == 1 else self.ddg[:, np.newaxis]
+        return self.solve(ddg + edge_offsets)
+
+    def align_to_experiment(self, dg: np.ndarray) -> np.ndarray:
+        """
+        Shift the predicted DGs so that their mean equals the mean of the experimental DGs, as is done for the CSV files
+        in 21_4_results/ligand_predictions.
+        """
+        shift = np.mean(self.exp_dg[self.has_exp]) - np.mean(dg[self.has_exp], axis=0)
+        return dg + shift
+
+    def edgewise_rmse(self, dg: np.ndarray) -> np.ndarray:
+        """
+        The RMSE of the cycle closure DDGs against the experimental DDGs, over the edges whose nodes both have
+        experimental data.
+
+        :param dg: The node DGs, shape (nnodes,) or (nnodes, k).
+        """
+        bm = self.incidence[self.exp_edges]
+        return weighted_rmse(bm @ dg - _column(bm @ np.nan_to_num(self.exp_dg), dg))[0]
+
+    def pairwise_rmse(self, dg: np.ndarray) -> np.ndarray:
+        """
+        The RMSE of all pairwise DG differences against experiment, over the nodes with experimental data.
+
+        :param dg: The node DGs, shape (nnodes,) or (nnodes, k).
+        """
+        return weighted_pairwise_rmse(dg[self.has_exp] - _column(self.exp_dg[self.has_exp], dg))[0]
+
+
+def _column(x: np.ndarray, like: np.ndarray) -> np.ndarray:
+    return x[:, np.newaxis] if like.ndim > 1 else x
+
+
+def weighted_rmse(resid: np.ndarray, weights: Optional[np.ndarray] = None):
+    """
+    The weighted RMSE of residuals and its derivative with respect to each residual. Bootstrap samples are represented
+    by weights that count how many times each residual was drawn.
+
+    :param resid: The residuals, shape (n,) or (n, k) for k sets at once.
+    :param weights: The weight of each residual, default=1.
+
+    :return: The RMSE and, for one set of residuals, the derivative.
+    """
+    if weights is None:
+        weights = np.ones(len(resid))
+    weights = _column(weights, resid)
+    f = np.sqrt(np.sum(weights * resid ** 2, axis=0) / np.sum(weights, axis=0))
+    if resid.ndim > 1:
+        return f, None
+    if f == 0:
+        return f, np.zeros(len(resid))
+    return f, weights * resid / (np.sum(weights) * f)
+
+
+def weighted_pairwise_rmse(err: np.ndarray, weights: Optional[np.ndarray] = None):
+    """
+    The RMSE of all pairwise differences of the errors e of m ligands and its derivative with respect to each error.
+    The sum over all pairs of (e_i - e_j)^2 is m times the sum of (e_i - mean(e))^2, so no pairs are formed. Weights
+    count how many times each ligand was drawn in a bootstrap sample.
+
+    :param err: The errors of the ligands, shape (m,) or (m, k) for k sets at once.
+    :param weights: The weight of each ligand, default=1.
+
+    :return: The RMSE and, for one set of errors, the derivative.
+    """
+    if weights is None:
+        weights = np.ones(len(err))
+    weights = _column(weights, err)
+    m = np.sum(weights, axis=0)
+    centred = err - np.sum(weights * err, axis=0) / m
+    f = np.sqrt(2 * np.sum(weights * centred ** 2, axis=0) / (m - 1))
+    if err.ndim > 1:
+        return f, None
+    if f == 0:
+        return f, np.zeros(len(err))
+    return f, 2 * weights * centred / ((m - 1) * f)
+
+
+def scan_grid(phs: Sequence[float], temperatures: Sequence[float]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Flatten a grid of pH values and temperatures into one batch axis.
+
+    :return: The pH and kT of each of the len(phs) * len(temperatures) points, with the temperature varying fastest.
+    """
+    ph, temperature = np.meshgrid(np.asarray(phs, dtype=float), np.asarray(temperatures, dtype=float), indexing='ij')
+    return ph.ravel(), BOLTZMANN * temperature.ravel()
+
+
+def scan_metrics(dg: np.ndarray, edge_incidence: np.ndarray, exp_dg: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    The edgewise and pairwise RMSE of many sets of DGs at once.
+
+    :param dg: The DGs, shape (n, k).
+    :param edge_incidence: The incidence matrix of the edges that are compared with experiment, shape (nedges, n).
+    :param exp_dg: The experimental DGs, NaN where unknown.
+
+    :return: The 'edgewise' and 'pairwise' RMSE of each of the k sets.
+    """
+    has_exp = np.isfinite(exp_dg)
+    exp_ddg = edge_incidence @ np.nan_to_num(exp_dg)
+    return {'edgewise': weighted_rmse(edge_incidence @ dg - exp_ddg[:, np.newaxis])[0],
+            'pairwise': weighted_pairwise_rmse(dg[has_exp] - exp_dg[has_exp, np.newaxis])[0]}
+
+
+def node_solvent_penalty(pkas: np.ndarray, ph: float = 7., kT: float = cm.KT) -> np.ndarray:
+    """
+    The free energy -kT ln(1 + 10^(pKa - pH)) of selecting the neutral form of each ligand in solvent. The difference
+    between two ligands is the solvent_penalty of sd_analysis_tools.py. pkas and ph broadcast against each other.
+    """
+    return -kT * np.log1p(10 ** (pkas - ph))
+
+
+def node_solvent_penalty_derivative(pkas: np.ndarray, ph: float = 7., kT: float = cm.KT) -> np.ndarray:
+    """
+    The derivative of node_solvent_penalty with respect to the pKa.
+    """
+    top = 10 ** (pkas - ph)
+    return -kT * np.log(10) * top / (1 + top)
+
+
+class SolventPkaObjective:
+    """
+    The accuracy of a map as a function of the solvent pKas of some of its ligands, with an analytic gradient.
+
+    Everything that does not depend on the fitted pKas is computed once: the penalties of the ligands with fixed pKas
+    and the response of the node DGs to a change in the node offsets. Each evaluation is then a handful of small array
+    operations.
+    """
+
+    def __init__(self, arrays: MapArrays, pka_dict: Dict[str, float], fit_ligands: List[str], ph: float = 7.,
+                 kT: float = cm.KT, metric: str = 'edgewise'):
+        """
+        :param arrays: The map.
+        :param pka_dict: The pKas of the ligands by name. Ligands that are not listed are not corrected.
+        :param fit_ligands: The names of the ligands whose pKas are fitted.
+        :param ph: The pH of the solvent.
+        :param kT: The thermal energy in kcal/mol.
+        :param metric: Either 'edgewise' or 'pairwise' RMSE.
+        """
+        if metric not in ('edgewise', 'pairwise'):
+            raise ValueError(f'Unknown metric {metric}. Choose from "edgewise" or "pairwise".')
+        self.arrays = arrays
+        self.ph = ph
+        self.kT = kT
+        self.metric = metric
+        self.fit_inds = arrays.node_indices(fit_ligands)
+
+        pkas = np.full(arrays.nnodes, -np.inf)
+        for name, pka in pka_dict.items():
+            if name in arrays.name_index:
+                pkas[arrays.name_index[name]] = pka
+        self.base_pkas = pkas
+        # A pKa of -inf gives no penalty.
+        self.base_offsets = node_solvent_penalty(pkas, ph, kT)
+        self.base_offsets[self.fit_inds] = 0.
+        self.dg0 = arrays.solve_offsets(self.base_offsets)
+
+        # The node DGs respond linearly to the node offsets: dg = dg0 + response @ offsets, and only the fitted nodes
+        # change.
+        self.response = -arrays.solve(arrays.incidence[:, self.fit_inds])
+
+    def node_dgs(self, pkas: np.ndarray) -> np.ndarray:
+        """
+        The cycle closure DGs for the fitted pKas.
+
+        :param pkas: The pKas of the fitted ligands, shape (nfit,) or (nfit, k) for k sets at once.
+        """
+        c = node_solvent_penalty(pkas, self.ph, self.kT)
+        if c.ndim == 1:
+            return self.dg0 + self.response @ c
+        return self.dg0[:, np.newaxis] + self.response @ c
+
+    def scan(self, pkas: np.ndarray, phs: Sequence[float],
+             temperatures: Sequence[float]) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """
+        The node DGs and accuracy of the map over a grid of pH values and temperatures, evaluated as one batch of cycle
+        closures. The penalties of all ligands, fitted or not, change with the pH and temperature. The DDGs of the edges
+        are those of the simulations and do not change with temperature.
+
+        :param pkas: The pKas of the fitted ligands.
+        :param phs: The pH values of the grid.
+        :param temperatures: The temperatures of the grid in K.
+
+        :return: The node DGs, shape (nnodes, len(phs), len(temperatures)), aligned to the mean experimental DG, and
+            the 'edgewise' and 'pairwise' RMSE, each of shape (len(phs), len(temperatures)).
+        """
+        ph, kT = scan_grid(phs, temperatures)
+        all_pkas = self.base_pkas.copy()
+        all_pkas[self.fit_inds] = pkas
+        dg = self.arrays.solve_offsets(node_solvent_penalty(all_pkas[:, np.newaxis], ph, kT))
+        arrays = self.arrays
+        metrics = scan_metrics(dg, arrays.incidence[arrays.exp_edges], arrays.exp_dg)
+        shape = (len(phs), len(temperatures))
+        dg = arrays.align_to_experiment(dg) if np.any(arrays.has_exp) else dg
+        return dg.reshape((arrays.nnodes,) + shape), {k: v.reshape(shape) for k, v in metrics.items()}
+
+    @property
+    def nunits(self) -> int:
+        """
+        The number of edges or ligands that the metric averages over, which are the units of bootstrap resampling.
+        """
+        if self.metric == 'edgewise':
+            return int(np.sum(self.arrays.exp_edges))
+        return int(np.sum(self.arrays.has_exp))
+
+    def __call__(self, pkas: np.ndarray) -> float:
+        return self.value(pkas)
+
+    def _metric(self, pkas: np.ndarray, weights: Optional[np.ndarray]):
+        arrays = self.arrays
+        dg = self.node_dgs(pkas)
+        if self.metric == 'edgewise':
+            bm = arrays.incidence[arrays.exp_edges]
+            f, d_resid = weighted_rmse(bm @ dg - _column(bm @ np.nan_to_num(arrays.exp_dg), dg), weights)
+            d_dg = bm.T @ d_resid if d_resid is not None else None
+        else:
+            f, d_err = weighted_pairwise_rmse(dg[arrays.has_exp] - _column(arrays.exp_dg[arrays.has_exp], dg),
+                                              weights)
+            d_dg = None
+            if d_err is not None:
+                d_dg = np.zeros(arrays.nnodes)
+                d_dg[arrays.has_exp] = d_err
+        return f, d_dg
+
+    def value(self, pkas: np.ndarray, weights: Optional[np.ndarray] = None):
+        """
+        The metric for one set of pKas, or an array of shape (nfit, k) to evaluate k sets at once.
+
+        :param weights: The bootstrap weight of each of the nunits edges or ligands, default=1.
+        """
+        return self._metric(pkas, weights)[0]
+
+    def gradient(self, pkas: np.ndarray, weights: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        The analytic derivative of the metric with respect to each fitted pKa.
+        """
+        d_dg = self._metric(pkas, weights)[1]
+        d_c = self.response.T @ d_dg
+        return d_c * node_solvent_penalty_derivative(pkas, self.ph, self.kT)
+
+
+class ProtonationStateObjective:
+    """
+    The accuracy of a map whose ligands are simulated in several protonation states or tautomers, as a function of the
+    solvent pKas that weight the states.
+
+    This is the model of scisol's pka_tautomer_correction.py. Each pair of states (protonated, deprotonated, pKa) sets
+    the ratio of their solvent populations to 10^(pKa - pH). The states that are linked by pairs form one ligand, whose
+    binding free energy is -kT ln sum_s f_s exp(-DG_s / kT), where f_s are the normalized populations. A population
+    file fixes the ratio of two states directly, which is the same as a pKa of pH + log10(pop1 / pop2).
+
+    The DG of every state comes from a single cycle closure of the map and does not depend on the pKas, so each
+    evaluation only combines the states of each ligand.
+    """
+
+    def __init__(self, arrays: MapArrays, pairs: List[Tuple[str, str, float]], ph: float = 7., kT: float = cm.KT,
+                 metric: str = 'pairwise'):
+        """
+        :param arrays: The map.
+        :param pairs: The (protonated state, deprotonated state, pKa) of each pair. Both states must be in the map and
+            the pairs must not form cycles.
+        :param ph: The pH of the solvent.
+        :param kT: The thermal energy in kcal/mol.
+        :param metric: Either 'edgewise' or 'pairwise' RMSE over the ligands.
+        """
+        if metric not in ('edgewise', 'pairwise'):
+            raise ValueError(f'Unknown metric {metric}. Choose from "edgewise" or "pairwise".')
+        self.arrays = arrays
+        self.pairs = pairs
+        self.ph = ph
+        self.kT = kT
+        self.metric = metric
+        nnodes = arrays.nnodes
+
+        # Walk the pairs from the first state of each ligand. The log10 population of every state relative to that
+        # state is linear in the pKas: sign @ (pKa - pH).
+        neighbours = {i: [] for i in range(nnodes)}
+        for k, (prot, deprot, pka) in enumerate(pairs):
+            p, d = arrays.name_index[prot], arrays.name_index[deprot]
+            neighbours[d].append((p, k, 1.))
+            neighbours[p].append((d, k, -1.))
+        self.sign = np.zeros((nnodes, len(pairs)))
+        self.node_ligand = np.full(nnodes, -1)
+        nligands = 0
+        for root in range(nnodes):
+            if self.node_ligand[root] >= 0:
+                continue
+            self.node_ligand[root] = nligands
+            stack, used = [root], set()
+            while stack:
+                i = stack.pop()
+                for j, k, sign in neighbours[i]:
+                    if k in used:
+                        continue
+                    used.add(k)
+                    if self.node_ligand[j] >= 0:
+                        raise ValueError(f'The pKas of {arrays.names[j]} form a cycle. Remove one of the pairs.')
+                    self.node_ligand[j] = nligands
+                    self.sign[j] = self.sign[i]
+                    self.sign[j, k] += sign
+                    stack.append(j)
+            nligands += 1
+        self.nligands = nligands
+        self.membership = np.zeros((nligands, nnodes))
+        self.membership[self.node_ligand, np.arange(nnodes)] = 1
+
+        self.ligand_names = [' / '.join(arrays.names[i] for i in np.flatnonzero(row)) for row in self.membership]
+        with np.errstate(invalid='ignore'):
+            exp_sum = self.membership @ np.nan_to_num(arrays.exp_dg)
+            exp_count = self.membership @ arrays.has_exp
+            self.exp_dg = np.where(exp_count > 0, exp_sum / np.maximum(exp_count, 1), np.nan)
+        self.has_exp = np.isfinite(self.exp_dg)
+
+        # The edges between different ligands that both have experimental data.
+        lig_src, lig_dst = self.node_ligand[arrays.src], self.node_ligand[arrays.dst]
+        keep = (lig_src != lig_dst) & self.has_exp[lig_src] & self.has_exp[lig_dst]
+        edges = sorted(set(zip(lig_src[keep], lig_dst[keep])))
+        self.edge_incidence = np.zeros((len(edges), nligands))
+        for e, (i, j) in enumerate(edges):
+            self.edge_incidence[e, j] += 1
+            self.edge_incidence[e, i] -= 1
+
+        self.state_dgs = arrays.solve(arrays.ddg)
+
+    @property
+    def nunits(self) -> int:
+        """
+        The number of edges or ligands that the metric averages over, which are the units of bootstrap resampling.
+        """
+        if self.metric == 'edgewise':
+            return len(self.edge_incidence)
+        return int(np.sum(self.has_exp))
+
+    def _logsumexp(self, log_weights: np.ndarray):
+        """
+        The log of the sum of exp(log_weights) over the states of each ligand, and the normalized populations.
+        """
+        shift = np.full((self.nligands,) + log_weights.shape[1:], -np.inf)
+        np.maximum.at(shift, self.node_ligand, log_weights)
+        w = np.exp(log_weights - shift[self.node_ligand])
+        total = self.membership @ w
+        return shift + np.log(total), w / total[self.node_ligand]
+
+    def _combine(self, pkas: np.ndarray, ph=None, kT=None):
+        ph = self.ph if ph is None else ph
+        kT = self.kT if kT is None else kT
+        log_pops = np.log(10) * (self.sign @ (pkas - ph))
+        solvent_lse, solvent = self._logsumexp(log_pops)
+        bound_lse, bound = self._logsumexp(log_pops - _column(self.state_dgs, log_pops) / kT)
+        return -kT * (bound_lse - solvent_lse), bound - solvent
+
+    def scan(self, pkas: np.ndarray, phs: Sequence[float],
+             temperatures: Sequence[float]) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """
+        The ligand DGs and accuracy of the map over a grid of pH values and temperatures in one broadcast evaluation.
+        The DGs of the states are those of the simulations and do not change with temperature.
+
+        :param pkas: The pKa of each pair.
+        :param phs: The pH values of the grid.
+        :param temperatures: The temperatures of the grid in K.
+
+        :return: The ligand DGs, shape (nligands, len(phs), len(temperatures)), aligned to the mean experimental DG,
+            and the 'edgewise' and 'pairwise' RMSE, each of shape (len(phs), len(temperatures)).
+        """
+        ph, kT = scan_grid(phs, temperatures)
+        dg = self._combine(np.asarray(pkas, dtype=float)[:, np.newaxis], ph, kT)[0]
+        metrics = scan_metrics(dg, self.edge_incidence, self.exp_dg)
+        shape = (len(phs), len(temperatures))
+        if np.any(self.has_exp):
+            dg = dg + np.mean(self.exp_dg[self.has_exp]) - np.mean(dg[self.has_exp], axis=0)
+        return dg.reshape((self.nligands,) + shape), {k: v.reshape(shape) for k, v in metrics.items()}
+
+    def ligand_dgs(self, pkas: np.ndarray) -> np.ndarray:
+        """
+        The binding free energy of each ligand for one set of pKas, or an array of shape (npairs, k) for k sets at once.
+        """
+        return self._combine(pkas)[0]
+
+    def _metric(self, pkas: np.ndarray, weights: Optional[np.ndarray]):
+        dg, dpop = self._combine(pkas)
+        if self.metric == 'edgewise':
+            bm = self.edge_incidence
+            f, d_resid = weighted_rmse(bm @ dg - _column(bm @ np.nan_to_num(self.exp_dg), dg), weights)
+            d_dg = bm.T @ d_resid if d_resid is not None else None
+        else:
+            f, d_err = weighted_pairwise_rmse(dg[self.has_exp] - _column(self.exp_dg[self.has_exp], dg), weights)
+            d_dg = None
+            if d_err is not None:
+                d_dg = np.zeros(self.nligands)
+                d_dg[self.has_exp] = d_err
+        return f, d_dg, dpop
+
+    def __call__(self, pkas: np.ndarray) -> float:
+        return self.value(pkas)
+
+    def value(self, pkas: np.ndarray, weights: Optional[np.ndarray] = None):
+        """
+        The metric for one set of pKas, or an array of shape (npairs, k) to evaluate k sets at once.
+
+        :param weights: The bootstrap weight of each of the nunits edges or ligands, default=1.
+        """
+        return self._metric(pkas, weights)[0]
+
+    def gradient(self, pkas: np.ndarray, weights: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        The analytic derivative of the metric with respect to each pKa. The derivative of a ligand DG with respect to
+        the log population of one of its states is -kT times the difference of its bound and solvent populations.
+        """
+        f, d_dg, dpop = self._metric(pkas, weights)
+        d_log_pops = -self.kT * dpop * d_dg[self.node_ligand]
+        return np.log(10) * (self.sign.T @ d_log_pops)
+
+
+def minimize_bounded(objective, x0: np.ndarray, bounds: List[Tuple[float, float]],
+                     weights: Optional[np.ndarray] = None):
+    """
+    Minimize an objective with an analytic gradient, such as SolventPkaObjective or ProtonationStateObjective, within
+    bounds.
+
+    :param weights: The bootstrap weights passed to the objective.
+
+    :return: The scipy.optimize.OptimizeResult.
+    """
+    return minimize(objective.value, x0=x0, jac=objective.gradient, args=(weights,), method='L-BFGS-B',
+                    bounds=bounds)
+
+
+def fit_solvent_pkas(objective: SolventPkaObjective, x0: np.ndarray, max_shift: float = 1.):
+    """
+    Minimize the objective with a gradient-based optimizer with the pKas bounded to within max_shift log units of their
+    starting values.
+
+    :return: The scipy.optimize.OptimizeResult.
+    """
+    bounds = [(x - max_shift, x + max_shift) for x in x0]
+    return minimize_bounded(objective, x0, bounds)
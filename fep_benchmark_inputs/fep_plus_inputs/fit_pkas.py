@@ -0,0 +1,254 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import correction_manifest as cm
+import fep_map_arrays as fma
+
+# The edge predictions of every map, which hold the uncorrected Bennett DDGs of all the protonation states.
+DEFAULT_EDGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '21_4_results',
+                                'edge_predictions')
+
+# The maps whose edge prediction CSV is not named after the input fmp of the manifest.
+EDGE_CSVS = {
+    'bace_ciordia_retro': 'retrospective_custom_core_extra_out.csv',
+    'eg5_extraprotomers': 'eg5_extraprotomers_manual_exp_out.csv',
+    'syk_4puz_fullmap': 'syk_out.csv',
+}
+
+
+def _split(line: str, separator: Optional[str]) -> List[str]:
+    return [x.strip() for x in line.strip().split(separator)]
+
+
+def read_pka_file(path: str, separator: Optional[str] = None) -> Tuple[float, List[Tuple[str, str, float]]]:
+    """
+    Read a pKa file in the format of scisol's pka_tautomer_correction.py. The first line is the pH, e.g. 'pH 7.5', and
+    every other line that is not blank or a comment is 'protonated_ligand deprotonated_ligand pKa'.
+
+    :param path: The location of the pKa file.
+    :param separator: The string that separates the fields. Defaults to whitespace.
+
+    :return: The pH and the (protonated, deprotonated, pKa) pairs.
+    """
+    with open(path) as f:
+        lines = f.read().splitlines()
+    ph = float(lines[0].split()[1])
+    pairs = []
+    for line in lines[1:]:
+        if line.strip() == '' or line.strip().startswith('#'):
+            continue
+        fields = _split(line, separator)
+        if len(fields) != 3:
+            print(f'Skipping the line "{line}" of {path}, which does not have 3 fields.')
+            continue
+        prot, deprot, pka = fields
+        pairs.append((prot, deprot, float(pka)))
+    return ph, pairs
+
+
+def read_population_file(path: str, separator: Optional[str] = None,
+                         ph: float = 7.) -> Tuple[float, List[Tuple[str, str, float]]]:
+    """
+    Read a population file in the format of scisol's pka_tautomer_correction.py, where every line is
+    'ligand1 ligand2 population1 population2'. The ratio of the populations is returned as the equivalent pKa,
+    pH + log10(population1 / population2), so that the tautomer ratios can be fitted like pKas.
+
+    :param path: The location of the population file.
+    :param separator: The string that separates the fields. Defaults to whitespace.
+    :param ph: The pH used when the file does not start with one.
+
+    :return: The pH and the (ligand1, ligand2, equivalent pKa) pairs.
+    """
+    with open(path) as f:
+        lines = f.read().splitlines()
+    if lines[0].strip().lower().startswith('ph'):
+        ph = float(lines[0].split()[1])
+        lines = lines[1:]
+    pairs = []
+    for line in lines:
+        if line.strip() == '' or line.strip().startswith('#'):
+            continue
+        fields = _split(line, separator)
+        if len(fields) != 4:
+            print(f'Skipping the line "{line}" of {path}, which does not have 4 fields.')
+            continue
+        lig1, lig2, pop1, pop2 = fields
+        pairs.append((lig1, lig2, ph + np.log10(float(pop1) / float(pop2))))
+    return ph, pairs
+
+
+def get_pka_maps(manifest: Dict, manifest_dir: str, edge_dir: str = DEFAULT_EDGE_DIR) -> List[Dict]:
+    """
+    Find every map of the manifest that has a pKa, population or solvent pKa correction.
+
+    :return: For each map, a dictionary with the 'group', 'name', 'edge_csv' and either the 'pairs' and 'ph' of a pKa
+        or population file, or the 'pkas' and 'ph' of a solvent pKa correction.
+    """
+    maps = []
+    for group_name, entry in cm.iter_maps(manifest):
+        group_dir = os.path.join(manifest_dir, group_name)
+        for step in entry.get('steps', []):
+            if step['type'] not in ('pka', 'solvent_pka'):
+                continue
+            source = entry['input'] if 'input' in entry else entry['inputs'][0]
+            csv_name = EDGE_CSVS.get(entry['name'], os.path.basename(source).replace('.fmp', '.csv'))
+            m = {'group': group_name, 'name': entry['name'], 'edge_csv': os.path.join(edge_dir, group_name, csv_name)}
+            if step['type'] == 'solvent_pka':
+                m['pkas'] = step['pkas']
+                m['ph'] = step.get('ph', 7.)
+            elif 'pka_file' in step:
+                m['ph'], m['pairs'] = read_pka_file(os.path.join(group_dir, step['pka_file']), step.get('separator'))
+            else:
+                m['ph'], m['pairs'] = read_population_file(os.path.join(group_dir, step['population_file']),
+                                                           step.get('separator'))
+            maps.append(m)
+    return maps
+
+
+def make_objective(m: Dict, metric: str):
+    """
+    Build the objective of a map and the starting values of its parameters.
+
+    :return: The objective, the starting parameters and the names of the (protonated, deprotonated) ligands of each
+        parameter.
+    """
+    arrays = fma.MapArrays.from_edge_csv(m['edge_csv'])
+    if 'pkas' in m:
+        fit_ligands = [l for l in m['pkas'] if l in arrays.name_index]
+        objective = fma.SolventPkaObjective(arrays, m['pkas'], fit_ligands, ph=m['ph'], metric=metric)
+        x0 = np.array([m['pkas'][l] for l in fit_ligands])
+        labels = [(l, '') for l in fit_ligands]
+    else:
+        pairs = [p for p in m['pairs'] if p[0] in arrays.name_index and p[1] in arrays.name_index]
+        objective = fma.ProtonationStateObjective(arrays, pairs, ph=m['ph'], metric=metric)
+        x0 = np.array([p[2] for p in pairs])
+        labels = [(p[0], p[1]) for p in pairs]
+    return objective, x0, labels
+
+
+def fit_map(m: Dict, metric: str = 'pairwise', nstarts: int = 20, max_shift: float = 2., nboots: int = 200,
+            seed: int = 0) -> Dict:
+    """
+    Fit the pKas of one map with many bounded optimizations from random starting points, then refit bootstrap samples
+    of the ligands (or edges) from the best fit for the confidence intervals.
+
+    :param m: The map, from get_pka_maps.
+    :param metric: Either 'pairwise' or 'edgewise' RMSE.
+    :param nstarts: The number of random starting points in addition to the starting pKas.
+    :param max_shift: The largest change of a pKa from its starting value, in log units.
+    :param nboots: The number of bootstrap samples.
+    :param seed: The seed of the random number generator.
+
+    :return: The map, its labels, starting and fitted pKas, the bootstrap samples of the fitted pKas and the metric
+        before and after the fit.
+    """
+    objective, x0, labels = make_objective(m, metric)
+    result = {'map': m, 'labels': labels, 'x0': x0}
+    if len(x0) == 0:
+        return result
+
+    rng = np.random.default_rng(seed)
+    bounds = [(x - max_shift, x + max_shift) for x in x0]
+    starts = np.vstack((x0, x0 + rng.uniform(-max_shift, max_shift, size=(nstarts, len(x0)))))
+    fits = [fma.minimize_bounded(objective, x, bounds) for x in starts]
+    best = min(fits, key=lambda r: r.fun)
+
+    weights = rng.multinomial(objective.nunits, np.full(objective.nunits, 1. / objective.nunits), size=nboots)
+    boots = np.array([fma.minimize_bounded(objective, best.x, bounds, w.astype(float)).x for w in weights])
+
+    result.update({'x': best.x, 'boots': boots, 'initial': float(objective.value(x0)), 'final': float(best.fun)})
+    return result
+
+
+def _fit_map_safely(args: Tuple) -> Tuple[Optional[Dict], Optional[str]]:
+    try:
+        return fit_map(*args), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def results_to_dataframe(results: List[Dict], alpha: float = 0.05) -> pd.DataFrame:
+    """
+    Tabulate the fitted pKas with percentile bootstrap intervals. For population files, the pKas are the equivalent
+    pKas pH + log10(population1 / population2).
+    """
+    rows = []
+    for r in results:
+        if 'x' not in r:
+            continue
+        lower = np.percentile(r['boots'], 100 * alpha / 2, axis=0)
+        upper = np.percentile(r['boots'], 100 * (1 - alpha / 2), axis=0)
+        for k, (lig1, lig2) in enumerate(r['labels']):
+            rows.append({'Group': r['map']['group'],
+                         'Map': r['map']['name'],
+                         'Ligand 1': lig1,
+                         'Ligand 2': lig2,
+                         'pH': r['map']['ph'],
+                         'Starting pKa': r['x0'][k],
+                         'Fitted pKa': r['x'][k],
+                         'Lower': lower[k],
+                         'Upper': upper[k],
+                         'Starting RMSE (kcal/mol)': r['initial'],
+                         'Fitted RMSE (kcal/mol)': r['final']})
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    description = """
+    Fit the solvent pKas (and tautomer populations) of every map in the benchmark that has a pKa correction. The
+    starting pKas are read from the pKa and population files of the correction manifest and the maps are read from the
+    edge prediction CSVs in 21_4_results, so no Schrodinger license is required. Each map is fitted with many bounded
+    optimizations from random starting points, and the uncertainty of the fitted pKas is estimated by bootstrapping the
+    ligands (or edges).
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-o', '--output', type=str, help="The CSV file of the fitted pKas, default=fitted_pkas.csv.",
+                        default='fitted_pkas.csv')
+    parser.add_argument('--manifest', type=str, help="The correction manifest, default=corrections_manifest.json.",
+                        default=cm.DEFAULT_MANIFEST)
+    parser.add_argument('--edge-dir', type=str, help="The directory of the edge prediction CSVs.",
+                        default=DEFAULT_EDGE_DIR)
+    parser.add_argument('-m', dest='maps', type=str, nargs='+', help="Only fit these maps, default=all maps.",
+                        default=None)
+    parser.add_argument('--metric', type=str, choices=['pairwise', 'edgewise'],
+                        help="The RMSE that is minimized, default=pairwise.", default='pairwise')
+    parser.add_argument('--starts', type=int, help="The number of random starting points per map, default=20.",
+                        default=20)
+    parser.add_argument('--max-shift', type=float,
+                        help="The largest change of a pKa from its starting value in log units, default=2.", default=2.)
+    parser.add_argument('--boots', type=int, help="The number of bootstrap samples per map, default=200.", default=200)
+    parser.add_argument('--seed', type=int, help="The seed of the random number generator, default=0.", default=0)
+    parser.add_argument('-j', dest='nprocs', type=int, help="The number of maps to fit in parallel, "
+                                                            "default=number of CPUs.", default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    manifest = cm.load_manifest(args.manifest)
+    manifest_dir = os.path.dirname(os.path.abspath(args.manifest))
+    maps = get_pka_maps(manifest, manifest_dir, args.edge_dir)
+    if args.maps is not None:
+        maps = [m for m in maps if m['name'] in args.maps]
+
+    jobs = [(m, args.metric, args.starts, args.max_shift, args.boots, args.seed) for m in maps]
+    results = []
+    with ProcessPoolExecutor(max_workers=args.nprocs) as pool:
+        for m, (result, error) in zip(maps, pool.map(_fit_map_safely, jobs)):
+            if error is not None:
+                print(f'Unable to fit {m["group"]}/{m["name"]}: {error}')
+            elif 'x' not in result:
+                print(f'Skipping {m["group"]}/{m["name"]}: none of its pKas refer to ligands in {m["edge_csv"]}')
+            else:
+                print(f'{m["group"]}/{m["name"]}: {args.metric} RMSE {result["initial"]:.2f} -> '
+                      f'{result["final"]:.2f} kcal/mol with {len(result["x"])} pKas')
+                results.append(result)
+
+    results_to_dataframe(results).to_csv(args.output, index=False)
+    print(f'Fitted pKas written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,14 @@
 from schrodinger.application.scisol.packages.fep import graph
-import numpy as np
 import argparse
 
 import sys
 sys.path.append('../')
 import binding_mode_correction as bmc
+import correction_manifest as cm
+import edge_corrections as ec
 
-# Add the symmetry corrections
-degree_of_symm = {'4a':4, '4a flipped':4,
-             '4b D':2,
-             '4b U':2,
-             '4c':4,
-             '4d':4,
-             '4e D':2, '4eD deprotonated':2,
-             '4e U':2, '4eU deprotonated':2,
-             '4f':4, '4f deprotonated':4,
-             '4g':4,
-             '4h':4,
-             '4i':4,
-             '4jR':2,
-             '4jS':2,
-             '4kD':2,
-             '4kU':2,
-             '4lD':2,
-             '4lU':2,
-             '4m D':2,
-             '4m U':2,
-             '4n':4,
-             '4o':4, '4o deprotonated':4,
-             '4q':4,
-             '4r D':2,
-             '4r U':2}
-
-def get_lignames(edge):
-    sep = edge.short_id_title.split('==>')
-    lig1 = sep[0].split(':')[1].strip()
-    lig2 = sep[1].split(':')[1].strip()
-    return lig1, lig2
+# The symmetry corrections are specific to the map and are listed in the correction manifest.
+degree_of_symm = cm.get_symmetry_numbers('a2a_hip278')
 
 
 
@@ -79,18 +51,14 @@ def main(argv=None):
         print('Removing {} nodes as they do not have results'.format(len(remove_nodes)))
         g.remove_nodes_from(remove_nodes)
 
-    kT =0.596
-    for e in g.edges_iter():
-        l1, l2 = get_lignames(e)
-        total_corr = 0
-        # Symmetry correction
-        total_corr += kT * np.log(degree_of_symm[l1])
-        total_corr -= kT * np.log(degree_of_symm[l2])
-        e.complex_dg += total_corr
+    if len(remove_edges) > 0 or len(remove_nodes) > 0:
+        g.calc_cycle_closure()
 
-    g.calc_cycle_closure()
+    # The symmetry and binding mode corrections are applied together with a single cycle closure.
+    layer = ec.EdgeCorrections(g)
+    layer.add_symmetry(degree_of_symm)
 
-    mode_nodes, corrections = bmc.correct_multiple_binding_modes(g)
+    mode_nodes, corrections = bmc.correct_multiple_binding_modes(g, layer)
     bmc.merge_ligand_nodes(g, mode_nodes, corrections)
     g.calc_cycle_closure()
     g.write(args.outfile)
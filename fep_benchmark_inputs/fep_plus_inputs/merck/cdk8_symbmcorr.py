@@ -7,13 +7,8 @@ from itertools import combinations
 import sys
 sys.path.append('../')
 import binding_mode_correction as bmc
-
-
-def get_lignames(edge):
-    sep = edge.short_id_title.split('==>')
-    lig1 = sep[0].split(':')[1].strip()
-    lig2 = sep[1].split(':')[1].strip()
-    return lig1, lig2
+import correction_manifest as cm
+import edge_corrections as ec
 
 def get_pairwise_diffs(g):
     pred_dg = np.zeros(len(g))
@@ -63,8 +58,8 @@ def get_error_before_corrs(g):
     #print('Pairwise RMSD without extra rotamers and symmetry correction = {:.2f} +/- {:.2f} kcal/mol'.format(pair_rmsd, np.std(boot_rmsds)))
 
 
-# Add the symmetry corrections. Specific to the map
-no_sym_corr = ['13','13 flipped', '14', '15', '16', '16 flipped','17', '17 flipped', '18', '18 flipped', '42','43','43 flipped', '44', '44 flipped', '45','45 flipped']
+# The symmetry corrections are specific to the map and are listed in the correction manifest.
+degree_of_symm = cm.get_symmetry_numbers('cdk8_5cei_new_helix_loop_extra')
 
 def main(argv=None):
     usage="""
@@ -106,23 +101,16 @@ def main(argv=None):
         #print('Removing {} nodes as they do not have results'.format(len(remove_nodes)))
         g.remove_nodes_from(remove_nodes)
 
+    if len(remove_edges) > 0 or len(remove_nodes) > 0:
+        g.calc_cycle_closure()
 
-    # SYMMETRY CORRECTION
-    kT =0.596
-    for e in g.edges_iter():
-        l1, l2 = get_lignames(e)
-        total_corr = 0
-        # Symmetry correction
-        if l1 not in no_sym_corr:
-            total_corr += kT * np.log(2)
-        if l2 not in no_sym_corr:
-            total_corr -= kT * np.log(2)
-        e.complex_dg += total_corr
 
-    g.calc_cycle_closure()
+    # SYMMETRY CORRECTION
+    layer = ec.EdgeCorrections(g)
+    layer.add_symmetry(degree_of_symm)
 
-    # BINDING MODE CORRECTION
-    mode_nodes, corrections = bmc.correct_multiple_binding_modes(g)
+    # BINDING MODE CORRECTION, applied together with the symmetry correction in a single cycle closure
+    mode_nodes, corrections = bmc.correct_multiple_binding_modes(g, layer)
     bmc.merge_ligand_nodes(g, mode_nodes, corrections)
     g.calc_cycle_closure()
 
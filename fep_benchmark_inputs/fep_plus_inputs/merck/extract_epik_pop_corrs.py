@@ -3,6 +3,10 @@ from schrodinger.application.scisol.packages.fep.graph import Graph
 import argparse
 from collections import defaultdict
 
+import sys
+sys.path.append('../')
+import smiles_cache
+
 epik_penalty_names = ('r_epik_Ionization_Penalty',
                       'r_epik_Ionization_Penalty_Charging',
                       'r_epik_Ionization_Penalty_Neutral',
@@ -13,10 +17,16 @@ epik_penalty_names = ('r_epik_Ionization_Penalty',
                       'r_lp_tautomer_probability')
  
 def extract_supernodes(g):
+    nodes = [n for n in g.nodes_iter() if 'r_epik_Ionization_Penalty' in n.struc.property]
+    # The canonical SMILES of the nodes are looked up in the persistent cache before they are generated.
+    strucs = [n.struc for n in nodes]
+    struc2node = {id(st): n for st, n in zip(strucs, nodes)}
+    smiles = smiles_cache.get_default_cache().get_smiles(strucs,
+                                                         generate=lambda st: struc2node[id(st)].canonical_smiles,
+                                                         method='node_canonical')
     smile2node = defaultdict(list)
-    for n in g.nodes_iter():
-        if 'r_epik_Ionization_Penalty' in n.struc.property:
-            smile2node[n.canonical_smiles].append(n)
+    for n, smile in zip(nodes, smiles):
+        smile2node[smile].append(n)
 
     smile2supernode = defaultdict(list)
     for key in smile2node:
@@ -6,20 +6,12 @@ from itertools import combinations
 import sys
 sys.path.append('../')
 import binding_mode_correction as bmc
+import correction_manifest as cm
+import edge_corrections as ec
 
 
-def get_lignames(edge):
-    sep = edge.short_id_title.split('==>')
-    lig1 = sep[0].split(':')[1].strip()
-    lig2 = sep[1].split(':')[1].strip()
-    return lig1, lig2
-
-
-# Add the symmetry corrections. Specific to the map
-degree_of_symm = {'23':2,
-             '251':2,
-             '256':2,
-             '67':2}
+# The symmetry corrections are specific to the map and are listed in the correction manifest.
+degree_of_symm = cm.get_symmetry_numbers('hif2a_automap')
 
 def get_error_before_corrs(g):
     pred_dgs = []
@@ -70,21 +62,11 @@ def main(argv=None):
     g = graph.Graph.deserialize(args.infile)
 
     # SYMMETRY CORRECTION
-    kT =0.596
-    for e in g.edges_iter():
-        l1, l2 = get_lignames(e)
-        total_corr = 0
-        # Symmetry correction
-        if l1 in degree_of_symm:
-            total_corr += kT * np.log(degree_of_symm[l1])
-        if l2 in degree_of_symm:
-            total_corr -= kT * np.log(degree_of_symm[l2])
-        e.complex_dg += total_corr
-
-    g.calc_cycle_closure()
+    layer = ec.EdgeCorrections(g)
+    layer.add_symmetry(degree_of_symm)
 
-    # BINDING MODE CORRECTION
-    mode_nodes, corrections = bmc.correct_multiple_binding_modes(g)
+    # BINDING MODE CORRECTION, applied together with the symmetry correction in a single cycle closure
+    mode_nodes, corrections = bmc.correct_multiple_binding_modes(g, layer)
     bmc.merge_ligand_nodes(g, mode_nodes, corrections)
     g.calc_cycle_closure()
 
@@ -1,18 +1,12 @@
 from schrodinger.application.scisol.packages.fep import graph
-import numpy as np
 import argparse
 
 
 import sys
 sys.path.append('../')
 import binding_mode_correction as bmc
-
-
-def get_lignames(edge):
-    sep = edge.short_id_title.split('==>')
-    lig1 = sep[0].split(':')[1].strip()
-    lig2 = sep[1].split(':')[1].strip()
-    return lig1, lig2
+import correction_manifest as cm
+import edge_corrections as ec
 
 
 def main(argv=None):
@@ -34,29 +28,15 @@ def main(argv=None):
 
     g = graph.Graph.deserialize(args.infile)
 
-    # Add the symmetry corrections. Specific to the map
-    degree_of_symm = {}
-    for n in g.nodes_iter():
-        l = n.short_id_title.split(':')[1].strip()
-        if l != '7':
-            degree_of_symm[l] = 2
-        else:
-            print('Ligand 7 does not need the correction.')
+    # The symmetry corrections are specific to the map and are listed in the correction manifest. Ligand 7 does not
+    # need the correction.
+    degree_of_symm = cm.get_symmetry_numbers('tnks2_fullmap')
 
 
     # SYMMETRY CORRECTION
-    kT =0.596
-    for e in g.edges_iter():
-        l1, l2 = get_lignames(e)
-        total_corr = 0
-        # Symmetry correction
-        if l1 in degree_of_symm:
-            total_corr += kT * np.log(degree_of_symm[l1])
-        if l2 in degree_of_symm:
-            total_corr -= kT * np.log(degree_of_symm[l2])
-        e.complex_dg += total_corr
-
-    g.calc_cycle_closure()
+    layer = ec.EdgeCorrections(g)
+    layer.add_symmetry(degree_of_symm)
+    layer.apply()
 
     if args.outfile is not None:
         g.write(args.outfile)
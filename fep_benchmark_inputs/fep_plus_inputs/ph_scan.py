@@ -0,0 +1,114 @@
+import argparse
+import os
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+import correction_manifest as cm
+import fit_pkas as fp
+
+
+def read_fitted_pkas(path: str) -> Dict:
+    """
+    Read the fitted pKas written by fit_pkas.py.
+
+    :return: A dictionary from (map, ligand 1, ligand 2) to the fitted pKa.
+    """
+    df = pd.read_csv(path, dtype={'Ligand 1': str, 'Ligand 2': str}, keep_default_na=False)
+    return {(r['Map'], r['Ligand 1'], r['Ligand 2']): float(r['Fitted pKa']) for _, r in df.iterrows()}
+
+
+def scan_map(m: Dict, phs: np.ndarray, temperatures: np.ndarray, fitted: Optional[Dict] = None):
+    """
+    Evaluate the protonation state correction of one map over a grid of pH values and temperatures.
+
+    :param m: The map, from fit_pkas.get_pka_maps.
+    :param phs: The pH values.
+    :param temperatures: The temperatures in K.
+    :param fitted: The fitted pKas from read_fitted_pkas. The pKas of the correction files are used if None, or for
+        the pairs that were not fitted.
+
+    :return: A dataframe of the metrics at every point of the grid and a dataframe of the ligand DGs.
+    """
+    objective, pkas, labels = fp.make_objective(m, 'pairwise')
+    if fitted is not None:
+        pkas = np.array([fitted.get((m['name'],) + l, x) for l, x in zip(labels, pkas)])
+    dg, metrics = objective.scan(pkas, phs, temperatures)
+    ph_grid, t_grid = np.meshgrid(phs, temperatures, indexing='ij')
+
+    df_metrics = pd.DataFrame({'Group': m['group'],
+                               'Map': m['name'],
+                               'pH': ph_grid.ravel(),
+                               'Temperature (K)': t_grid.ravel(),
+                               'Edgewise RMSE (kcal/mol)': metrics['edgewise'].ravel(),
+                               'Pairwise RMSE (kcal/mol)': metrics['pairwise'].ravel()})
+
+    names = objective.ligand_names if hasattr(objective, 'ligand_names') else objective.arrays.names
+    npoints = ph_grid.size
+    df_dgs = pd.DataFrame({'Group': m['group'],
+                           'Map': m['name'],
+                           'Ligand': np.repeat(names, npoints),
+                           'pH': np.tile(ph_grid.ravel(), len(names)),
+                           'Temperature (K)': np.tile(t_grid.ravel(), len(names)),
+                           'Pred. dG (kcal/mol)': dg.reshape(len(names), npoints).ravel()})
+    return df_metrics, df_dgs
+
+
+def main(argv=None):
+    description = """
+    Compute how the accuracy of every map with a protonation state correction depends on the pH of the assay and the
+    temperature. The corrected DGs of all grid points are evaluated at once from the edge prediction CSVs, so no
+    Schrodinger license is required. The curves of the edgewise and pairwise RMSE against pH are written to a CSV file.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-o', '--output', type=str, help="The CSV file of the metrics versus pH, default=ph_scan.csv.",
+                        default='ph_scan.csv')
+    parser.add_argument('--dg-output', type=str, help="An optional CSV file for the corrected ligand DGs at every pH.",
+                        default=None)
+    parser.add_argument('--manifest', type=str, help="The correction manifest, default=corrections_manifest.json.",
+                        default=cm.DEFAULT_MANIFEST)
+    parser.add_argument('--edge-dir', type=str, help="The directory of the edge prediction CSVs.",
+                        default=fp.DEFAULT_EDGE_DIR)
+    parser.add_argument('-m', dest='maps', type=str, nargs='+', help="Only scan these maps, default=all maps.",
+                        default=None)
+    parser.add_argument('--pkas', type=str, help="The fitted pKas from fit_pkas.py. By default the pKas of the "
+                                                 "correction files are used.", default=None)
+    parser.add_argument('--ph', type=float, nargs=3, metavar=('START', 'STOP', 'STEP'),
+                        help="The range of pH values, default=4 10 0.1.", default=[4., 10., 0.1])
+    parser.add_argument('-t', '--temperatures', type=float, nargs='+', help="The temperatures in K, default=300.",
+                        default=[300.])
+    args = parser.parse_args(argv)
+
+    manifest = cm.load_manifest(args.manifest)
+    maps = fp.get_pka_maps(manifest, os.path.dirname(os.path.abspath(args.manifest)), args.edge_dir)
+    if args.maps is not None:
+        maps = [m for m in maps if m['name'] in args.maps]
+    fitted = read_fitted_pkas(args.pkas) if args.pkas is not None else None
+
+    start, stop, step = args.ph
+    phs = np.round(np.arange(start, stop + step / 2, step), 6)
+    temperatures = np.array(args.temperatures)
+
+    all_metrics, all_dgs = [], []
+    for m in maps:
+        try:
+            df_metrics, df_dgs = scan_map(m, phs, temperatures, fitted)
+        except Exception as e:
+            print(f'Unable to scan {m["group"]}/{m["name"]}: {type(e).__name__}: {e}')
+            continue
+        best = df_metrics.loc[df_metrics['Pairwise RMSE (kcal/mol)'].idxmin()]
+        print(f'{m["group"]}/{m["name"]}: lowest pairwise RMSE {best["Pairwise RMSE (kcal/mol)"]:.2f} kcal/mol at '
+              f'pH {best["pH"]:.2f} and {best["Temperature (K)"]:.0f} K')
+        all_metrics.append(df_metrics)
+        all_dgs.append(df_dgs)
+
+    pd.concat(all_metrics).to_csv(args.output, index=False)
+    print(f'Metrics written to {args.output}')
+    if args.dg_output is not None:
+        pd.concat(all_dgs).to_csv(args.dg_output, index=False)
+        print(f'Ligand DGs written to {args.dg_output}')
+
+
+if __name__ == '__main__':
+    main()
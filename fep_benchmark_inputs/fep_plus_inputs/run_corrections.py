@@ -0,0 +1,265 @@
+import argparse
+import importlib.util
+import os
+import sys
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from typing import Dict, List, Optional, Tuple
+
+from schrodinger.application.scisol.packages.fep import graph
+
+import binding_mode_correction as bmc
+import correction_manifest as cm
+import edge_corrections as ec
+
+
+def _load_scisol_script(name: str):
+    """
+    Import one of the scripts that are normally run with '$SCHRODINGER/run -FROM scisol', so that it can be called
+    in this process instead of a new one.
+
+    :param name: The name of the script without the '.py' extension, e.g. 'pka_tautomer_correction'.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    schrodinger = os.environ.get('SCHRODINGER')
+    if schrodinger is None:
+        raise Exception('The SCHRODINGER environment variable must be set to run the scisol corrections.')
+    scisol_dirs = glob(f'{schrodinger}/scisol-v*')
+    if len(scisol_dirs) != 1:
+        raise Exception(f'Expected one scisol installation in {schrodinger}, found {len(scisol_dirs)}: {scisol_dirs}.')
+    candidates = glob(f'{scisol_dirs[0]}/python/scripts/{name}.py') or glob(f'{scisol_dirs[0]}/bin/*/{name}.py')
+    if len(candidates) != 1:
+        raise Exception(f'Expected one scisol script {name}.py in {scisol_dirs[0]}, found {len(candidates)}: '
+                        f'{candidates}.')
+    spec = importlib.util.spec_from_file_location(name, candidates[0])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def remove_incomplete(g: graph.Graph):
+    """
+    Remove the edges and nodes that do not have results. If anything is removed, cycle closure is run again. The graph
+    is modified in place.
+    """
+    remove_edges = [e for e in g.edges_iter() if e.complex_dg is None or e.solvent_dg is None]
+    if len(remove_edges) > 0:
+        g.remove_edges_from(remove_edges)
+
+    remove_nodes = [n for n in g.nodes_iter() if n.pred_dg is None]
+    if len(remove_nodes) > 0:
+        g.remove_nodes_from(remove_nodes)
+
+    if len(remove_edges) > 0 or len(remove_nodes) > 0:
+        g.calc_cycle_closure()
+
+
+def apply_pka_correction(g: graph.Graph, step: Dict, group_dir: str, workdir: str) -> graph.Graph:
+    """
+    Run scisol's pka_tautomer_correction.py in this process. As the script works on files, the graph is passed to it
+    through the working directory.
+
+    :param g: An FEP+ graph with output data.
+    :param step: The manifest entry of the correction, with either a 'pka_file' or 'population_file' and an optional
+        'separator'.
+    :param group_dir: The directory that the paths in the step are relative to.
+    :param workdir: A scratch directory for the intermediate files.
+
+    :return: The corrected graph.
+    """
+    pka_script = _load_scisol_script('pka_tautomer_correction')
+    infile = os.path.join(workdir, 'pka_in.fmp')
+    outfile = os.path.join(workdir, 'pka_out.fmp')
+    g.write(infile)
+    argv = [infile, '-o', outfile]
+    if 'pka_file' in step:
+        argv += ['-pka-file', os.path.join(group_dir, step['pka_file'])]
+    else:
+        argv += ['-p', os.path.join(group_dir, step['population_file'])]
+    if 'separator' in step:
+        argv += ['-s', step['separator']]
+    pka_script.main(argv)
+    return graph.Graph.deserialize(outfile)
+
+
+def merge_maps(inputs: List[str], workdir: str, shift_to_common: bool = False) -> graph.Graph:
+    """
+    Merge several maps into one with scisol's merge_graph.py.
+    """
+    merge_script = _load_scisol_script('merge_graph')
+    outfile = os.path.join(workdir, 'merged_out.fmp')
+    argv = list(inputs) + ['-o', outfile]
+    if shift_to_common:
+        argv.append('-sc')
+    merge_script.main(argv)
+    return graph.Graph.deserialize(outfile)
+
+
+def run_map(group_dir: str, entry: Dict) -> str:
+    """
+    Load a map, apply every correction in its manifest entry in order and write the corrected map.
+
+    :param group_dir: The absolute path of the group directory of the map.
+    :param entry: The manifest entry of the map.
+
+    :return: The absolute path of the corrected map.
+    """
+    output = os.path.join(group_dir, entry['output'])
+    steps = entry.get('steps', [])
+    if 'input' in entry and len(steps) == 0:
+        return output
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if 'inputs' in entry:
+            g = merge_maps([os.path.join(group_dir, f) for f in entry['inputs']], workdir,
+                           entry.get('shift_to_common', False))
+        else:
+            g = graph.Graph.deserialize(os.path.join(group_dir, entry['input']))
+
+        # Consecutive symmetry, solvent pKa and binding mode corrections are accumulated in one layer and applied with
+        # a single cycle closure. Steps that change the graph in other ways apply the pending corrections first.
+        layer = None
+        for step in steps:
+            if step['type'] in ('symmetry', 'solvent_pka', 'binding_mode') and layer is None:
+                layer = ec.EdgeCorrections(g)
+
+            if step['type'] == 'remove_incomplete':
+                if layer is not None:
+                    layer.apply()
+                    layer = None
+                remove_incomplete(g)
+            elif step['type'] == 'symmetry':
+                layer.add_symmetry(entry['symmetry_numbers'])
+            elif step['type'] == 'solvent_pka':
+                layer.add_solvent_pka(step['pkas'], step.get('ph', 7.))
+            elif step['type'] == 'binding_mode':
+                mode_nodes, corrections = bmc.correct_multiple_binding_modes(g, layer)
+                layer = None
+                if step.get('merge', True):
+                    bmc.merge_ligand_nodes(g, mode_nodes, corrections)
+                    g.calc_cycle_closure()
+            elif step['type'] == 'pka':
+                if layer is not None:
+                    layer.apply()
+                    layer = None
+                g = apply_pka_correction(g, step, group_dir, workdir)
+
+        if layer is not None:
+            layer.apply()
+
+        g.write(output)
+
+    return output
+
+
+def _run_map_safely(args: Tuple[str, str, Dict]) -> Tuple[str, Optional[str], Optional[str]]:
+    """
+    Run the corrections of one map in a worker process and report failures rather than raising them, so that one
+    broken map does not stop the others.
+    """
+    group_name, group_dir, entry = args
+    try:
+        return group_name, run_map(group_dir, entry), None
+    except Exception:
+        return group_name, None, traceback.format_exc()
+
+
+def write_outs_files(manifest: Dict, manifest_dir: str, groups: List[str], failures: List[Tuple[str, str]]):
+    """
+    Write the '*_outs.txt' file of each group, which lists the corrected maps relative to the manifest directory. These
+    files can be read with helper_functions.read_outfiles.
+
+    :param manifest: The correction manifest.
+    :param manifest_dir: The directory of the manifest.
+    :param groups: The names of the groups whose files will be written.
+    :param failures: The (group, map) names of the maps that could not be corrected and are left out.
+    """
+    for group_name in groups:
+        group = manifest['groups'][group_name]
+        lines = []
+        for entry in group['maps']:
+            if entry.get('skip', False) or (group_name, entry['name']) in failures:
+                continue
+            lines.append(os.path.join(group_name, entry['output']))
+        with open(os.path.join(manifest_dir, group['outs_file']), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def main(argv=None):
+    usage = """
+    Apply all the post-simulation corrections of the benchmark in a single session. The corrections of every map are
+    read from a manifest (corrections_manifest.json by default) and the maps are processed in parallel:
+
+        $SCHRODINGER/run -FROM scisol run_corrections.py -j 8
+
+    Only some groups or maps can be processed with, for example,
+
+        $SCHRODINGER/run -FROM scisol run_corrections.py -g merck gpcrs
+        $SCHRODINGER/run -FROM scisol run_corrections.py -m a2a_hip278
+
+    The '*_outs.txt' file of each group is written next to the manifest.
+    """
+    description = """
+    Replace the per-map correction scripts with a single process pool. For each map, the manifest lists the symmetry
+    numbers, pKa or population files, binding mode corrections and merges, in the order that they are applied.
+    """
+    parser = argparse.ArgumentParser(usage=usage, description=description)
+    parser.add_argument('manifest',
+                        type=str,
+                        nargs='?',
+                        help="The correction manifest, default=corrections_manifest.json next to this script.",
+                        default=cm.DEFAULT_MANIFEST)
+    parser.add_argument('-j',
+                        dest='nprocs',
+                        type=int,
+                        help="The number of maps to correct in parallel, default=number of CPUs.",
+                        default=os.cpu_count())
+    parser.add_argument('-g',
+                        dest='groups',
+                        type=str,
+                        nargs='+',
+                        help="Only process the maps of these groups, default=all groups.",
+                        default=None)
+    parser.add_argument('-m',
+                        dest='maps',
+                        type=str,
+                        nargs='+',
+                        help="Only process the maps with these names, default=all maps.",
+                        default=None)
+    args = parser.parse_args(argv)
+
+    manifest = cm.load_manifest(args.manifest)
+    manifest_dir = os.path.dirname(os.path.abspath(args.manifest))
+
+    jobs = []
+    for group_name, entry in cm.iter_maps(manifest):
+        if entry.get('skip', False):
+            continue
+        if args.groups is not None and group_name not in args.groups:
+            continue
+        if args.maps is not None and entry['name'] not in args.maps:
+            continue
+        jobs.append((group_name, os.path.join(manifest_dir, group_name), entry))
+
+    failures = []
+    with ProcessPoolExecutor(max_workers=args.nprocs) as pool:
+        for (group_name, group_dir, entry), (_, output, error) in zip(jobs, pool.map(_run_map_safely, jobs)):
+            if error is None:
+                print(f'Corrected {group_name}/{entry["name"]}')
+            else:
+                print(f'Failed to correct {group_name}/{entry["name"]}:\n{error}')
+                failures.append((group_name, entry['name']))
+
+    groups = list(dict.fromkeys(group_name for group_name, group_dir, entry in jobs))
+    write_outs_files(manifest, manifest_dir, groups, failures)
+
+    if len(failures) > 0:
+        sys.exit(f'{len(failures)} maps could not be corrected: {", ".join(n for g, n in failures)}')
+
+
+if __name__ == '__main__':
+    main()
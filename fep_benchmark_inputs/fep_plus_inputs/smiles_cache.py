@@ -0,0 +1,132 @@
+import hashlib
+import os
+import sqlite3
+from typing import Callable, Dict, Iterable, List, Optional
+
+from schrodinger.structutils import analyze
+
+# The location of the on-disk cache can be changed with this environment variable. Setting it to 'none' switches off
+# the persistent cache and SMILES are generated every time.
+CACHE_ENV_VARIABLE = 'FEP_SMILES_CACHE'
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'fep_benchmark', 'smiles_cache.sqlite')
+
+# The name under which SMILES from analyze.generate_smiles(struc, unique=True) are stored.
+UNIQUE_SMILES = 'unique'
+
+
+def structure_fingerprint(struc) -> str:
+    """
+    Hash everything about a structure that can change its canonical SMILES: the elements, formal charges, bond orders
+    and the coordinates (which determine the stereochemistry).
+
+    :param struc: A schrodinger.structure.Structure.
+
+    :return: A hex digest that identifies the structure.
+    """
+    h = hashlib.sha1()
+    for a in struc.atom:
+        h.update('{}:{}:{:.3f}:{:.3f}:{:.3f};'.format(a.element, a.formal_charge, a.x, a.y, a.z).encode())
+    for b in struc.bond:
+        h.update('{}-{}:{};'.format(b.atom1.index, b.atom2.index, b.order).encode())
+    return h.hexdigest()
+
+
+class SmilesCache:
+    """
+    A persistent, process-safe store of canonical SMILES keyed by structure fingerprint. The store is an SQLite
+    database, so any number of correction scripts can read and write to it at the same time.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        :param path: The location of the SQLite database. If None, the database is stored in memory and is lost when
+            the process ends.
+        """
+        self.path = path
+        if path is None:
+            self._conn = sqlite3.connect(':memory:')
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, timeout=60.)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS smiles '
+                           '(fingerprint TEXT, method TEXT, smiles TEXT, PRIMARY KEY (fingerprint, method))')
+        self._conn.commit()
+
+    def lookup(self, fingerprints: Iterable[str], method: str = UNIQUE_SMILES) -> Dict[str, str]:
+        """
+        Return the stored SMILES of the fingerprints that are in the cache.
+
+        :param fingerprints: The structure fingerprints to look up.
+        :param method: The name of the SMILES generation method.
+
+        :return: A dictionary from fingerprint to SMILES. Fingerprints that are not in the cache are omitted.
+        """
+        fingerprints = list(set(fingerprints))
+        found = {}
+        # SQLite limits the number of host parameters in a single query.
+        chunk = 500
+        for start in range(0, len(fingerprints), chunk):
+            keys = fingerprints[start:start + chunk]
+            query = 'SELECT fingerprint, smiles FROM smiles WHERE method = ? AND fingerprint IN ({})'.format(
+                ','.join('?' * len(keys)))
+            found.update(self._conn.execute(query, [method] + keys).fetchall())
+        return found
+
+    def store(self, smiles: Dict[str, str], method: str = UNIQUE_SMILES):
+        """
+        Add SMILES to the cache in a single transaction.
+
+        :param smiles: A dictionary from fingerprint to SMILES.
+        :param method: The name of the SMILES generation method.
+        """
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO smiles VALUES (?, ?, ?)',
+                                   [(f, method, s) for f, s in smiles.items()])
+
+    def get_smiles(self, strucs: List, generate: Optional[Callable] = None, method: str = UNIQUE_SMILES) -> List[str]:
+        """
+        Return the SMILES of each structure, only generating the SMILES of the structures that are not in the cache.
+
+        :param strucs: The structures whose SMILES are required.
+        :param generate: The function that turns a structure into a SMILES. Defaults to unique SMILES from
+            analyze.generate_smiles.
+        :param method: The name under which the generated SMILES are stored. Must change if generate changes.
+
+        :return: The SMILES of each structure, in the same order as the input.
+        """
+        if generate is None:
+            generate = _unique_smiles
+        fingerprints = [structure_fingerprint(st) for st in strucs]
+        known = self.lookup(fingerprints, method)
+        new = {}
+        for f, st in zip(fingerprints, strucs):
+            if f not in known and f not in new:
+                new[f] = generate(st)
+        if new:
+            self.store(new, method)
+            known.update(new)
+        return [known[f] for f in fingerprints]
+
+    def close(self):
+        self._conn.close()
+
+
+def _unique_smiles(struc) -> str:
+    return analyze.generate_smiles(struc, unique=True)
+
+
+_default_cache = None
+
+
+def get_default_cache() -> SmilesCache:
+    """
+    Return the cache shared by all grouping code in this process. The location is read from the FEP_SMILES_CACHE
+    environment variable, falling back to ~/.cache/fep_benchmark/smiles_cache.sqlite.
+    """
+    global _default_cache
+    if _default_cache is None:
+        path = os.environ.get(CACHE_ENV_VARIABLE, DEFAULT_CACHE_PATH)
+        if path.lower() == 'none':
+            path = None
+        _default_cache = SmilesCache(path)
+    return _default_cache
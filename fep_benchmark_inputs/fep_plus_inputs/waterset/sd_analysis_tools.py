@@ -2,14 +2,14 @@ import numpy as np
 from copy import deepcopy
 from schrodinger.application.scisol.packages.fep import graph
 from schrodinger.application.scisol.packages.fep import fep_stats
-from schrodinger.application.desmond.measurement import Measurement
-from itertools import combinations
 
+import sys
+sys.path.append('../')
+import edge_corrections as ec
+import fep_map_arrays as fma
 
-from scipy.optimize import minimize
 
-
-def selection_penaly(pka, ph=7., protonated=True):
+def selection_penaly(pka, ph=7., protonated=True, kT=0.596):
     """
     The free energy to select out the either the protonated or deprotonated state of a molecule in solvent.
 
@@ -26,22 +26,28 @@ def selection_penaly(pka, ph=7., protonated=True):
         The pKa of the protonated form.
     protonated: bool
         Whether to spit out the penalty to select either the protonated form, or deprotonated form.
+    kT: float
+        The thermal energy in kcal/mol.
+
+    pka, ph and kT can be numpy arrays, which are broadcast against each other to evaluate many pH values and
+    temperatures at once.
     """
     top = 10 ** (pka - ph)
     if protonated:
-        return -0.596 * np.log(top / (1 + top))
+        return -kT * np.log(top / (1 + top))
     else:
-        return -0.596 * np.log(1 / (1 + top))
+        return -kT * np.log(1 / (1 + top))
 
 
-def solvent_penalty(pka1, pka2, ph=7):
+def solvent_penalty(pka1, pka2, ph=7, kT=0.596):
     """
     Apply the relative free energy penalty to isoloate the neutral forms of two ligands. Used to for the
-    pKa correction of the SD map.
+    pKa correction of the SD map. The arguments can be numpy arrays that broadcast against each other. See
+    ph_scan.py to scan the whole map over pH and temperature.
     """
     top1 = 10 ** (pka1 - ph)
     top2 = 10 ** (pka2 - ph)
-    return -0.596 * np.log((1 + top1) / (1 + top2))
+    return -kT * np.log((1 + top1) / (1 + top2))
 
 
 def apply_solvent_penalty(g_pka, pka_dict):
@@ -55,14 +61,9 @@ def apply_solvent_penalty(g_pka, pka_dict):
     pka_dict: dict
         The dictionary that stores (by ligand name) the macro pKas of the ligands.
     """
-    for e in g_pka.edges_iter():
-        l1 = e.short_id_title.split('==>')[0].split(':')[1].strip()
-        l2 = e.short_id_title.split('==>')[1].split(':')[1].strip()
-        corr = solvent_penalty(pka_dict[l1], pka_dict[l2])
-        unc = e.complex_dg.unc
-        val = e.complex_dg.val
-        e.complex_dg = Measurement(val + corr, unc)
-    g_pka.calc_cycle_closure()
+    layer = ec.EdgeCorrections(g_pka)
+    layer.add_solvent_pka(pka_dict)
+    layer.apply()
 
 def pretty_print_fmp(g):
     """
@@ -115,22 +116,15 @@ if __name__ == '__main__':
 
     if args.optimize:
         # Minimize the pKas from the starting dict subject to the constraint that they can be no more than 1 log unit away from their starting value.
+        # The objective works on arrays extracted once from the graph, so each evaluation is a cheap cycle closure with
+        # a cached factorization and the optimizer can use the analytic gradient.
         X0 = np.array((pka_dict['2d'], pka_dict['6d'], pka_dict['8d']))
-        def pairwise_error_constraint(pkas):
-            """
-            Defining the function that will be minimized.
-            """
-            if np.any(np.abs(X0 - pkas) > 1):
-                return np.inf
-            else:
-                g_pka_corr = deepcopy(g)
-                pka_dict_mod = {'2d': pkas[0], '3d': 8.0, '4d': 5.45, '5d': 4.06, '6d': pkas[1], '7d': 5.42, '8d': pkas[2]}
-                apply_solvent_penalty(g_pka_corr, pka_dict_mod)
-                r = fep_stats.calculate(g_pka_corr)
-                return r['RMSE Edgewise'].val
+        pka_dict_fixed = {'3d': 8.0, '4d': 5.45, '5d': 4.06, '7d': 5.42}
+        arrays = fma.MapArrays.from_graph(g)
+        objective = fma.SolventPkaObjective(arrays, pka_dict_fixed, ['2d', '6d', '8d'], metric='edgewise')
 
         print('\nOptimizing pKas of 2d, 6d and 8d to minimize the edgewise RMSE...')
-        result = minimize(fun=pairwise_error_constraint, x0=X0, method='Nelder-Mead', options={'maxiter': 100})
+        result = fma.fit_solvent_pkas(objective, X0, max_shift=1.)
         pka_dict['2d'] = result.x[0]
         pka_dict['6d'] = result.x[1]
         pka_dict['8d'] = result.x[2]